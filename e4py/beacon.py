@@ -0,0 +1,241 @@
+"""
+Server beacons.
+
+Servers announce themselves by periodic beacons carrying their GUID and a change count of the served channels.
+:class:`BeaconEmitter` sends them fast after startup or a change and slows down while the server is stable.
+
+Clients keep a :class:`BeaconTable` of the servers seen. A new GUID at an address that had another one means
+the server restarted: only the channels connected to it are searched again. A new server or a changed
+change count makes unresolved channels be searched again right away.
+"""
+import ipaddress
+import socket
+import struct
+import threading
+
+from . import constants
+from .messages import *
+from .timer import now, scheduler
+from .transport import close_socket
+
+
+class BeaconEmitter(object):
+    """
+    Send beacons of a server, every *min_period* seconds at first, doubling up to *max_period*.
+
+    :param addresses: [(*host*, *port*)] beacon destinations, usually broadcast addresses
+    :param change_count: callable returning the change count of the served channels, a new value
+                         resets the period to *min_period*
+    """
+    def __init__(self, addresses, guid, port=constants.PVA_SERVER_PORT, change_count=None,
+                 min_period=constants.PVA_BEACON_MIN_PERIOD, max_period=constants.PVA_BEACON_MAX_PERIOD):
+        self.addresses = addresses
+        self.guid = guid
+        self.port = port
+        self.change_count = change_count
+        self.min_period = min_period
+        self.max_period = max_period
+        self.period = min_period
+        self.sequenceId = 0
+        self.last_count = None
+        self.timer = None
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+
+    def start(self):
+        self.timer = scheduler.schedule(0, self.send)
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def send(self):
+        count = self.change_count() if self.change_count is not None else 0
+        if count != self.last_count:
+            self.last_count = count
+            self.period = self.min_period
+        beacon = BeaconMessage(self.guid, 0, self.sequenceId, count, ipaddress.ip_address(u'::ffff:0:0'),
+                               self.port, b'tcp')
+        self.sequenceId = (self.sequenceId + 1) & 0xff
+        data = beacon.to_buffer()
+        for address in self.addresses:
+            try:
+                self.sock.sendto(data, address)
+            except EnvironmentError:
+                pass
+        self.timer = scheduler.schedule(self.period, self.send)
+        self.period = min(2 * self.period, self.max_period)
+
+
+class ServerEntry(object):
+    """
+    What the beacons of one server told.
+    """
+    def __init__(self, guid, address, changeCount):
+        self.guid = guid
+        self.address = address
+        self.changeCount = changeCount
+        self.last_seen = now()
+        self.beacons = 0
+
+
+class BeaconTable(object):
+    """
+    Servers by GUID, fed by :meth:`beacon_received`. Servers that went silent are dropped by :meth:`expire`,
+    run periodically once :meth:`start_expiry` is called, as the :class:`BeaconListener` does.
+
+    :param searcher: :class:`e4py.search.SearchScheduler` to re-search with
+    """
+    def __init__(self, searcher=None):
+        self.searcher = searcher
+        self.servers = {}
+        # (host, port) -> GUID
+        self.addresses = {}
+        # (host, port) -> {name: callback} of the channels connected there
+        self.channels = {}
+        self.anomaly_callbacks = []
+        self.server_callbacks = []
+        self.lock = threading.Lock()
+        self.timer = None
+
+    def add_server_callback(self, callback):
+        """
+        Call *callback(address)* when a server is seen at (*host*, *port*) for the first time.
+        """
+        self.server_callbacks.append(callback)
+
+    def add_anomaly_callback(self, callback):
+        """
+        Call *callback(address)* when the server at (*host*, *port*) restarted or changed its channels.
+        """
+        self.anomaly_callbacks.append(callback)
+
+    def connected(self, name, address, callback):
+        """
+        Note that channel *name* is served from *address*, it is searched again with *callback* if that
+        server restarts.
+        """
+        with self.lock:
+            self.channels.setdefault(address, {})[name] = callback
+
+    def disconnected(self, name, address):
+        with self.lock:
+            channels = self.channels.get(address)
+            if channels is not None:
+                channels.pop(name, None)
+
+    def beacon_received(self, beacon, sender):
+        """
+        :param beacon: :class:`BeaconMessage`
+        :param sender: source address of the datagram
+        """
+        server = beacon.serverAddress
+        if server.ipv4_mapped is not None:
+            server = server.ipv4_mapped
+        address = (sender[0] if server.is_unspecified else str(server), beacon.serverPort)
+        restarted = changed = new = False
+        with self.lock:
+            entry = self.servers.get(beacon.guid)
+            if entry is None:
+                previous = self.addresses.get(address)
+                if previous is not None:
+                    del self.servers[previous]
+                    restarted = True
+                else:
+                    new = True
+                entry = self.servers[beacon.guid] = ServerEntry(beacon.guid, address, beacon.changeCount)
+                self.addresses[address] = beacon.guid
+                changed = True
+            elif entry.changeCount != beacon.changeCount:
+                entry.changeCount = beacon.changeCount
+                changed = True
+            entry.last_seen = now()
+            entry.beacons += 1
+            research = self.channels.pop(address, {}) if restarted else {}
+        if self.searcher is not None:
+            for name, callback in research.items():
+                self.searcher.search(name, callback)
+            if changed:
+                self.searcher.boost()
+        if new:
+            for callback in self.server_callbacks:
+                callback(address)
+        if restarted or (changed and entry.beacons > 1):
+            for callback in self.anomaly_callbacks:
+                callback(address)
+
+    def expire(self, timeout=5 * constants.PVA_BEACON_MAX_PERIOD):
+        """
+        Forget servers silent for *timeout* seconds.
+        """
+        t = now()
+        with self.lock:
+            for guid, entry in list(self.servers.items()):
+                if t - entry.last_seen > timeout:
+                    del self.servers[guid]
+                    if self.addresses.get(entry.address) == guid:
+                        del self.addresses[entry.address]
+
+    def start_expiry(self, period=constants.PVA_BEACON_MAX_PERIOD, timeout=5 * constants.PVA_BEACON_MAX_PERIOD):
+        """
+        Run :meth:`expire` every *period* seconds on the shared scheduler.
+        """
+        with self.lock:
+            if self.timer is None:
+                self.timer = scheduler.schedule_periodic(period, self.expire, timeout)
+
+    def stop_expiry(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+
+class BeaconListener(object):
+    """
+    Receive beacons on the broadcast port and feed them to a :class:`BeaconTable`.
+    """
+    def __init__(self, table, port=constants.PVA_BROADCAST_PORT):
+        self.table = table
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.sock.bind(('', port))
+        self.thread = None
+        self.closed = False
+
+    def run(self):
+        while True:
+            try:
+                chunk, sender = self.sock.recvfrom(0x10000)
+            except EnvironmentError:
+                break
+            if self.closed:
+                break
+            buffer = BufferReader(chunk)
+            try:
+                header = MessageHeader.from_buffer(buffer)
+                if header.messageCommand != ApplicationMessageCode.Beacon:
+                    continue
+                beacon = BeaconMessage.from_buffer(buffer)
+            except (ValueError, struct.error):
+                continue
+            self.table.beacon_received(beacon, sender)
+
+    def start(self):
+        self.table.start_expiry()
+        self.thread = threading.Thread(target=self.run, name='e4py-beacons')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        """
+        Stop expiring servers and close the socket, which ends the receiving thread.
+        """
+        self.closed = True
+        self.table.stop_expiry()
+        close_socket(self.sock)
+        if self.thread is not None:
+            self.thread.join()
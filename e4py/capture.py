@@ -0,0 +1,364 @@
+"""
+Offline decoder for pvAccess captures.
+
+A capture is the raw TCP byte stream of a pvAccess connection, e.g. as reassembled by tcpflow or
+exported from wireshark with "Follow TCP Stream" in raw mode. The file is memory-mapped and cut into byte ranges
+which are decoded in parallel by a process pool. Each worker synchronizes on the first run of chained message
+headers in its range and decodes the messages whose header starts in the range, so the parent never walks the
+capture.
+
+Usage::
+
+    python -m e4py.capture [--stream] [--jobs N] capture.bin
+"""
+from __future__ import print_function
+import argparse
+import collections
+import mmap
+import multiprocessing
+import os
+import struct
+import sys
+
+from . import constants
+from .messages import MessageHeader, BufferReader, MessageDirection, \
+    ApplicationMessageCode, ControlMessageCode, \
+    BeaconMessage, SearchRequest, SearchResponse, \
+    ConnectionValidationRequest, ConnectionValidationResponse, ConnectionValidatedResponse, \
+    CreateChannelRequest, CreateChannelResponse, ChannelGetFieldRequest, ChannelGetFieldResponse
+
+
+#: message class by (command, direction)
+DECODERS = {
+    (ApplicationMessageCode.Beacon, MessageDirection.Server): BeaconMessage,
+    (ApplicationMessageCode.SearchRequest, MessageDirection.Client): SearchRequest,
+    (ApplicationMessageCode.SearchResponse, MessageDirection.Server): SearchResponse,
+    (ApplicationMessageCode.ConnectionValidation, MessageDirection.Server): ConnectionValidationRequest,
+    (ApplicationMessageCode.ConnectionValidation, MessageDirection.Client): ConnectionValidationResponse,
+    (ApplicationMessageCode.ConnectionValidated, MessageDirection.Server): ConnectionValidatedResponse,
+    (ApplicationMessageCode.CreateChannel, MessageDirection.Client): CreateChannelRequest,
+    (ApplicationMessageCode.CreateChannel, MessageDirection.Server): CreateChannelResponse,
+    (ApplicationMessageCode.ChannelIF, MessageDirection.Client): ChannelGetFieldRequest,
+    (ApplicationMessageCode.ChannelIF, MessageDirection.Server): ChannelGetFieldResponse,
+}
+
+# client requests starting with serverChannelID, requestID
+CHANNEL_REQUESTS = frozenset([
+    ApplicationMessageCode.ChannelGet, ApplicationMessageCode.ChannelPut, ApplicationMessageCode.ChannelPutGet,
+    ApplicationMessageCode.ChannelMonitor, ApplicationMessageCode.ChannelArray,
+    ApplicationMessageCode.ChannelProcess, ApplicationMessageCode.ChannelIF, ApplicationMessageCode.ChannelRPC,
+])
+
+_header = struct.Struct('BBBBI')
+
+# consecutive plausible headers that identify a frame boundary in the middle of a capture
+_SYNC_DEPTH = 4
+
+# bytes per range in --stream mode, bounds the output a worker returns at once
+_STREAM_RANGE_SIZE = 1 << 20
+
+
+def _is_header(source, offset, end):
+    """
+    True if a plausible message header starts at *offset*.
+    """
+    if offset + constants.PVA_MESSAGE_HEADER_SIZE > end:
+        return False
+    magic, version, flags, command, size = _header.unpack_from(source, offset)
+    if magic != constants.PVA_MAGIC:
+        return False
+    if flags & 0x01:
+        return command <= max(ControlMessageCode)
+    return command <= max(ApplicationMessageCode) and offset + constants.PVA_MESSAGE_HEADER_SIZE + size <= end
+
+
+def _frame_size(source, offset):
+    magic, version, flags, command, size = _header.unpack_from(source, offset)
+    if flags & 0x01:
+        size = 0
+    return constants.PVA_MESSAGE_HEADER_SIZE + size
+
+
+def scan_frames(source, start=0, end=None, stop=None):
+    """
+    Iterate over the messages in *source*.
+
+    Bytes that do not belong to a valid message, e.g. a truncated capture start, are skipped
+    up to the next frame boundary found by :func:`synchronize`.
+
+    :param source: bytes-like object, typically a :class:`mmap.mmap`
+    :param end: end of the data, messages must fit before it
+    :param stop: only messages whose header starts before *stop*, by default *end*
+    :return: generator of (*offset*, *size*) tuples
+    """
+    if end is None:
+        end = len(source)
+    if stop is None:
+        stop = end
+    offset = start
+    while offset < stop:
+        if not _is_header(source, offset, end):
+            offset = synchronize(source, offset + 1, end)
+            continue
+        size = _frame_size(source, offset)
+        yield offset, size
+        offset += size
+
+
+def synchronize(source, offset, end=None, depth=_SYNC_DEPTH):
+    """
+    Find the first frame boundary at or after *offset*, the start of *depth* chained plausible headers
+    or of a chain reaching *end*. A single magic byte inside a payload rarely starts such a chain.
+
+    :return: offset of the boundary, *end* if there is none
+    """
+    if end is None:
+        end = len(source)
+    while 0 <= offset < end:
+        position = offset
+        chained = 0
+        while chained < depth and _is_header(source, position, end):
+            position += _frame_size(source, position)
+            chained += 1
+        if chained == depth or chained and position == end:
+            return offset
+        offset = source.find(b'\xca', offset + 1, end)
+    return end
+
+
+def split_ranges(size, parts=None, range_size=None):
+    """
+    Cut *size* bytes into *parts* byte ranges of similar size, or into ranges of at most *range_size* bytes.
+    Ranges are not aligned to frames, see :func:`range_frames`.
+
+    :return: list of (*start*, *stop*) tuples
+    """
+    if range_size is None:
+        range_size = -(-size // max(parts, 1))
+    range_size = max(range_size, 1)
+    return [(start, min(start + range_size, size)) for start in range(0, size, range_size)]
+
+
+def range_frames(source, start, stop):
+    """
+    Iterate over the messages whose header starts in [*start*, *stop*). Consecutive ranges together
+    yield every message of the capture once.
+
+    :return: generator of (*offset*, *size*) tuples
+    """
+    return scan_frames(source, synchronize(source, start), len(source), stop)
+
+
+def decode_message(header, buffer):
+    """
+    Decode the message body following *header*.
+
+    :return: message instance or None if the message type has no decoder
+    """
+    if header.is_control():
+        return None
+    decoder = DECODERS.get((header.messageCommand, header.flags.direction))
+    if decoder is None:
+        return None
+    return decoder.from_buffer(buffer)
+
+
+class CaptureSummary(object):
+    """
+    Message and byte counts per command and per channel.
+
+    Workers only see a part of the capture, so channel statistics are kept by the raw IDs
+    found in the messages and resolved to channel names after all parts are merged.
+    """
+    def __init__(self):
+        self.commands = {}
+        self.searches = {}
+        # clientChannelID -> name, serverChannelID -> clientChannelID, requestID -> serverChannelID
+        self.channel_names = {}
+        self.server_channels = {}
+        self.requests = {}
+        # [messages, bytes] by serverChannelID and requestID
+        self.by_channel = {}
+        self.by_request = {}
+        self.errors = 0
+
+    @staticmethod
+    def _count(table, key, size):
+        stat = table.get(key)
+        if stat is None:
+            table[key] = [1, size]
+        else:
+            stat[0] += 1
+            stat[1] += size
+
+    def add(self, header, buffer):
+        """
+        Account the message whose payload starts at the current *buffer* position.
+        """
+        size = header.message_size()
+        self._count(self.commands, (header.flags.type_, header.messageCommand), size)
+        if header.is_control():
+            return
+
+        command = header.messageCommand
+        direction = header.flags.direction
+        if command == ApplicationMessageCode.SearchRequest:
+            for id_, name in SearchRequest.from_buffer(buffer).channels:
+                self.searches[name] = self.searches.get(name, 0) + 1
+        elif command == ApplicationMessageCode.CreateChannel:
+            if direction == MessageDirection.Client:
+                self.channel_names.update(CreateChannelRequest.from_buffer(buffer).channels)
+            else:
+                response = CreateChannelResponse.from_buffer(buffer)
+                self.server_channels[response.serverChannelID] = response.clientChannelID
+        elif command == ApplicationMessageCode.DestroyChannel:
+            self._count(self.by_channel, buffer.get_integer(), size)
+        elif command in CHANNEL_REQUESTS:
+            if direction == MessageDirection.Client:
+                serverChannelID = buffer.get_integer()
+                requestID = buffer.get_integer()
+                self.requests[requestID] = serverChannelID
+                self._count(self.by_channel, serverChannelID, size)
+            else:
+                self._count(self.by_request, buffer.get_integer(), size)
+
+    def merge(self, other):
+        for table in ('commands', 'by_channel', 'by_request'):
+            mine = getattr(self, table)
+            for key, (messages, bytes_) in getattr(other, table).items():
+                stat = mine.setdefault(key, [0, 0])
+                stat[0] += messages
+                stat[1] += bytes_
+        for name, count in other.searches.items():
+            self.searches[name] = self.searches.get(name, 0) + count
+        self.channel_names.update(other.channel_names)
+        self.server_channels.update(other.server_channels)
+        self.requests.update(other.requests)
+        self.errors += other.errors
+
+    def channels(self):
+        """
+        Return {*name*: [*messages*, *bytes*]} combining requests and responses of each channel.
+        """
+        def name_of(serverChannelID):
+            clientChannelID = self.server_channels.get(serverChannelID)
+            return self.channel_names.get(clientChannelID, '<sid %d>' % serverChannelID)
+
+        channels = {}
+        for serverChannelID, (messages, bytes_) in self.by_channel.items():
+            stat = channels.setdefault(name_of(serverChannelID), [0, 0])
+            stat[0] += messages
+            stat[1] += bytes_
+        for requestID, (messages, bytes_) in self.by_request.items():
+            serverChannelID = self.requests.get(requestID)
+            if serverChannelID is None:
+                name = '<ioid %d>' % requestID
+            else:
+                name = name_of(serverChannelID)
+            stat = channels.setdefault(name, [0, 0])
+            stat[0] += messages
+            stat[1] += bytes_
+        return channels
+
+    def __str__(self):
+        output = 'Commands\n'
+        for (type_, command), (messages, bytes_) in sorted(self.commands.items(), key=lambda x: -x[1][1]):
+            output += '  %-24s %10d msgs %14d bytes\n' % (command.name, messages, bytes_)
+        channels = self.channels()
+        if channels:
+            output += 'Channels\n'
+        for name, (messages, bytes_) in sorted(channels.items(), key=lambda x: -x[1][1]):
+            if isinstance(name, bytes):
+                name = name.decode('utf-8', 'replace')
+            output += '  %-40s %10d msgs %14d bytes\n' % (name, messages, bytes_)
+        if self.searches:
+            output += 'Searches\n'
+        for name, count in sorted(self.searches.items(), key=lambda x: -x[1]):
+            output += '  %-40s %10d\n' % (name.decode('utf-8', 'replace'), count)
+        if self.errors:
+            output += 'Undecodable messages: %d\n' % self.errors
+        return output
+
+
+_source = None
+
+
+def _open(path):
+    with open(path, 'rb') as f:
+        # the map keeps its own handle of the file
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _init_worker(path):
+    global _source
+    _source = _open(path)
+
+
+def _summarize_range(range_):
+    summary = CaptureSummary()
+    buffer = BufferReader(_source)
+    for offset, size in range_frames(_source, *range_):
+        buffer.index = offset
+        header = MessageHeader.from_buffer(buffer)
+        try:
+            summary.add(header, buffer)
+        except Exception:
+            summary.errors += 1
+    return summary
+
+
+def _decode_range(range_):
+    output = []
+    buffer = BufferReader(_source)
+    for offset, size in range_frames(_source, *range_):
+        buffer.index = offset
+        header = MessageHeader.from_buffer(buffer)
+        try:
+            message = decode_message(header, buffer)
+        except Exception as e:
+            message = '<undecodable: %s>\n' % e
+        output.append('@%d\n%s%s' % (offset, header, message or ''))
+    return output
+
+
+def _ordered_results(pool, function, ranges, window):
+    """
+    Results of *function* over *ranges* in order, with at most *window* of them pending or held.
+    """
+    pending = collections.deque()
+    for range_ in ranges:
+        pending.append(pool.apply_async(function, (range_,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='e4py.capture', description='Decode a pvAccess capture file')
+    parser.add_argument('capture', help='raw pvAccess byte stream')
+    parser.add_argument('--stream', action='store_true', help='print every decoded message instead of a summary')
+    parser.add_argument('--jobs', type=int, default=multiprocessing.cpu_count(), help='number of worker processes')
+    args = parser.parse_args(argv)
+
+    size = os.path.getsize(args.capture)
+    pool = multiprocessing.Pool(args.jobs, initializer=_init_worker, initargs=(args.capture,))
+    try:
+        if args.stream:
+            ranges = split_ranges(size, range_size=_STREAM_RANGE_SIZE)
+            for output in _ordered_results(pool, _decode_range, ranges, 2 * args.jobs):
+                for message in output:
+                    print(message)
+        else:
+            # a few ranges per worker to balance uneven message mixes
+            summary = CaptureSummary()
+            for part in pool.imap_unordered(_summarize_range, split_ranges(size, args.jobs * 4)):
+                summary.merge(part)
+            print(summary)
+    finally:
+        pool.close()
+        pool.join()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
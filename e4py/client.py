@@ -1,41 +1,1301 @@
+"""
+pvAccess client.
+
+A :class:`Context` resolves channel names with a :class:`SearchScheduler` and connects them through a
+:class:`ConnectionPool`, which keeps a single TCP connection per server, identified by its GUID and address,
+however many channels are open on it. Connections are opened in the background, a few at a time, and an
+unused connection lingers for a while before it is closed, so channels that are closed and opened again,
+e.g. by a display reloading, find it still there. Introspection results are kept per server by an
+:class:`IntrospectionCache`, so a display reloading does not ask for them again either.
+"""
+import collections
+import itertools
+import math
 import socket
+import struct
 import threading
 
+from . import constants
+from . import health
+from .beacon import BeaconListener, BeaconTable
+from .data import DataFlag, DataObject, LazyStructure
 from .messages import *
+from .messages import BufferWriter, StatusType
+from .nameserver import NameServerClient
+from .search import SearchScheduler, address_list, name_server_list
+from .timer import now, scheduler
+from .transport import Connection, configure_socket
+
+# most channels per CreateChannel request
+_MAX_CREATE_CHANNELS = 1024
+# seconds before the ID of a finished request is used again
+_ID_QUARANTINE = 5.
+# serverChannelID, requestID and subcommand of a channel request
+_REQUEST = struct.Struct('IIB')
+
+# outcomes of requests ended by the client
+_TIMED_OUT = Status(StatusType.ERROR, b'timed out')
+_CANCELLED = Status(StatusType.ERROR, b'cancelled')
+_DISCONNECTED = Status(StatusType.ERROR, b'connection lost')
+
+
+def _sizes(*sizes):
+    buffer = BufferWriter()
+    for size in sizes:
+        buffer._put_size(size)
+    return buffer
 
-def run_socket_client(addr, port):
+
+def _raise(status, what):
+    """
+    Raise the exception for the failed *status* of request *what*.
+    """
+    if status is _TIMED_OUT:
+        raise socket.timeout('%s timed out' % what)
+    raise ValueError(status.message.decode())
+
+
+def run_socket_client(addr, port, name=b'testMP', introspection=None, guid=None):
     sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+    configure_socket(sock, constants.PVA_RECEIVE_BUFFER_SIZE)
     sock.connect((addr, port))
 
-    dispatcher = ClientMessageDispatcher(sock)
-    while True:
-        chunk = sock.recv(1024)
-        status = dispatcher.data_received(chunk)
-        if status == 0:
-            break
-    sock.close()
+    connection = Connection(sock)
+    connection.dispatcher = ClientMessageDispatcher(connection, name, introspection, (guid, addr, port))
+    health.monitor.register(connection)
+    connection.run()
 
-def run_client():
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-    if hasattr(socket, 'SO_REUSEPORT'):
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
-
-    sock.bind(('0.0.0.0', 50001))
-
-    search = SearchRequest(1, 0, u'::ffff:0:0', 50001, [b'tcp'], [(1, b'testMP')])
-    sock.sendto(search.to_buffer(), ('192.168.1.255', 5076))
-
-    chunk, addr = sock.recvfrom(1024)
-    buffer = BufferReader(chunk)
-    header = MessageHeader.from_buffer(buffer)
-    print(header)
-    if header.messageCommand == ApplicationMessageCode.SearchResponse:
-        response = SearchResponse.from_buffer(buffer)
-        print(response)
-        tid = threading.Thread(target=run_socket_client, args=(response.serverAddress.compressed, response.serverPort))
+
+class ClientDispatcher(MessageDispatcher):
+    """
+    Client side of a :class:`ClientConnection`, routing responses to its channels and requests.
+    """
+    def __init__(self, transport, client):
+        MessageDispatcher.__init__(self, transport)
+        self.client = client
+        # keep the connection running between messages
+        self.pending = True
+
+    def message_received(self, header, buffer):
+        client = self.client
+        command = header.messageCommand
+        if command == ApplicationMessageCode.ConnectionValidation:
+            request = ConnectionValidationRequest.from_buffer(buffer)
+            self.transport.set_send_buffer_size(request.serverReceiverBufferSize)
+            response = ConnectionValidationResponse(self.transport.receive_buffer_size,
+                                                    request.serverIntrospectionRegistryMaxSize, 0, b'')
+            self.send_data(response.to_buffer())
+        elif command == ApplicationMessageCode.ConnectionValidated:
+            response = ConnectionValidatedResponse.from_buffer(buffer)
+            if response.status.is_ok():
+                client.validated()
+            else:
+                self.transport.close()
+        elif command == ApplicationMessageCode.CreateChannel:
+            client.channel_created(CreateChannelResponse.from_buffer(buffer))
+        elif command == ApplicationMessageCode.DestroyChannel:
+            client.channel_destroyed(DestroyChannelRequest.from_buffer(buffer))
+        elif command in (ApplicationMessageCode.ChannelIF, ApplicationMessageCode.ChannelGet,
+                         ApplicationMessageCode.ChannelPut, ApplicationMessageCode.ChannelPutGet,
+                         ApplicationMessageCode.ChannelMonitor, ApplicationMessageCode.ChannelArray,
+                         ApplicationMessageCode.ChannelProcess, ApplicationMessageCode.ChannelRPC):
+            handler = client.requests.get(struct.unpack_from('I', buffer.source, buffer.index)[0])
+            if handler is not None:
+                handler.response_received(command, buffer)
+
+    def connection_lost(self):
+        self.client.closed()
+
+
+class RequestManager(object):
+    """
+    Request IDs and pending requests of a :class:`ClientConnection`.
+
+    IDs of finished requests go to the end of a free list and are only handed out again after a quarantine,
+    so a late response to a timed out request is not mistaken for the answer to the next one. Timeouts sit in
+    the buckets of a timer wheel that ticks every *tick* seconds while any is pending. Adding, settling and
+    removing a request are O(1).
+
+    Handlers get their responses through ``response_received(command, buffer)`` and are told by
+    ``abort(status)`` when the request times out, is cancelled or the connection is lost. They need a
+    ``serverChannelID`` attribute for the CancelRequest and DestroyRequest sent to the server.
+    """
+    def __init__(self, client, tick=0.1, slots=512):
+        self.client = client
+        self.period = tick
+        self.wheel = [set() for i in range(slots)]
+        self.tick = 0
+        # requestID -> handler
+        self.handlers = {}
+        # requestID -> (slot, deadline tick)
+        self.deadlines = {}
+        # (requestID, time freed)
+        self.free = collections.deque()
+        self.next_id = 1
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def add(self, handler, timeout=None):
+        """
+        :param timeout: seconds after which the request is cancelled, see :meth:`settle`
+        :return: request ID for *handler*
+        """
+        with self.lock:
+            if self.free and now() - self.free[0][1] >= _ID_QUARANTINE:
+                requestID = self.free.popleft()[0]
+            else:
+                requestID = self.next_id
+                self.next_id = self.next_id % 0xffffffff + 1
+            self.handlers[requestID] = handler
+            if timeout is not None:
+                deadline = self.tick + max(1, int(math.ceil(timeout / self.period)))
+                slot = deadline % len(self.wheel)
+                self.wheel[slot].add(requestID)
+                self.deadlines[requestID] = (slot, deadline)
+                if self.timer is None:
+                    self.timer = scheduler.schedule_periodic(self.period, self._tick)
+        return requestID
+
+    def get(self, requestID):
+        return self.handlers.get(requestID)
+
+    def _unschedule(self, requestID):
+        entry = self.deadlines.pop(requestID, None)
+        if entry is not None:
+            self.wheel[entry[0]].discard(requestID)
+            if not self.deadlines and self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+    def _pop(self, requestID):
+        handler = self.handlers.pop(requestID, None)
+        if handler is not None:
+            self._unschedule(requestID)
+            self.free.append((requestID, now()))
+        return handler
+
+    def settle(self, requestID):
+        """
+        Keep the request without a timeout, e.g. once a long lived request is initialized.
+        """
+        with self.lock:
+            self._unschedule(requestID)
+
+    def remove(self, requestID):
+        """
+        Forget a finished request.
+        """
+        with self.lock:
+            self._pop(requestID)
+
+    def destroy(self, requestID):
+        """
+        Forget the request and have the server release it.
+        """
+        with self.lock:
+            handler = self._pop(requestID)
+        if handler is not None:
+            self.client.send(DestroyRequest(handler.serverChannelID, requestID).to_buffer())
+
+    def cancel(self, requestID, status=_CANCELLED):
+        """
+        Cancel and destroy the request on the server and abort its handler with *status*.
+        """
+        with self.lock:
+            handler = self._pop(requestID)
+        if handler is None:
+            return
+        self.client.send(self._cancellation(handler, requestID))
+        handler.abort(status)
+
+    @staticmethod
+    def _cancellation(handler, requestID):
+        return DestroyRequest(handler.serverChannelID, requestID, ApplicationMessageCode.CancelRequest) \
+            .to_buffer() + DestroyRequest(handler.serverChannelID, requestID).to_buffer()
+
+    def abort_all(self, status):
+        """
+        Abort all requests, e.g. when the connection is lost.
+        """
+        with self.lock:
+            handlers = list(self.handlers.values())
+            self.handlers.clear()
+            for requestID in list(self.deadlines):
+                self._unschedule(requestID)
+        for handler in handlers:
+            handler.abort(status)
+
+    def _tick(self):
+        with self.lock:
+            self.tick += 1
+            bucket = self.wheel[self.tick % len(self.wheel)]
+            expired = [requestID for requestID in bucket if self.deadlines[requestID][1] <= self.tick]
+            handlers = [(requestID, self._pop(requestID)) for requestID in expired]
+        if not handlers:
+            return
+        # not on the scheduler thread, the send may block
+        data = b''.join(self._cancellation(handler, requestID) for requestID, handler in handlers)
+        thread = threading.Thread(target=self.client.send, args=(data,))
+        thread.daemon = True
+        thread.start()
+        for requestID, handler in handlers:
+            handler.abort(_TIMED_OUT)
+
+    def __len__(self):
+        return len(self.handlers)
+
+
+class ClientConnection(object):
+    """
+    Connection to one server, shared by the channels a :class:`ConnectionPool` has there.
+
+    Channels attached before the connection is validated are created together once it is.
+    Requests are kept by a :class:`RequestManager`.
+    """
+    CONNECTING, READY, CLOSED = range(3)
+
+    def __init__(self, pool, key):
+        self.pool = pool
+        self.key = key
+        self.guid = key[0]
+        self.address = key[1:]
+        self.state = ClientConnection.CONNECTING
+        self.connection = None
+        # channels holding the connection, see :meth:`ConnectionPool.acquire`
+        self.references = 0
+        self.linger_timer = None
+        self.gated = False
+        # clientChannelID -> channel
+        self.channels = {}
+        # serverChannelID -> clientChannelID
+        self.server_ids = {}
+        self.channel_ids = itertools.count(1)
+        self.requests = RequestManager(self)
+        self.lock = threading.Lock()
+
+    def open(self):
+        tid = threading.Thread(target=self._run, name='e4py-client')
+        tid.daemon = True
         tid.start()
 
+    def _run(self):
+        # at most max_connecting connections are between connect and validation
+        self.pool.connecting.acquire()
+        self.gated = True
+        timer = scheduler.schedule(self.pool.timeout, self._validation_timeout)
+        try:
+            family, type_, proto, canonname, sockaddr = socket.getaddrinfo(
+                self.address[0], self.address[1], 0, socket.SOCK_STREAM)[0]
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            configure_socket(sock, constants.PVA_RECEIVE_BUFFER_SIZE)
+            sock.settimeout(self.pool.timeout)
+            sock.connect(sockaddr)
+            sock.settimeout(None)
+        except EnvironmentError:
+            timer.cancel()
+            self.closed()
+            return
+        connection = Connection(sock)
+        connection.dispatcher = ClientDispatcher(connection, self)
+        health.monitor.register(connection)
+        with self.lock:
+            self.connection = connection
+            abandoned = self.state == ClientConnection.CLOSED
+        if abandoned:
+            connection.close()
+        else:
+            connection.run()
+        timer.cancel()
+
+    def _ungate(self):
+        with self.lock:
+            gated = self.gated
+            self.gated = False
+        if gated:
+            self.pool.connecting.release()
+
+    def _validation_timeout(self):
+        if self.state == ClientConnection.CONNECTING:
+            self.close()
+
+    def validated(self):
+        with self.lock:
+            self.state = ClientConnection.READY
+            channels = [(clientChannelID, channel.name) for clientChannelID, channel in self.channels.items()]
+        self._ungate()
+        for i in range(0, len(channels), _MAX_CREATE_CHANNELS):
+            self.send(CreateChannelRequest(channels[i:i + _MAX_CREATE_CHANNELS]).to_buffer())
+
+    def send(self, data):
+        connection = self.connection
+        if connection is None:
+            return
+        try:
+            connection.send(data)
+        except EnvironmentError:
+            pass
+
+    def queue(self, data):
+        """
+        Queue *data* without writing it, for callers holding a lock, see :meth:`flush`.
+        """
+        connection = self.connection
+        if connection is not None:
+            connection.queue_buffers((data,))
+
+    def flush(self):
+        """
+        Write what :meth:`queue` left. Writable callbacks may run, so no lock they take must be held.
+        """
+        connection = self.connection
+        if connection is None or connection.dispatching:
+            return
+        try:
+            connection.flush()
+        except EnvironmentError:
+            pass
+
+    def attach(self, channel):
+        """
+        Create *channel* on the server, as soon as the connection is validated.
+        """
+        with self.lock:
+            clientChannelID = next(self.channel_ids) & 0xffffffff
+            while not clientChannelID or clientChannelID in self.channels:
+                clientChannelID = next(self.channel_ids) & 0xffffffff
+            channel.clientChannelID = clientChannelID
+            self.channels[clientChannelID] = channel
+            state = self.state
+        if state == ClientConnection.READY:
+            self.send(CreateChannelRequest([(channel.clientChannelID, channel.name)]).to_buffer())
+        elif state == ClientConnection.CLOSED:
+            # lost between acquire and attach
+            self.detach(channel)
+            channel.connection_lost(self)
+
+    def detach(self, channel):
+        """
+        Forget *channel* and destroy it on the server.
+        """
+        serverChannelID = channel.serverChannelID
+        with self.lock:
+            if self.channels.get(channel.clientChannelID) is not channel:
+                return
+            del self.channels[channel.clientChannelID]
+            if serverChannelID is not None:
+                self.server_ids.pop(serverChannelID, None)
+            ready = self.state == ClientConnection.READY
+        if ready and serverChannelID is not None:
+            self.send(DestroyChannelRequest(serverChannelID, channel.clientChannelID).to_buffer())
+
+    def channel_created(self, response):
+        with self.lock:
+            channel = self.channels.get(response.clientChannelID)
+            if channel is not None and response.status.is_ok():
+                self.server_ids[response.serverChannelID] = response.clientChannelID
+        if channel is not None:
+            channel.created(self, response)
+
+    def channel_destroyed(self, response):
+        """
+        The server destroyed a channel, or confirmed that it did so on request.
+        """
+        with self.lock:
+            clientChannelID = self.server_ids.pop(response.serverChannelID, None)
+            channel = self.channels.pop(clientChannelID, None) if clientChannelID is not None else None
+        if channel is not None:
+            channel.connection_lost(self)
+
+    def add_request(self, handler, timeout=None):
+        """
+        :return: request ID for *handler*, see :meth:`RequestManager.add`
+        """
+        return self.requests.add(handler, timeout)
+
+    def remove_request(self, requestID):
+        self.requests.remove(requestID)
+
+    def close(self):
+        with self.lock:
+            connection = self.connection
+            self.state = ClientConnection.CLOSED
+        if connection is not None:
+            connection.close()
+        else:
+            self.closed()
+
+    def closed(self):
+        """
+        The connection failed or was lost: drop it from the pool and tell its channels.
+        """
+        with self.lock:
+            self.state = ClientConnection.CLOSED
+            channels = list(self.channels.values())
+            self.channels.clear()
+            self.server_ids.clear()
+        self.requests.abort_all(_DISCONNECTED)
+        self._ungate()
+        self.pool.discard(self)
+        for channel in channels:
+            channel.connection_lost(self)
+
+
+class ConnectionPool(object):
+    """
+    Client connections by server GUID and address.
+
+    :param max_connecting: connections being opened at the same time, further ones wait their turn
+    :param linger: seconds an unused connection is kept open
+    :param timeout: seconds to connect and validate
+    """
+    def __init__(self, max_connecting=8, linger=30., timeout=5.):
+        self.linger = linger
+        self.timeout = timeout
+        self.connecting = threading.Semaphore(max_connecting)
+        # (guid, host, port) -> ClientConnection
+        self.connections = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, address, guid=None):
+        """
+        :return: :class:`ClientConnection` to the server *guid* at (*host*, *port*), opened if needed.
+                 It is held until :meth:`release`.
+        """
+        key = (guid,) + tuple(address)
+        with self.lock:
+            client = self.connections.get(key)
+            if client is None:
+                client = self.connections[key] = ClientConnection(self, key)
+                client.open()
+            client.references += 1
+            if client.linger_timer is not None:
+                client.linger_timer.cancel()
+                client.linger_timer = None
+        return client
+
+    def release(self, client):
+        with self.lock:
+            client.references -= 1
+            if client.references == 0 and self.connections.get(client.key) is client:
+                client.linger_timer = scheduler.schedule(self.linger, self._expire, client)
+
+    def _expire(self, client):
+        with self.lock:
+            if client.references > 0 or self.connections.get(client.key) is not client:
+                return
+            del self.connections[client.key]
+        client.close()
+
+    def discard(self, client):
+        with self.lock:
+            if self.connections.get(client.key) is client:
+                del self.connections[client.key]
+            if client.linger_timer is not None:
+                client.linger_timer.cancel()
+                client.linger_timer = None
+
+    def close(self):
+        with self.lock:
+            clients = list(self.connections.values())
+        for client in clients:
+            client.close()
+
+
+class _GetRequest(object):
+    """
+    A single get: INIT, then get and destroy together.
+    """
+    def __init__(self, channel, pvRequest, timeout=None, lazy=False):
+        self.client = channel.client
+        self.serverChannelID = channel.serverChannelID
+        self.lazy = lazy
+        self.type_ = None
+        self.values = None
+        self.status = None
+        self.done = threading.Event()
+        self.requestID = self.client.add_request(self, timeout)
+        request = ChannelRequestInit(ApplicationMessageCode.ChannelGet, self.serverChannelID, self.requestID,
+                                     pvRequest)
+        self.client.send(request.to_buffer())
+
+    def response_received(self, command, buffer):
+        subcommand = struct.unpack_from('B', buffer.source, buffer.index + 4)[0]
+        if subcommand & Subcommand.Init:
+            response = ChannelResponseInit.from_buffer(buffer, command)
+            if not response.status.is_ok():
+                self.finish(response.status)
+                return
+            self.type_ = response.types[0]
+            request = ChannelRequest(command, self.serverChannelID, self.requestID,
+                                     Subcommand.Get | Subcommand.Destroy)
+            self.client.send(request.to_buffer())
+        else:
+            response = ChannelResponse.from_buffer(buffer, command)
+            if response.status.is_ok():
+                changed = BitSet.from_buffer(buffer)
+                if not self.lazy:
+                    self.values = self.type_.decode(buffer, bitset=changed)
+                elif changed.get(0):
+                    # only the bytes of the value are copied out of the receive buffer
+                    self.values = LazyStructure(self.type_, buffer.source, buffer.index).copy()
+                else:
+                    self.values = LazyStructure.from_values(self.type_, self.type_.decode(buffer, bitset=changed))
+            self.finish(response.status)
+
+    def finish(self, status):
+        self.status = status
+        self.client.remove_request(self.requestID)
+        self.done.set()
+
+    abort = finish
+
+
+class _FieldRequest(object):
+    """
+    A ChannelGetField request for the introspection of a channel.
+    """
+    def __init__(self, channel, subFieldName, timeout=None):
+        self.client = channel.client
+        self.serverChannelID = channel.serverChannelID
+        self.type_ = None
+        self.status = None
+        self.done = threading.Event()
+        self.requestID = self.client.add_request(self, timeout)
+        self.client.send(ChannelGetFieldRequest(self.serverChannelID, self.requestID, subFieldName).to_buffer())
+
+    def response_received(self, command, buffer):
+        response = ChannelGetFieldResponse.from_buffer(buffer)
+        self.type_ = response.subFieldIF
+        self.finish(response.status)
+
+    def finish(self, status):
+        self.status = status
+        self.client.remove_request(self.requestID)
+        self.done.set()
+
+    abort = finish
+
+
+class _Operation(object):
+    """
+    An operation of a :class:`_Request`, waiting for its response.
+    """
+    __slots__ = ('target', 'position', 'value', 'status', 'done')
+
+    def __init__(self, target=None, position=0):
+        self.target = target
+        self.position = position
+        self.value = None
+        self.status = None
+        self.done = threading.Event()
+
+
+class _Request(object):
+    """
+    A channel request of type *command*, initialized with *pvRequest*.
+
+    The server answers the operations of a request in order, so they are sent without waiting for each other
+    and matched to the responses by a queue. Subclasses decode response bodies in :meth:`decode`.
+
+    :raises socket.timeout: if the INIT is not answered in *timeout*
+    :raises ValueError: if the server refuses the request or the connection is lost
+    """
+    command = None
+
+    def __init__(self, channel, pvRequest, timeout=5.):
+        self.client = channel.client
+        self.serverChannelID = channel.serverChannelID
+        self.timeout = timeout
+        self.types = None
+        self.status = None
+        # status of the last failed operation nobody waited for
+        self.error = None
+        self.ready = threading.Event()
+        # operations sent and not answered yet, oldest first, None for those not waited for
+        self.operations = collections.deque()
+        self.lock = threading.Lock()
+        self.requestID = self.client.add_request(self, timeout)
+        if self.client.state == ClientConnection.CLOSED:
+            # lost before the request was added, so not aborted with the others
+            self.abort(_DISCONNECTED)
+        request = ChannelRequestInit(self.command, self.serverChannelID, self.requestID, pvRequest)
+        self.client.send(request.to_buffer())
+        if not self.ready.wait(timeout):
+            self.client.requests.cancel(self.requestID, _TIMED_OUT)
+            self.abort(_TIMED_OUT)
+        if not self.status.is_ok():
+            self.client.remove_request(self.requestID)
+            _raise(self.status, ApplicationMessageCode(self.command).name)
+        self.client.requests.settle(self.requestID)
+
+    def response_received(self, command, buffer):
+        subcommand = struct.unpack_from('B', buffer.source, buffer.index + 4)[0]
+        if subcommand & Subcommand.Init:
+            response = ChannelResponseInit.from_buffer(buffer, command)
+            self.types = response.types
+            self.status = response.status
+            self.ready.set()
+            return
+        response = ChannelResponse.from_buffer(buffer, command)
+        with self.lock:
+            if not self.operations:
+                return
+            operation = self.operations.popleft()
+        if operation is None:
+            if not response.status.is_ok():
+                self.error = response.status
+            return
+        if response.status.is_ok():
+            operation.value = self.decode(subcommand, buffer, operation)
+        operation.status = response.status
+        operation.done.set()
+
+    def decode(self, subcommand, buffer, operation):
+        return None
+
+    def abort(self, status):
+        if not self.ready.is_set():
+            self.status = status
+            self.ready.set()
+        with self.lock:
+            operations = list(self.operations)
+            self.operations.clear()
+        for operation in operations:
+            if operation is not None:
+                operation.status = status
+                operation.done.set()
+
+    def _send(self, data, operation):
+        # queued in the order sent, written after releasing the lock
+        with self.lock:
+            self.operations.append(operation)
+            self.client.queue(data)
+        self.client.flush()
+        return operation
+
+    def _submit(self, subcommand, body=b'', operation=None):
+        request = ChannelRequest(self.command, self.serverChannelID, self.requestID, subcommand, bytes(body))
+        return self._send(request.to_buffer(), operation or _Operation())
+
+    def _wait(self, operation):
+        if not operation.done.wait(self.timeout):
+            raise socket.timeout('%s request timed out' % ApplicationMessageCode(self.command).name)
+        if not operation.status.is_ok():
+            _raise(operation.status, ApplicationMessageCode(self.command).name)
+        return operation.value
+
+    def close(self):
+        self.client.requests.destroy(self.requestID)
+
+
+class ChannelArray(_Request):
+    """
+    Sliced access to an array field of a channel, without transferring the whole array.
+    :meth:`read_into` keeps *window* chunks in flight and copies each one straight into the caller's buffer.
+    """
+    command = ApplicationMessageCode.ChannelArray
+
+    def __init__(self, channel, field='value', timeout=5.):
+        _Request.__init__(self, channel, PVRequest.create([field]), timeout)
+        self.type_ = self.types[0]
+
+    def decode(self, subcommand, buffer, operation):
+        if subcommand & Subcommand.Get:
+            if operation.target is not None:
+                return self._copy(buffer, operation)
+            return self.type_.get_value(buffer)
+        elif subcommand & Subcommand.GetLength:
+            return buffer._get_size()
+
+    def _copy(self, buffer, operation):
+        count = max(buffer._get_size(), 0)
+        size = self.type_.element_size()
+        start = operation.position * size
+        operation.target[start:start + count * size] = buffer.source[buffer.index:buffer.index + count * size]
+        return count
+
+    def get(self, offset=0, count=0, stride=1):
+        """
+        :return: *count* elements from *offset*, every *stride*-th, up to the end if *count* is 0
+        """
+        return self._wait(self._submit(Subcommand.Get, _sizes(offset, count, stride).get_buffer()))
+
+    def put(self, value, offset=0, stride=1):
+        """
+        Write the elements of *value* from *offset* every *stride* elements, the array grows as needed.
+        """
+        body = _sizes(offset, stride)
+        self.type_.put_value(body, self.type_.convert(value))
+        self._wait(self._submit(Subcommand.Default, body.get_buffer()))
+
+    def get_length(self):
+        return self._wait(self._submit(Subcommand.GetLength))
+
+    def set_length(self, length):
+        """
+        Truncate the array or pad it with zeros.
+        """
+        self._wait(self._submit(Subcommand.SetLength, _sizes(length).get_buffer()))
+
+    def read_into(self, out, offset=0, count=None, chunk=0x100000, window=4):
+        """
+        Read a numeric array in chunks of *chunk* elements into *out*, e.g. an :class:`array.array`, a NumPy
+        array or a bytearray with room for *count* elements of the array type.
+
+        :param count: elements to read from *offset*, by default as many as fit into *out* and the array
+        :return: number of elements read, fewer than *count* if the array is shorter
+        """
+        size = self.type_.element_size()
+        if size is None:
+            raise TypeError('not a numeric array')
+        view = memoryview(out).cast('B')
+        capacity = len(view) // size
+        if count is None:
+            count = min(self.get_length() - offset, capacity)
+        elif count > capacity:
+            raise ValueError('buffer holds %d elements, %d requested' % (capacity, count))
+        pending = collections.deque()
+        position = read = 0
+        while position < count or pending:
+            while position < count and len(pending) < window:
+                n = min(chunk, count - position)
+                body = _sizes(offset + position, n, 1).get_buffer()
+                pending.append(self._submit(Subcommand.Get, body, _Operation(view, position)))
+                position += n
+            read += self._wait(pending.popleft())
+        return read
+
+
+def _leaves(value, prefix=''):
+    """
+    (*path*, *value*) of the non-structure fields in nested dicts.
+    """
+    result = []
+    for name, field in value.items():
+        if isinstance(field, dict):
+            result.extend(_leaves(field, prefix + name + '.'))
+        else:
+            result.append((prefix + name, field))
+    return result
+
+
+class PutPlan(object):
+    """
+    Encoding of puts to the fields at *paths* of *type_*, compiled once and reused for every put.
+
+    The BitSet selecting the fields is serialized once. If all fields are numeric scalars their values are
+    packed with a single precompiled struct, and the message header is built once per command too.
+
+    :raises KeyError: if a field does not exist
+    :raises ValueError: if a field is a structure
+    """
+    def __init__(self, type_, paths):
+        fields = sorted((type_.field_offset(path), index) for index, path in enumerate(paths))
+        self.offsets = [offset for offset, index in fields]
+        # put order of the values given in *paths* order
+        self.order = [index for offset, index in fields]
+        if self.order == list(range(len(self.order))):
+            self.order = None
+        self.fields = [type_.field_at(offset) for offset in self.offsets]
+        if any(field.is_structure() for field in self.fields):
+            raise ValueError('a put plan takes leaf fields only')
+        self.bitset = BitSet.from_offsets(self.offsets)
+        self.prefix = bytes(self.bitset.to_buffer())
+        codes = [field.struct_format() for field in self.fields]
+        self.struct = struct.Struct('=' + ''.join(codes)) if None not in codes else None
+        # message command -> header, the same for every request put with the plan
+        self.headers = {}
+
+    def encode(self, values):
+        """
+        :param values: values of the fields, in the order of *paths*
+        :return: BitSet and values as sent in a put
+        """
+        if self.order is not None:
+            values = [values[index] for index in self.order]
+        if self.struct is not None:
+            return self.prefix + self.struct.pack(*values)
+        buffer = BufferWriter()
+        buffer.put_raw(self.prefix)
+        for field, value in zip(self.fields, values):
+            field.put_value(buffer, field.convert(value))
+        return buffer.get_buffer()
+
+    def message(self, command, serverChannelID, requestID, values):
+        """
+        Complete put message.
+        """
+        if self.struct is None:
+            return ChannelRequest(command, serverChannelID, requestID, Subcommand.Default,
+                                  bytes(self.encode(values))).to_buffer()
+        header = self.headers.get(command)
+        if header is None:
+            header = MessageHeader(messageCommand=command, payloadSize=9 + len(self.prefix) + self.struct.size)
+            header = self.headers[command] = bytes(header.to_buffer())
+        if self.order is not None:
+            values = [values[index] for index in self.order]
+        return header + _REQUEST.pack(serverChannelID, requestID, Subcommand.Default) + self.prefix + \
+            self.struct.pack(*values)
+
+
+class ChannelPut(_Request):
+    """
+    Puts to a channel, put-gets if *get* is set.
+
+    A put sends only the fields given, selected by a BitSet, with a :class:`PutPlan` cached per set of fields.
+    :meth:`put_values` with *wait* False pipelines puts without waiting for the responses, and :meth:`stream`
+    keeps only the latest value while the connection is congested, for setpoints written at high rates.
+    """
+    def __init__(self, channel, timeout=5., get=False):
+        self.command = ApplicationMessageCode.ChannelPutGet if get else ApplicationMessageCode.ChannelPut
+        self.plans = {}
+        # latest (plan, values) held back by :meth:`stream`
+        self.held = None
+        self.waiting = False
+        _Request.__init__(self, channel, PVRequest.create(), timeout)
+        self.type_ = self.types[0]
+        self.get_type = self.types[-1]
+
+    def plan(self, *paths):
+        """
+        :return: :class:`PutPlan` for the fields at *paths*
+        """
+        plan = self.plans.get(paths)
+        if plan is None:
+            plan = self.plans[paths] = PutPlan(self.type_, paths)
+        return plan
+
+    def decode(self, subcommand, buffer, operation):
+        if subcommand & Subcommand.GetPut:
+            type_ = self.type_
+        elif subcommand & Subcommand.Get or self.command == ApplicationMessageCode.ChannelPutGet:
+            type_ = self.get_type
+        else:
+            return None
+        changed = BitSet.from_buffer(buffer)
+        return type_.to_dict(type_.decode(buffer, bitset=changed))
+
+    def put(self, value):
+        """
+        Put the fields in *value*, nested dicts keyed by field name.
+
+        :return: for a put-get the value read back, as nested dicts
+        """
+        leaves = _leaves(value)
+        plan = self.plan(*[path for path, field in leaves])
+        return self.put_values(plan, [field for path, field in leaves])
+
+    def put_values(self, plan, values, wait=True):
+        """
+        Put *values* with *plan*, see :meth:`plan`.
+
+        :param wait: wait for the response, otherwise errors show up in :data:`error`
+        """
+        data = plan.message(self.command, self.serverChannelID, self.requestID, values)
+        if not wait:
+            self._send(data, None)
+            return None
+        return self._wait(self._send(data, _Operation()))
+
+    def stream(self, plan, values):
+        """
+        Put *values* without waiting. While the connection is congested only the latest values are kept
+        and sent once it drains.
+
+        :raises ValueError: if the connection is lost
+        """
+        connection = self.client.connection
+        if connection is None or self.client.state == ClientConnection.CLOSED:
+            _raise(_DISCONNECTED, 'put')
+        with self.lock:
+            if self.held is None and connection.writable():
+                self.operations.append(None)
+                self.client.queue(plan.message(self.command, self.serverChannelID, self.requestID, values))
+                sent = True
+            else:
+                self.held = (plan, values)
+                sent = False
+                if not self.waiting:
+                    self.waiting = True
+                    connection.add_writable_callback(self._writable)
+        if sent:
+            # flushing may call _writable, which takes the lock
+            self.client.flush()
+
+    def _writable(self, connection):
+        with self.lock:
+            held = self.held
+            self.held = None
+            if self.waiting:
+                self.waiting = False
+                connection.remove_writable_callback(self._writable)
+        if held is not None:
+            self.stream(*held)
+
+    def get(self):
+        """
+        :return: current value as nested dicts
+        """
+        return self._wait(self._submit(Subcommand.Get))
+
+    def get_put(self):
+        """
+        :return: for a put-get the current value of the put structure
+        """
+        return self._wait(self._submit(Subcommand.GetPut))
+
+
+def _argument(value):
+    """
+    (:class:`DataObject`, values) of an RPC argument given as a flat dict of numbers and strings.
+    """
+    fields = []
+    values = {}
+    for name, field in sorted(value.items()):
+        if isinstance(field, bool):
+            type_code = DataFlag.Boolean
+        elif isinstance(field, int):
+            type_code = DataFlag.Long
+        elif isinstance(field, float):
+            type_code = DataFlag.Double
+        else:
+            type_code = DataFlag.String
+            if not isinstance(field, bytes):
+                field = field.encode()
+        fields.append((name.encode(), DataObject.scalar(type_code)))
+        values[name] = field
+    type_ = DataObject.structure(b'', fields)
+    return type_, type_.from_dict(values)
+
+
+class RPCCall(object):
+    """
+    One RPC call with a request ID of its own, so any number of calls can be in flight on a channel.
+    INIT and the call go out together, the call with the destroy bit so that the server frees the request
+    once it has answered.
+    """
+    def __init__(self, channel, type_, values, callback=None, timeout=None):
+        self.client = channel.client
+        self.serverChannelID = serverChannelID = channel.serverChannelID
+        self.callback = callback
+        self.type_ = None
+        self.values = None
+        self.status = None
+        self.done = threading.Event()
+        self.requestID = self.client.add_request(self, timeout)
+        body = BufferWriter()
+        body.put_raw(type_.to_buffer())
+        type_.encode(body, values)
+        init = ChannelRequestInit(ApplicationMessageCode.ChannelRPC, serverChannelID, self.requestID,
+                                  PVRequest.create())
+        request = ChannelRequest(ApplicationMessageCode.ChannelRPC, serverChannelID, self.requestID,
+                                 Subcommand.Destroy, bytes(body.get_buffer()))
+        self.client.send(init.to_buffer() + request.to_buffer())
+
+    def response_received(self, command, buffer):
+        subcommand = struct.unpack_from('B', buffer.source, buffer.index + 4)[0]
+        if subcommand & Subcommand.Init:
+            response = ChannelResponseInit.from_buffer(buffer, command)
+            if not response.status.is_ok():
+                self.finish(response.status)
+            return
+        response = ChannelResponse.from_buffer(buffer, command)
+        if response.status.is_ok():
+            self.type_ = DataObject.from_buffer(buffer)
+            if self.type_ is not None:
+                self.values = self.type_.decode(buffer)
+        self.finish(response.status)
+
+    def finish(self, status):
+        self.status = status
+        self.client.remove_request(self.requestID)
+        self.done.set()
+        if self.callback is not None:
+            self.callback(self)
+
+    abort = finish
+
+    def cancel(self):
+        """
+        Give up the call, the server drops the response.
+        """
+        self.client.requests.cancel(self.requestID)
+
+    def wait(self):
+        """
+        :return: the response as nested dicts
+        :raises socket.timeout: if the call timed out
+        :raises ValueError: if the service reports an error, or the call was cancelled or lost
+        """
+        self.done.wait()
+        if not self.status.is_ok():
+            _raise(self.status, 'RPC')
+        if self.type_ is None:
+            return None
+        return self.type_.to_dict(self.values)
+
+
+class IntrospectionCache(object):
+    """
+    Introspection results of the channels of a :class:`Context`, by (connection key, channel name, sub field).
+    The connection key starts with the server GUID, so the entries of a restarted server are not reused, and
+    :meth:`invalidate` drops them when beacons report the restart.
+
+    Descriptors are interned: equal structures of any channel and connection are a single :class:`DataObject`.
+    """
+    def __init__(self):
+        # ((guid, host, port), name, subFieldName) -> DataObject
+        self.entries = {}
+        # encoded descriptor -> DataObject
+        self.interned = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, name, subFieldName):
+        return self.entries.get((key, name, subFieldName))
+
+    def put(self, key, name, subFieldName, type_):
+        """
+        Keep *type_*, unless the GUID in *key* is unknown and a restart of the server would go unnoticed.
+
+        :return: the interned *type_*
+        """
+        type_ = self.intern(type_)
+        if key[0] is not None:
+            with self.lock:
+                self.entries[(key, name, subFieldName)] = type_
+        return type_
+
+    def intern(self, type_):
+        if type_ is None:
+            return None
+        encoded = bytes(type_.to_buffer())
+        with self.lock:
+            return self.interned.setdefault(encoded, type_)
+
+    def invalidate(self, address):
+        """
+        Forget the entries of the server at (*host*, *port*).
+        """
+        address = tuple(address)
+        with self.lock:
+            for entry in [entry for entry in self.entries if entry[0][1:] == address]:
+                del self.entries[entry]
+            # descriptors only the dropped entries used
+            used = set(id(type_) for type_ in self.entries.values())
+            for encoded, type_ in list(self.interned.items()):
+                if id(type_) not in used:
+                    del self.interned[encoded]
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class Channel(object):
+    """
+    A channel of a :class:`Context`. It is connected through the pooled connection to its server and
+    searched again when that connection is lost.
+    """
+    def __init__(self, context, name):
+        self.context = context
+        self.name = name
+        self.client = None
+        self.address = None
+        self.clientChannelID = None
+        self.serverChannelID = None
+        self.status = None
+        self.ready = threading.Event()
+        self.closing = False
+        self.lock = threading.Lock()
+
+    def connect(self):
+        self.context.searcher.search(self.name, self._found)
+
+    def _found(self, name, address):
+        context = self.context
+        with self.lock:
+            if self.closing:
+                return
+            previous = self._drop()
+            client = context.pool.acquire(address, context.searcher.guids.get(address))
+            self.client = client
+            self.address = address
+        if previous is not None:
+            context.pool.release(previous)
+        context.beacons.connected(name, address, self._found)
+        client.attach(self)
+
+    def _drop(self):
+        """
+        Forget the current connection, to be released by the caller.
+        """
+        client = self.client
+        if client is not None:
+            client.detach(self)
+            self.context.beacons.disconnected(self.name, self.address)
+        self.client = None
+        self.serverChannelID = None
+        self.ready.clear()
+        return client
+
+    def created(self, client, response):
+        if client is not self.client:
+            return
+        self.status = response.status
+        if response.status.is_ok():
+            self.serverChannelID = response.serverChannelID
+        self.ready.set()
+
+    def connection_lost(self, client):
+        with self.lock:
+            if client is not self.client or self.closing:
+                return
+            self._drop()
+        self.context.pool.release(client)
+        self.connect()
+
+    def wait_connected(self, timeout=None):
+        """
+        :return: True once the channel is created on its server
+        """
+        self.ready.wait(timeout)
+        return self.serverChannelID is not None
+
+    def get(self, timeout=5., fields=(), lazy=False):
+        """
+        :param lazy: return a :class:`LazyStructure` decoding only the fields read from it
+        :return: value as nested dicts, see :meth:`e4py.data.DataObject.to_dict`
+        :raises socket.timeout: if the channel is not connected or the server does not answer in *timeout*
+        :raises ValueError: if the server reports an error
+        """
+        if not self.wait_connected(timeout):
+            raise socket.timeout('%s not connected' % self.name.decode())
+        request = _GetRequest(self, PVRequest.create(fields), timeout, lazy)
+        request.done.wait()
+        if not request.status.is_ok():
+            _raise(request.status, 'get of %s' % self.name.decode())
+        if lazy:
+            return request.values
+        return request.type_.to_dict(request.values)
+
+    def introspect(self, subFieldName=b'', timeout=5.):
+        """
+        :return: :class:`DataObject` describing the channel, or its field *subFieldName*, from the
+                 :class:`IntrospectionCache` once known
+        :raises socket.timeout: if the channel is not connected or the server does not answer in *timeout*
+        :raises ValueError: if the server reports an error
+        """
+        if not self.wait_connected(timeout):
+            raise socket.timeout('%s not connected' % self.name.decode())
+        client = self.client
+        cache = self.context.introspection
+        type_ = cache.get(client.key, self.name, subFieldName)
+        if type_ is not None:
+            return type_
+        request = _FieldRequest(self, subFieldName, timeout)
+        request.done.wait()
+        if not request.status.is_ok():
+            _raise(request.status, 'introspection of %s' % self.name.decode())
+        return cache.put(client.key, self.name, subFieldName, request.type_)
+
+    def array(self, field='value', timeout=5.):
+        """
+        :return: :class:`ChannelArray` on the array *field*
+        """
+        if not self.wait_connected(timeout):
+            raise socket.timeout('%s not connected' % self.name.decode())
+        return ChannelArray(self, field, timeout)
+
+    def put_request(self, timeout=5., get=False):
+        """
+        :return: :class:`ChannelPut`, for put-get if *get* is set
+        """
+        if not self.wait_connected(timeout):
+            raise socket.timeout('%s not connected' % self.name.decode())
+        return ChannelPut(self, timeout, get)
+
+    def put(self, value, timeout=5.):
+        """
+        Put the fields in *value*, nested dicts keyed by field name, e.g. {'value': 1.0}.
+        """
+        request = self.put_request(timeout)
+        try:
+            request.put(value)
+        finally:
+            request.close()
+
+    def rpc_async(self, argument, callback=None, timeout=5.):
+        """
+        Start an RPC call and return without waiting for it.
+
+        :param argument: flat dict of numbers and strings, or (:class:`DataObject`, values)
+        :param callback: *callback(call)* once answered, failed or timed out
+        :param timeout: seconds to connect, then for the call to be answered
+        :return: :class:`RPCCall`
+        """
+        if not self.wait_connected(timeout):
+            raise socket.timeout('%s not connected' % self.name.decode())
+        type_, values = _argument(argument) if isinstance(argument, dict) else argument
+        return RPCCall(self, type_, values, callback, timeout)
+
+    def rpc(self, argument, timeout=5.):
+        """
+        :return: the response as nested dicts, see :meth:`rpc_async`
+        """
+        return self.rpc_async(argument, timeout=timeout).wait()
+
+    def close(self):
+        with self.lock:
+            self.closing = True
+            client = self._drop()
+        if client is not None:
+            self.context.pool.release(client)
+
+
+class Context(object):
+    """
+    Client context: search, beacons and the connection pool.
+
+    :param addresses: search destinations, by default from EPICS_PVA_ADDR_LIST, see :func:`address_list`
+    :param name_servers: name server addresses, by default from EPICS_PVA_NAME_SERVERS
+    """
+    def __init__(self, addresses=None, name_servers=None, max_connecting=8, linger=30., timeout=5.,
+                 beacon_port=constants.PVA_BROADCAST_PORT):
+        self.searcher = SearchScheduler(address_list(addresses))
+        self.name_servers = [NameServerClient(address, self.searcher) for address in name_server_list(name_servers)]
+        self.beacons = BeaconTable(self.searcher)
+        self.listener = None
+        if beacon_port is not None:
+            self.listener = BeaconListener(self.beacons, beacon_port)
+            self.listener.start()
+        self.pool = ConnectionPool(max_connecting, linger, timeout)
+        self.introspection = IntrospectionCache()
+        self.beacons.add_anomaly_callback(self.introspection.invalidate)
+
+    def channel(self, name):
+        """
+        :return: :class:`Channel` *name*, connecting in the background
+        """
+        channel = Channel(self, name)
+        channel.connect()
+        return channel
+
+    def close(self):
+        """
+        Close the connections, stop searching and listening to beacons, and end the threads doing so.
+        """
+        if self.listener is not None:
+            self.listener.close()
+        for name_server in self.name_servers:
+            name_server.close()
+        self.searcher.close()
+        self.pool.close()
+
+
+def run_client():
+    context = Context()
+    channel = context.channel(b'testMP')
+    print(channel.get(timeout=30.))
+
 
 if __name__ == '__main__':
-    run_client()
\ No newline at end of file
+    run_client()
@@ -2,4 +2,29 @@ PVA_MAGIC = 0xCA
 PVA_VERSION = 0x01
 PVA_SERVER_PORT = 5075
 PVA_BROADCAST_PORT = 5076
-PVA_MESSAGE_HEADER_SIZE = 8
\ No newline at end of file
+PVA_MESSAGE_HEADER_SIZE = 8
+
+# receive buffer advertised in connection validation and used as initial socket receive buffer
+PVA_RECEIVE_BUFFER_SIZE = 0x4400
+# upper bound for the adaptive growth of receive buffers
+PVA_MAX_RECEIVE_BUFFER_SIZE = 0x400000
+# queued outbound bytes at which a connection stops being writable
+PVA_MAX_SEND_QUEUE_SIZE = 0x400000
+# idle time after which a connection is probed with an echo request
+PVA_ECHO_PERIOD = 15.0
+# minimum time to wait for the echo response before the peer is declared dead
+PVA_ECHO_TIMEOUT = 5.0
+# largest UDP payload sent, fits an Ethernet frame
+PVA_MAX_UDP_PAYLOAD = 1440
+# socket receive buffer of search sockets, absorbs search storms
+PVA_SEARCH_RECEIVE_BUFFER_SIZE = 0x100000
+# beacon period right after startup or a change of the served channels
+PVA_BEACON_MIN_PERIOD = 1.0
+# beacon period of a stable server
+PVA_BEACON_MAX_PERIOD = 15.0
+# threads running RPC handlers of a server
+PVA_RPC_WORKERS = 8
+# channels one client connection may create on a server
+PVA_MAX_CHANNELS = 0x10000
+# requests one client connection may have open on a server
+PVA_MAX_REQUESTS = 0x10000
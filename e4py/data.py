@@ -1,4 +1,5 @@
 from __future__ import print_function
+import array
 import enum
 import pprint
 
@@ -158,10 +159,22 @@ class DataType(object):
     |   +-------+----------------+
     |   | 000   | structure      |
     +---+-------+----------------+
+
+    Instances are immutable and shared: there is one per type code and array flag, made when the module is
+    loaded together with the table from field description bytes, and ``DataType(type_code, array_flag)``
+    looks it up. Numeric types carry their :mod:`struct` format, :class:`array.array` typecode and element
+    size, the others None.
     """
+    __slots__ = ('type_code', 'array_flag', 'field_desc', 'struct_code', 'typecode', 'element_size')
 
-    def __init__(self, *args):
-        self.type_code, self.array_flag = args
+    def __new__(cls, type_code, array_flag):
+        return _types[type_code << 2 | array_flag]
+
+    def __setattr__(self, name, value):
+        raise AttributeError('DataType is immutable')
+
+    def __reduce__(self):
+        return DataType, (self.type_code, self.array_flag)
 
     def __str__(self):
         if self.array_flag == ArrayFlag.Scalar:
@@ -174,67 +187,127 @@ class DataType(object):
             return  '%s<>' % self.type_code
 
     def to_field_desc(self):
-        array_bits = self.array_flag << 3
-        subtype_bits = 0
-        if self.type_code == DataFlag.Boolean:
-            major_bits = 0b000
-
-        elif self.type_code <= DataFlag.ULong and self.type_code >= DataFlag.Byte:
-            major_bits = 0b001
-            if (self.type_code - DataFlag.Byte) % 2 == 0:
-                subtype_bits = (self.type_code - DataFlag.Byte) / 2
-            elif (self.type_code - DataFlag.UByte) % 2 == 0:
-                subtype_bits = (self.type_code - DataFlag.UByte) / 2
-                subtype_bits |= 0b100
-
-        elif self.type_code == DataFlag.Float:
-            major_bits = 0b010
-            subtype_bits = 0b010
-
-        elif self.type_code == DataFlag.Double:
-            major_bits = 0b010
-            subtype_bits = 0b011
-
-        elif self.type_code == DataFlag.String:
-            major_bits = 0b011
+        return self.field_desc
+
+    @staticmethod
+    def from_field_desc(field_desc):
+        """
+        :raises ValueError: if *field_desc* is reserved
+        """
+        data_type = _field_descs[field_desc]
+        if data_type is None:
+            raise ValueError('reserved field description 0x%02x' % field_desc)
+        return data_type
+
+
+def _field_desc(type_code, array_flag):
+    """
+    Field description byte of a type, see :class:`DataType`.
+    """
+    array_bits = array_flag << 3
+    subtype_bits = 0
+    if type_code == DataFlag.Boolean:
+        major_bits = 0b000
+
+    elif type_code <= DataFlag.ULong and type_code >= DataFlag.Byte:
+        major_bits = 0b001
+        if (type_code - DataFlag.Byte) % 2 == 0:
+            subtype_bits = (type_code - DataFlag.Byte) // 2
+        elif (type_code - DataFlag.UByte) % 2 == 0:
+            subtype_bits = (type_code - DataFlag.UByte) // 2
+            subtype_bits |= 0b100
+
+    elif type_code == DataFlag.Float:
+        major_bits = 0b010
+        subtype_bits = 0b010
+
+    elif type_code == DataFlag.Double:
+        major_bits = 0b010
+        subtype_bits = 0b011
+
+    elif type_code == DataFlag.String:
+        major_bits = 0b011
+
+    else:
+        major_bits = 0b100
+        subtype_bits = type_code - DataFlag.Structure
+
+    return major_bits << 5 | array_bits | subtype_bits
+
+
+def _type_code(field_desc):
+    """
+    Type code of a field description byte, None if reserved.
+    """
+    # bit 6-7 is type selection
+    major_code = (field_desc & 0xE0) >> 5
+    # bit 0-2 is dependant on major type
+    sub_code = field_desc & 0x07
+
+    if major_code == 0b000:
+        return DataFlag.Boolean
 
+    elif major_code == 0b001: # integer
+        if sub_code & 0b100: # unsigned
+            return DataFlag(DataFlag.UByte + (sub_code & 0b011) * 2)
         else:
-            major_bits = 0b100
-            subtype_bits = self.type_code - DataFlag.Structure
+            return DataFlag(DataFlag.Byte + (sub_code & 0b011) * 2)
 
-        return major_bits << 5 | array_bits | subtype_bits
+    elif major_code == 0b010: # floating-point
+        if sub_code == 0b010:
+            return DataFlag.Float
+        elif sub_code == 0b011:
+            return DataFlag.Double
 
-    @staticmethod
-    def from_field_desc(field_desc):
-        # bit 3-4 is array flag
-        array_flag = ArrayFlag((field_desc & 0x18) >> 3)
-        # bit 6-7 is type selection
-        major_code = (field_desc & 0xE0) >> 5
-        # bit 0-2 is dependant on major type
-        sub_code = field_desc & 0x07
-
-        if major_code == 0b000:
-            type_code = DataFlag.Boolean
-
-        elif major_code == 0b001: # integer
-            if sub_code & 0b100: # unsigned
-                type_code = DataFlag(DataFlag.UByte + (sub_code & 0b011) * 2)
-            else:
-                type_code = DataFlag(DataFlag.Byte + (sub_code & 0b011) * 2)
+    elif major_code == 0b011:
+        return DataFlag.String
+
+    elif major_code == 0b100 and sub_code <= DataFlag.BoundedString - DataFlag.Structure:
+        return DataFlag(DataFlag.Structure + sub_code)
+
+    return None
+
+
+# struct format, array.array typecode and size of numeric types
+_numeric = {
+    DataFlag.Boolean: ('?', 'B', 1),
+    DataFlag.Byte: ('b', 'b', 1),
+    DataFlag.UByte: ('B', 'B', 1),
+    DataFlag.Short: ('h', 'h', 2),
+    DataFlag.UShort: ('H', 'H', 2),
+    DataFlag.Int: ('i', 'i', 4),
+    DataFlag.UInt: ('I', 'I', 4),
+    DataFlag.Long: ('q', 'q', 8),
+    DataFlag.ULong: ('Q', 'Q', 8),
+    DataFlag.Float: ('f', 'f', 4),
+    DataFlag.Double: ('d', 'd', 8),
+}
+
+
+def _make_type(type_code, array_flag):
+    data_type = object.__new__(DataType)
+    attributes = (type_code, array_flag, _field_desc(type_code, array_flag)) + \
+        _numeric.get(type_code, (None, None, None))
+    for name, value in zip(DataType.__slots__, attributes):
+        object.__setattr__(data_type, name, value)
+    return data_type
 
-        elif major_code == 0b010: # floating-point
-            if sub_code == 0b010:
-                type_code = DataFlag.Float
-            elif sub_code == 0b011:
-                type_code = DataFlag.Double
 
-        elif major_code == 0b011:
-            type_code = DataFlag.String
+# DataType by type_code << 2 | array_flag
+_types = [_make_type(DataFlag(i >> 2), ArrayFlag(i & 0b11)) for i in range(len(DataFlag) << 2)]
+# DataType by field description byte, None where reserved
+_field_descs = [None] * 256
+for _desc in range(256):
+    _code = _type_code(_desc)
+    if _code is not None:
+        _field_descs[_desc] = _types[_code << 2 | (_desc & 0x18) >> 3]
+del _desc, _code
 
-        elif major_code == 0b100:
-            type_code = DataFlag(DataFlag.Structure + sub_code)
 
-        return DataType(type_code, array_flag)
+def _as_bytes(name):
+    if isinstance(name, bytes):
+        return name
+    return name.encode('ascii')
 
 
 class DataObject(object):
@@ -245,11 +318,56 @@ class DataObject(object):
     :data:`DataObject.size` designates the size of the data type. For structure, it is the number of fields.
     For fixed or bounded array, it is the number of elements. For scalar type, it is always 0.
     :data:`DataObject.fields` is a list of fields. Each field is a (*name*, :class:`DataObject`) tuple.
+    :data:`DataObject.element` is the element type of structure and union arrays.
 
+    Values of a structure are kept in a flat list indexed by field offset, the same numbering BitSets use:
+    offset 0 is the structure itself, its fields follow depth first. Structure entries are None,
+    numeric arrays are :class:`array.array`, strings are bytes, a union is None or (*index*, *value*),
+    a variant union is None or (:class:`DataObject`, *value*) and an element of a structure array is
+    the flat value list of the element.
     """
     def __init__(self, *args):
         self.type_, self.size, self.fields = args
         self.name = b''
+        self.element = None
+        self._count = None
+        self._offsets = None
+        self._fields = None
+        self._layout = None
+
+    @staticmethod
+    def scalar(type_code):
+        return DataObject(DataType(type_code, ArrayFlag.Scalar), 0, [])
+
+    @staticmethod
+    def array(type_code):
+        return DataObject(DataType(type_code, ArrayFlag.VarSizeArray), 0, [])
+
+    @staticmethod
+    def structure(name, fields):
+        """
+        :param name: structure ID, e.g. b'time_t'
+        :param fields: list of (*name*, :class:`DataObject`)
+        """
+        object_ = DataObject(DataType(DataFlag.Structure, ArrayFlag.Scalar), len(fields), fields)
+        object_.name = name
+        return object_
+
+    @staticmethod
+    def union(name, fields):
+        object_ = DataObject(DataType(DataFlag.Union, ArrayFlag.Scalar), len(fields), fields)
+        object_.name = name
+        return object_
+
+    @staticmethod
+    def variant_union():
+        return DataObject(DataType(DataFlag.VariantUnion, ArrayFlag.Scalar), 0, [])
+
+    @staticmethod
+    def structure_array(element):
+        object_ = DataObject(DataType(element.type_.type_code, ArrayFlag.VarSizeArray), 0, [])
+        object_.element = element
+        return object_
 
     @staticmethod
     def from_buffer(buffer):
@@ -261,51 +379,555 @@ class DataObject(object):
             return registry.get_type(id_)
         elif field_enc == FieldEncoding.Full_ID or field_enc == FieldEncoding.Full_Tagged_ID:
             id_ = buffer.get_short()
-            tag = b''
             if field_enc == FieldEncoding.Full_Tagged_ID:
-                tag = buffer.get_string()
-            data_type = DataType.from_field_desc(buffer.get_byte())
-            if data_type.type_code == DataFlag.Structure or data_type.type_code == DataFlag.Union:
-                if data_type.array_flag == ArrayFlag.Scalar:
-                    name_ = buffer.get_string()
-                    size = buffer._get_size()
-                    fields = []
-                    for i in range(size):
-                        name = buffer.get_string()
-                        object_ = DataObject.from_buffer(buffer)
-                        fields.append((name, object_))
-                    object_ = DataObject(data_type, size, fields)
-                    object_.name = name_
-                    registry.register_type(id_, object_)
-                    return object_
-                else:
-                    object_ = DataObject.from_buffer(buffer)
-                    return object_
-            elif data_type.type_code == DataFlag.VariantUnion:
-                object_ = DataObject(data_type, 0, [])
-                registry.register_type(id_, object_)
-                return object_
-            elif data_type.type_code == DataFlag.BoundedString:
-                name = buffer.get_string()
+                tag = buffer.get_integer()
+            object_ = DataObject.from_buffer(buffer)
+            registry.register_type(id_, object_)
+            return object_
+
+        data_type = DataType.from_field_desc(field_enc)
+        if data_type.type_code == DataFlag.Structure or data_type.type_code == DataFlag.Union:
+            if data_type.array_flag == ArrayFlag.Scalar:
+                name_ = buffer.get_string()
                 size = buffer._get_size()
-                object_ = DataObject(data_type, size, [])
-                object_.name = name
-                registry.register_type(id_, object_)
-                return object_
+                fields = []
+                for i in range(size):
+                    name = buffer.get_string()
+                    fields.append((name, DataObject.from_buffer(buffer)))
+                object_ = DataObject(data_type, size, fields)
+                object_.name = name_
+            else:
+                object_ = DataObject(data_type, 0, [])
+                object_.element = DataObject.from_buffer(buffer)
+            return object_
+        elif data_type.type_code == DataFlag.VariantUnion:
+            return DataObject(data_type, 0, [])
+        elif data_type.type_code == DataFlag.BoundedString:
+            return DataObject(data_type, buffer._get_size(), [])
         else:
-            data_type = DataType.from_field_desc(field_enc)
             size = 0
             if data_type.array_flag == ArrayFlag.FixedSizeArray or data_type.array_flag == ArrayFlag.BoundSizeArray:
                 size = buffer._get_size()
             return DataObject(data_type, size, [])
 
+    def to_buffer(self):
+        """
+        Serialize the introspection data, without type cache IDs.
+        """
+        from .messages import BufferWriter
+        buffer = BufferWriter()
+        self._put_desc(buffer)
+        return buffer.get_buffer()
+
+    def _put_desc(self, buffer):
+        buffer.put_byte(self.type_.to_field_desc())
+        type_code = self.type_.type_code
+        array_flag = self.type_.array_flag
+        if type_code == DataFlag.Structure or type_code == DataFlag.Union:
+            if array_flag == ArrayFlag.Scalar:
+                buffer.put_string(self.name)
+                buffer._put_size(len(self.fields))
+                for name, field in self.fields:
+                    buffer.put_string(name)
+                    field._put_desc(buffer)
+            else:
+                self.element._put_desc(buffer)
+        elif type_code == DataFlag.BoundedString:
+            buffer._put_size(self.size)
+        elif type_code != DataFlag.VariantUnion:
+            if array_flag == ArrayFlag.FixedSizeArray or array_flag == ArrayFlag.BoundSizeArray:
+                buffer._put_size(self.size)
+
+    def is_structure(self):
+        """
+        True for a (scalar) structure, whose fields have their own offsets.
+        """
+        return self.type_.type_code == DataFlag.Structure and self.type_.array_flag == ArrayFlag.Scalar
+
+    def field_count(self):
+        """
+        Number of offsets the field occupies, 1 for anything but a structure.
+        """
+        if self._count is None:
+            if self.is_structure():
+                self._count = 1 + sum(field.field_count() for name, field in self.fields)
+            else:
+                self._count = 1
+        return self._count
+
+    def offsets(self):
+        """
+        :return: {*path*: (*offset*, :class:`DataObject`)} for all fields, *path* as in b'timeStamp.nanoseconds'
+        """
+        if self._offsets is None:
+            offsets = {b'': (0, self)}
+            offset = 1
+            for name, field in self.fields if self.is_structure() else []:
+                for path, (sub_offset, sub_field) in field.offsets().items():
+                    offsets[name + b'.' + path if path else name] = (offset + sub_offset, sub_field)
+                offset += field.field_count()
+            self._offsets = offsets
+        return self._offsets
+
+    def field_offset(self, path):
+        """
+        Offset of the field at *path*, e.g. 'value' or 'timeStamp.secondsPastEpoch'.
+
+        :raises KeyError: if no such field exists
+        """
+        return self.offsets()[_as_bytes(path)][0]
+
+    def field(self, path):
+        return self.offsets()[_as_bytes(path)][1]
+
+    def field_at(self, offset):
+        """
+        :return: :class:`DataObject` of the field at *offset*
+        """
+        if self._fields is None:
+            fields = [None] * self.field_count()
+            for path, (field_offset, field) in self.offsets().items():
+                fields[field_offset] = field
+            self._fields = fields
+        return self._fields[offset]
+
+    def fixed_size(self):
+        """
+        Serialized size in bytes of a numeric scalar or of a structure of them, None if it varies.
+        """
+        if self.is_structure():
+            sizes = [field.fixed_size() for name, field in self.fields]
+            return None if None in sizes else sum(sizes)
+        if self.type_.array_flag != ArrayFlag.Scalar:
+            return None
+        return self.type_.element_size
+
+    def layout(self):
+        """
+        Where the serialized fields start, as one (*anchor*, *delta*) per offset and one past the end:
+        *delta* bytes after the end of the variable size field at offset *anchor*, or after the start of the
+        structure if *anchor* is -1. Fields with a fixed layout are thus found without reading any data.
+        """
+        if self._layout is None:
+            layout = [None] * (self.field_count() + 1)
+            position = [-1, 0]
+            end = self._place(layout, 0, position)
+            layout[end] = tuple(position)
+            self._layout = layout
+        return self._layout
+
+    def _place(self, layout, offset, position):
+        layout[offset] = tuple(position)
+        if self.is_structure():
+            offset += 1
+            for name, field in self.fields:
+                offset = field._place(layout, offset, position)
+            return offset
+        size = self.fixed_size()
+        if size is None:
+            position[:] = [offset, 0]
+        else:
+            position[1] += size
+        return offset + 1
+
+    def skip(self, buffer):
+        """
+        Move *buffer* past a serialized value of this type, without making Python objects of it.
+        """
+        type_code = self.type_.type_code
+        if self.is_structure():
+            size = self.fixed_size()
+            if size is not None:
+                buffer.index += size
+            else:
+                for name, field in self.fields:
+                    field.skip(buffer)
+        elif self.type_.array_flag == ArrayFlag.Scalar:
+            if self.type_.element_size is not None:
+                buffer.index += self.type_.element_size
+            elif type_code == DataFlag.String or type_code == DataFlag.BoundedString:
+                size = buffer._get_size()
+                buffer.index += max(size, 0)
+            elif type_code == DataFlag.Union:
+                index = buffer._get_size()
+                if index >= 0:
+                    self.fields[index][1].skip(buffer)
+            elif type_code == DataFlag.VariantUnion:
+                type_ = DataObject.from_buffer(buffer)
+                if type_ is not None:
+                    type_.skip(buffer)
+        elif self.type_.element_size is not None:
+            size = buffer._get_size()
+            buffer.index += max(size, 0) * self.type_.element_size
+        elif type_code == DataFlag.String:
+            for i in range(buffer._get_size()):
+                size = buffer._get_size()
+                buffer.index += max(size, 0)
+        else:
+            element = self.element or DataObject(DataType(type_code, ArrayFlag.Scalar), 0, [])
+            for i in range(buffer._get_size()):
+                if buffer.get_byte():
+                    element.skip(buffer)
+
+    def element_size(self):
+        """
+        Size in bytes of a numeric value or array element, None for other types.
+        """
+        return self.type_.element_size
+
+    def struct_format(self):
+        """
+        :mod:`struct` format of a numeric scalar, None for other types.
+        """
+        if self.type_.array_flag != ArrayFlag.Scalar:
+            return None
+        return self.type_.struct_code
+
+    def convert(self, value):
+        """
+        Convert *value* to the representation used in value lists, e.g. a list into an :class:`array.array`.
+        NumPy arrays are kept as they are.
+        """
+        if self.type_.array_flag != ArrayFlag.Scalar and self.type_.typecode is not None and \
+                not isinstance(value, array.array) and not hasattr(value, 'dtype'):
+            return array.array(self.type_.typecode, value)
+        return value
+
+    def default_value(self):
+        """
+        Initial value of the field. For a structure it is the flat value list.
+        """
+        type_code = self.type_.type_code
+        if self.is_structure():
+            values = [None] * self.field_count()
+            offset = 1
+            for name, field in self.fields:
+                if field.is_structure():
+                    values[offset:offset + field.field_count()] = field.default_value()
+                else:
+                    values[offset] = field.default_value()
+                offset += field.field_count()
+            return values
+        elif self.type_.array_flag != ArrayFlag.Scalar:
+            if self.type_.typecode is not None:
+                return array.array(self.type_.typecode)
+            return []
+        elif type_code == DataFlag.Boolean:
+            return False
+        elif type_code == DataFlag.Float or type_code == DataFlag.Double:
+            return 0.0
+        elif self.type_.struct_code is not None:
+            return 0
+        elif type_code == DataFlag.String or type_code == DataFlag.BoundedString:
+            return b''
+        return None
+
+    def encode(self, buffer, values, bitset=None):
+        """
+        Serialize the structure *values* into *buffer*, only the fields in *bitset* if given.
+        """
+        if bitset is None:
+            self._encode(buffer, values, 0)
+        else:
+            self._encode_partial(buffer, values, 0, bitset)
+
+    def decode(self, buffer, values=None, bitset=None):
+        """
+        Deserialize structure values from *buffer* into *values*, only the fields in *bitset* if given.
+
+        :return: the flat value list
+        """
+        if values is None:
+            values = self.default_value()
+        if bitset is None:
+            self._decode(buffer, values, 0)
+        else:
+            self._decode_partial(buffer, values, 0, bitset)
+        return values
+
+    def _encode(self, buffer, values, offset):
+        if not self.is_structure():
+            self.put_value(buffer, values[offset])
+            return offset + 1
+        offset += 1
+        for name, field in self.fields:
+            offset = field._encode(buffer, values, offset)
+        return offset
+
+    def _encode_partial(self, buffer, values, offset, bitset):
+        if bitset.get(offset):
+            return self._encode(buffer, values, offset)
+        if not self.is_structure():
+            return offset + 1
+        offset += 1
+        for name, field in self.fields:
+            offset = field._encode_partial(buffer, values, offset, bitset)
+        return offset
+
+    def _decode(self, buffer, values, offset):
+        if not self.is_structure():
+            values[offset] = self.get_value(buffer)
+            return offset + 1
+        offset += 1
+        for name, field in self.fields:
+            offset = field._decode(buffer, values, offset)
+        return offset
+
+    def _decode_partial(self, buffer, values, offset, bitset):
+        if bitset.get(offset):
+            return self._decode(buffer, values, offset)
+        if not self.is_structure():
+            return offset + 1
+        offset += 1
+        for name, field in self.fields:
+            offset = field._decode_partial(buffer, values, offset, bitset)
+        return offset
+
+    def put_value(self, buffer, value):
+        """
+        Serialize a single field value, for a structure the flat value list.
+        """
+        data_type = self.type_
+        type_code = data_type.type_code
+        if data_type.array_flag == ArrayFlag.Scalar:
+            if data_type.struct_code is not None:
+                buffer.put_value(data_type.struct_code, value)
+            elif type_code == DataFlag.String or type_code == DataFlag.BoundedString:
+                buffer.put_string(value)
+            elif type_code == DataFlag.Structure:
+                self._encode(buffer, value, 0)
+            elif type_code == DataFlag.Union:
+                if value is None:
+                    buffer._put_size(-1)
+                else:
+                    index, value = value
+                    buffer._put_size(index)
+                    self.fields[index][1].put_value(buffer, value)
+            elif type_code == DataFlag.VariantUnion:
+                if value is None:
+                    buffer.put_byte(FieldEncoding.No)
+                else:
+                    type_, value = value
+                    type_._put_desc(buffer)
+                    type_.put_value(buffer, value)
+        elif data_type.typecode is not None:
+            buffer.put_value_array(data_type.typecode, value)
+        elif type_code == DataFlag.String:
+            buffer.put_string_array(value)
+        else:
+            element = self.element or DataObject(DataType(type_code, ArrayFlag.Scalar), 0, [])
+            buffer._put_size(len(value))
+            for v in value:
+                if v is None:
+                    buffer.put_byte(0)
+                else:
+                    buffer.put_byte(1)
+                    element.put_value(buffer, v)
+
+    def get_value(self, buffer):
+        """
+        Deserialize a single field value, for a structure the flat value list.
+        """
+        data_type = self.type_
+        type_code = data_type.type_code
+        if data_type.array_flag == ArrayFlag.Scalar:
+            if data_type.struct_code is not None:
+                return buffer.get_value(data_type.struct_code, data_type.element_size)
+            elif type_code == DataFlag.String or type_code == DataFlag.BoundedString:
+                return buffer.get_string()
+            elif type_code == DataFlag.Structure:
+                values = [None] * self.field_count()
+                self._decode(buffer, values, 0)
+                return values
+            elif type_code == DataFlag.Union:
+                index = buffer._get_size()
+                if index < 0:
+                    return None
+                return index, self.fields[index][1].get_value(buffer)
+            elif type_code == DataFlag.VariantUnion:
+                type_ = DataObject.from_buffer(buffer)
+                if type_ is None:
+                    return None
+                return type_, type_.get_value(buffer)
+        elif data_type.typecode is not None:
+            return buffer.get_value_array(data_type.typecode, data_type.element_size)
+        elif type_code == DataFlag.String:
+            return buffer.get_string_array()
+        else:
+            element = self.element or DataObject(DataType(type_code, ArrayFlag.Scalar), 0, [])
+            value = []
+            for i in range(buffer._get_size()):
+                if buffer.get_byte():
+                    value.append(element.get_value(buffer))
+                else:
+                    value.append(None)
+            return value
+
+    def to_dict(self, values, offset=0):
+        """
+        Convert flat structure *values* into nested dicts keyed by field name.
+        """
+        result = {}
+        offset += 1
+        for name, field in self.fields:
+            if field.is_structure():
+                result[name.decode()] = field.to_dict(values, offset)
+            else:
+                result[name.decode()] = values[offset]
+            offset += field.field_count()
+        return result
+
+    def from_dict(self, value, values=None, offset=0):
+        """
+        Fill flat structure *values* from nested dicts keyed by field name. Missing fields are left untouched.
+
+        :return: the flat value list
+        """
+        if values is None:
+            values = self.default_value()
+        offset += 1
+        for name, field in self.fields:
+            key = name.decode()
+            if key in value:
+                if field.is_structure():
+                    field.from_dict(value[key], values, offset)
+                else:
+                    values[offset] = value[key]
+            offset += field.field_count()
+        return values
 
     def __str__(self):
         output = '%s %s %d' % (self.name, self.type_, self.size)
         for name, object_ in self.fields:
             output += '\n  %s: %s' % (name, object_)
+        if self.element is not None:
+            output += '\n  %s' % self.element
         return output
 
+
+class LazyStructure(object):
+    """
+    Structure value decoded on access from its serialized form, as written by :meth:`DataObject.encode`.
+
+    Fields are found through :meth:`DataObject.layout`: those after fixed size fields directly, the others
+    by skipping the variable size fields in front of them once. Decoded fields and the ends of skipped
+    fields are cached, so each byte is looked at no more than once.
+
+    :param source: bytes-like object holding the value at *start*, it has to stay unchanged, see :meth:`copy`
+    """
+    def __init__(self, type_, source, start=0):
+        self.type_ = type_
+        self.source = source
+        self.start = start
+        self.layout = type_.layout()
+        # offset -> decoded value
+        self.cache = {}
+        # offset of a variable size field -> end of its data, from start
+        self.ends = {}
+
+    @staticmethod
+    def from_values(type_, values):
+        from .messages import BufferWriter
+        buffer = BufferWriter()
+        type_.encode(buffer, values)
+        return LazyStructure(type_, bytes(buffer.get_buffer()))
+
+    def _reader(self, position):
+        from .messages import BufferReader
+        buffer = BufferReader(self.source)
+        buffer.index = self.start + position
+        return buffer
+
+    def _position(self, offset):
+        """
+        Start of the field at *offset*, from start, skipping the variable size fields in front not skipped yet.
+        """
+        anchor, delta = self.layout[offset]
+        pending = []
+        while anchor >= 0 and anchor not in self.ends:
+            pending.append(anchor)
+            anchor = self.layout[anchor][0]
+        for field_offset in reversed(pending):
+            field_anchor, field_delta = self.layout[field_offset]
+            position = field_delta if field_anchor < 0 else self.ends[field_anchor] + field_delta
+            buffer = self._reader(position)
+            self.type_.field_at(field_offset).skip(buffer)
+            self.ends[field_offset] = buffer.index - self.start
+        anchor, delta = self.layout[offset]
+        return delta if anchor < 0 else self.ends[anchor] + delta
+
+    def value(self, offset):
+        """
+        :return: decoded value of the field at *offset*, nested dicts for a structure
+        """
+        try:
+            return self.cache[offset]
+        except KeyError:
+            pass
+        field = self.type_.field_at(offset)
+        buffer = self._reader(self._position(offset))
+        if field.is_structure():
+            value = field.to_dict(field.get_value(buffer))
+        else:
+            value = field.get_value(buffer)
+            if self.layout[offset + 1] == (offset, 0):
+                self.ends[offset] = buffer.index - self.start
+        self.cache[offset] = value
+        return value
+
+    def get(self, path):
+        """
+        :return: decoded value of the field at *path*, e.g. 'value' or 'timeStamp.secondsPastEpoch'
+        :raises KeyError: if no such field exists
+        """
+        return self.value(self.type_.field_offset(path))
+
+    __getitem__ = get
+
+    def locate(self, offset):
+        """
+        :return: index in source of the serialized field at *offset*
+        """
+        return self.start + self._position(offset)
+
+    def reader(self, path):
+        """
+        :return: :class:`e4py.messages.BufferReader` positioned at the field at *path*, to decode it in other ways
+        """
+        return self._reader(self._position(self.type_.field_offset(path)))
+
+    def view(self, path):
+        """
+        :return: :class:`LazyStructure` of the substructure at *path*, sharing the data
+        """
+        offset = self.type_.field_offset(path)
+        return LazyStructure(self.type_.field_at(offset), self.source, self.start + self._position(offset))
+
+    def size(self):
+        """
+        Serialized size in bytes.
+        """
+        return self._position(len(self.layout) - 1)
+
+    def copy(self):
+        """
+        :return: :class:`LazyStructure` on a copy of the data, e.g. to keep it beyond a receive buffer
+        """
+        size = self.size()
+        copy = LazyStructure(self.type_, bytes(self.source[self.start:self.start + size]))
+        copy.cache.update(self.cache)
+        copy.ends.update(self.ends)
+        return copy
+
+    def values(self):
+        """
+        :return: the flat value list, decoding everything
+        """
+        return self.type_.decode(self._reader(0))
+
+    def to_dict(self):
+        return self.type_.to_dict(self.values())
+
 if __name__ == '__main__':
     import codecs
     import hexdump
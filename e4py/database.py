@@ -0,0 +1,582 @@
+"""
+Server side process variable store.
+
+Each :class:`Record` holds a :class:`DataObject` type and a flat value list indexed by field offset,
+numeric arrays as :class:`array.array` (or NumPy arrays if given so). Changes are applied atomically under
+the record lock and posted to the monitors as a BitSet of the changed offsets.
+"""
+import array
+import struct
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from . import constants
+from .data import ArrayFlag, DataFlag, DataObject
+from .messages import ApplicationMessageCode, BitSet, BufferWriter, HeaderFlag, MessageDirection, Status, \
+    StatusType, Subcommand
+from .timer import now, scheduler
+
+# header, requestID and subcommand of a monitor update
+_monitor_prefix = struct.Struct('BBBBIIB')
+_monitor_flags = int(HeaderFlag(direction=MessageDirection.Server))
+
+
+def _as_bytes(name):
+    if isinstance(name, bytes):
+        return name
+    return name.encode()
+
+
+def _resized(field, value, length):
+    """
+    Copy of the array *value* of *field* with *length* elements, cut or padded with zeros.
+    Values held by a record are replaced, never changed in place, since encoded updates may still refer to them.
+    """
+    if hasattr(value, 'dtype'):
+        value = value.copy()
+        value.resize(length, refcheck=False)
+        return value
+    if length <= len(value):
+        return value[:length]
+    if isinstance(value, array.array):
+        return value + array.array(value.typecode, b'\x00' * (field.element_size() * (length - len(value))))
+    pad = b'' if field.type_.type_code == DataFlag.String else None
+    return value + [pad] * (length - len(value))
+
+
+class Record(object):
+    """
+    A process variable.
+
+    :param name: channel name
+    :param type_: :class:`DataObject` structure
+    :param value: initial value as nested dicts, see :meth:`DataObject.from_dict`
+
+    Monitor updates are built and queued on their connections while the lock is held, and written to the
+    sockets once it is released, so a slow client never blocks the record.
+    """
+    __slots__ = ('name', 'type_', 'values', 'lock', 'monitors', 'timestamp_offset', 'unflushed')
+
+    def __init__(self, name, type_, value=None):
+        self.name = _as_bytes(name)
+        self.type_ = type_
+        self.values = type_.default_value()
+        self.lock = threading.RLock()
+        self.monitors = []
+        # connections with monitor updates queued under the lock
+        self.unflushed = set()
+        try:
+            self.timestamp_offset = type_.field_offset(b'timeStamp')
+        except KeyError:
+            self.timestamp_offset = None
+        if value:
+            self.update(value, timestamp=False)
+
+    def get(self, path=b''):
+        """
+        Current value of the field at *path*, nested dicts for a structure.
+        """
+        offset = self.type_.field_offset(path)
+        field = self.type_.field_at(offset)
+        with self.lock:
+            if field.is_structure():
+                return field.to_dict(self.values, offset)
+            return self.values[offset]
+
+    def update(self, changes, timestamp=True):
+        """
+        Atomically change fields and notify the monitors.
+
+        :param changes: {*path*: *value*}, a structure field takes nested dicts
+        :param timestamp: set timeStamp to now unless it is part of *changes*
+        :return: :class:`BitSet` of changed offsets
+        """
+        changed = BitSet()
+        with self.lock:
+            for path, value in changes.items():
+                offset = self.type_.field_offset(path)
+                field = self.type_.field_at(offset)
+                if field.is_structure():
+                    field.from_dict(value, self.values, offset)
+                    # substructures are converted field by field
+                    for sub_offset in range(offset + 1, offset + field.field_count()):
+                        self.values[sub_offset] = self.type_.field_at(sub_offset).convert(self.values[sub_offset])
+                else:
+                    self.values[offset] = field.convert(value)
+                changed.set(offset)
+            if timestamp and self.timestamp_offset is not None and \
+                    not any(_as_bytes(path).startswith(b'timeStamp') for path in changes):
+                self._stamp(changed)
+            self.notify(changed)
+        self.flush()
+        return changed
+
+    def _stamp(self, changed):
+        t = time.time()
+        offset = self.timestamp_offset
+        self.values[offset + 1] = int(t)
+        self.values[offset + 2] = int((t - int(t)) * 1e9)
+        changed.set(offset)
+
+    def put(self, values, bitset):
+        """
+        Apply the fields in *bitset* from the flat value list *values*, as decoded from a client put.
+        """
+        with self.lock:
+            for offset in bitset:
+                count = self.type_.field_at(offset).field_count()
+                self.values[offset:offset + count] = values[offset:offset + count]
+            self.notify(bitset)
+        self.flush()
+
+    def get_array(self, offset, start=0, count=0, stride=1):
+        """
+        Elements *start*, *start* + *stride*... of the array at *offset*, *count* of them or up to the end if 0.
+        """
+        if start < 0 or count < 0 or stride < 1:
+            raise ValueError('invalid array slice')
+        with self.lock:
+            value = self.values[offset]
+        stop = start + count * stride if count else len(value)
+        return value[start:stop:stride]
+
+    def put_array(self, offset, data, start=0, stride=1):
+        """
+        Write *data* into the array at *offset* from *start* every *stride* elements, growing it if needed.
+        """
+        if start < 0 or stride < 1:
+            raise ValueError('invalid array slice')
+        field = self.type_.field_at(offset)
+        data = field.convert(data)
+        with self.lock:
+            value = self.values[offset]
+            end = start + (len(data) - 1) * stride + 1 if len(data) else start
+            value = _resized(field, value, max(len(value), end))
+            value[start:start + len(data) * stride:stride] = data
+            self.values[offset] = value
+            self.notify(BitSet.from_offsets([offset]))
+        self.flush()
+
+    def set_array_length(self, offset, length):
+        """
+        Truncate the array at *offset* or pad it with zeros to *length* elements.
+        """
+        if length < 0:
+            raise ValueError('invalid array length')
+        field = self.type_.field_at(offset)
+        with self.lock:
+            self.values[offset] = _resized(field, self.values[offset], length)
+            self.notify(BitSet.from_offsets([offset]))
+        self.flush()
+
+    def encode(self, buffer, bitset=None):
+        with self.lock:
+            self.type_.encode(buffer, self.values, bitset)
+
+    def create_monitor(self, connection, requestID, options=None):
+        """
+        :param options: record options of the pvRequest, see :class:`MonitorFilter`
+        :raises ValueError: on an invalid filter option
+        """
+        return Monitor(self, connection, requestID, MonitorFilter.from_options(self, options or {}))
+
+    def post(self, changed):
+        """
+        Notify the monitors of the *changed* offsets and send the updates.
+        """
+        with self.lock:
+            self.notify(changed)
+        self.flush()
+
+    def notify(self, changed):
+        """
+        Queue the monitor updates for the *changed* offsets. Called with the lock held, :meth:`flush` sends them.
+        """
+        if not self.monitors:
+            return
+        update = Update(self, changed)
+        for monitor in list(self.monitors):
+            monitor.post(update)
+
+    def queued(self, connection):
+        """
+        A monitor queued an update on *connection*. Called with the lock held.
+        """
+        self.unflushed.add(connection)
+
+    def flush(self):
+        """
+        Write out the monitor updates queued so far. Must be called without the lock.
+        """
+        with self.lock:
+            if not self.unflushed:
+                return
+            connections = self.unflushed
+            self.unflushed = set()
+        for connection in connections:
+            if connection.dispatching:
+                # flushed at the end of the dispatch cycle
+                continue
+            try:
+                connection.flush()
+            except EnvironmentError:
+                # the connection is gone, its dispatcher cleans up
+                with self.lock:
+                    for monitor in list(self.monitors):
+                        if getattr(monitor, 'connection', None) is connection:
+                            monitor.started = False
+                            self.monitors.remove(monitor)
+
+
+class Update(object):
+    """
+    A change posted to the monitors of a record.
+
+    The monitor body, changed BitSet, values and an empty overrun BitSet, is encoded on first use and
+    then shared as immutable bytes by every monitor that sends the update as is. Fanout to many subscribers
+    costs one encoding plus a small prefix per subscriber.
+    """
+    __slots__ = ('record', 'changed', '_body')
+
+    def __init__(self, record, changed):
+        self.record = record
+        self.changed = changed
+        self._body = None
+
+    def body(self):
+        if self._body is None:
+            self._body = encode_monitor_body(self.record, self.changed, BitSet())
+        return self._body
+
+
+def encode_monitor_body(record, changed, overrun):
+    """
+    Monitor update body as bytes. Called with the record lock held.
+    """
+    buffer = BufferWriter()
+    buffer.put_raw(changed.to_buffer())
+    record.type_.encode(buffer, record.values, changed)
+    buffer.put_raw(overrun.to_buffer())
+    return bytes(buffer.get_buffer())
+
+
+# runs the handlers of RPC services, created on first use
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def rpc_executor():
+    """
+    Thread pool shared by the :class:`RPCService` instances without their own.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(constants.PVA_RPC_WORKERS)
+        return _executor
+
+
+class RPCService(object):
+    """
+    A channel answering RPC requests.
+
+    *handler(type_, values)* gets the argument structure as :class:`DataObject` and flat value list and returns
+    the response the same way, or raises ValueError to report an error to the client. Handlers run on a thread
+    pool, so calls are served concurrently and answered as they complete, in any order.
+
+    :param executor: :class:`concurrent.futures.Executor` for the handler, by default :func:`rpc_executor`
+    """
+    def __init__(self, name, handler, executor=None):
+        self.name = _as_bytes(name)
+        self.handler = handler
+        self.executor = executor
+        # nothing to get or monitor
+        self.type_ = DataObject.structure(b'', [])
+
+    def call(self, type_, values, callback):
+        """
+        Run the handler, then *callback(status, type_, values)* on the pool thread.
+        """
+        (self.executor or rpc_executor()).submit(self._run, type_, values, callback)
+
+    def _run(self, type_, values, callback):
+        try:
+            result_type, result = self.handler(type_, values)
+            status = Status()
+        except ValueError as e:
+            result_type = result = None
+            status = Status(StatusType.ERROR, str(e).encode())
+        except Exception as e:
+            # the client gets the traceback as call tree, the server prints nothing
+            result_type = result = None
+            status = Status(StatusType.FATAL, str(e).encode(), traceback.format_exc().encode())
+        callback(status, result_type, result)
+
+
+class Database(object):
+    """
+    Records by name.
+    """
+    def __init__(self):
+        self.records = {}
+        self.lock = threading.Lock()
+        # bumped whenever the set of records changes, announced in beacons
+        self.change_count = 0
+
+    def add(self, name, type_, value=None):
+        """
+        Create a record, replacing one of the same name.
+
+        :return: :class:`Record`
+        """
+        record = Record(name, type_, value)
+        with self.lock:
+            self.records[record.name] = record
+            self.change_count = (self.change_count + 1) & 0xffff
+        return record
+
+    def add_service(self, name, handler, executor=None):
+        """
+        Create an RPC channel, see :class:`RPCService`.
+        """
+        service = RPCService(name, handler, executor)
+        with self.lock:
+            self.records[service.name] = service
+            self.change_count = (self.change_count + 1) & 0xffff
+        return service
+
+    def remove(self, name):
+        with self.lock:
+            record = self.records.pop(_as_bytes(name), None)
+            if record is not None:
+                self.change_count = (self.change_count + 1) & 0xffff
+            return record
+
+    def get(self, name):
+        """
+        :return: :class:`Record`, :class:`RPCService` or None
+        """
+        return self.records.get(_as_bytes(name))
+
+    def names(self):
+        return list(self.records.keys())
+
+    def update(self, name, changes, timestamp=True):
+        """
+        Update record *name*, see :meth:`Record.update`.
+        """
+        return self.records[_as_bytes(name)].update(changes, timestamp)
+
+    def __contains__(self, name):
+        return _as_bytes(name) in self.records
+
+    def __len__(self):
+        return len(self.records)
+
+
+class MonitorFilter(object):
+    """
+    Server side filter of one monitor, configured by the record options of its pvRequest
+
+        deadband     absolute deadband on value
+        deadbandRel  deadband relative to the last value sent, e.g. 0.01 for 1%
+        maxRate      maximum updates per second
+        coalesce     'true' (default) sends the latest value at the end of a rate interval,
+                     'false' drops updates above maxRate
+
+    Updates that change nothing but value and timeStamp are dropped while value stays within the deadband.
+    Filters run before an update is encoded, what they drop costs nothing but the comparison.
+    """
+    def __init__(self, record, deadband=0., relative=0., max_rate=None, coalesce=True):
+        self.deadband = deadband
+        self.relative = relative
+        self.interval = 1. / max_rate if max_rate else 0.
+        self.coalesce = coalesce
+        self.last_value = None
+        self.last_sent = None
+        self.value_offset = None
+        self.deadband_bits = 0
+        if deadband or relative:
+            try:
+                offset = record.type_.field_offset(b'value')
+            except KeyError:
+                return
+            field = record.type_.field_at(offset)
+            if field.type_.array_flag != ArrayFlag.Scalar or \
+                    field.type_.type_code in (DataFlag.Structure, DataFlag.Union, DataFlag.String):
+                return
+            self.value_offset = offset
+            self.deadband_bits = 1 << offset
+            if record.timestamp_offset is not None:
+                timestamp = record.type_.field_at(record.timestamp_offset)
+                for sub_offset in range(record.timestamp_offset, record.timestamp_offset + timestamp.field_count()):
+                    self.deadband_bits |= 1 << sub_offset
+
+    @staticmethod
+    def from_options(record, options):
+        """
+        :return: :class:`MonitorFilter`, or None if *options* ask for no filtering
+        :raises ValueError: on an invalid option value
+        """
+        deadband = float(options.get('deadband', 0))
+        relative = float(options.get('deadbandRel', 0))
+        max_rate = float(options.get('maxRate', 0))
+        coalesce = options.get('coalesce', 'true').lower()
+        if coalesce not in ('true', 'false') or deadband < 0 or relative < 0 or max_rate < 0:
+            raise ValueError('invalid monitor filter option in %s' % options)
+        if not (deadband or relative or max_rate):
+            return None
+        return MonitorFilter(record, deadband, relative, max_rate, coalesce == 'true')
+
+    def accept(self, changed, values):
+        """
+        False if the update is within the deadband.
+        """
+        if self.value_offset is None or self.last_value is None or changed.bits & ~self.deadband_bits:
+            return True
+        if not changed.get(self.value_offset):
+            return False
+        difference = abs(values[self.value_offset] - self.last_value)
+        return difference > self.deadband and difference > self.relative * abs(self.last_value)
+
+    def delay(self):
+        """
+        Seconds until the rate limit allows the next update.
+        """
+        if not self.interval or self.last_sent is None:
+            return 0.
+        return max(0., self.last_sent + self.interval - now())
+
+    def sent(self, values):
+        if self.value_offset is not None:
+            self.last_value = values[self.value_offset]
+        if self.interval:
+            self.last_sent = now()
+
+
+class Monitor(object):
+    """
+    Subscription of a monitor request to a record.
+
+    Updates are sent right away while the connection is writable, sharing the body encoded for all monitors
+    of the record. Otherwise changes accumulate in the pending BitSet and go out as one update, encoded for
+    this monitor alone, once the connection drains, fields that changed again meanwhile are flagged in the
+    overrun BitSet. A slow client costs a pending BitSet, not a growing queue. Updates held back by the
+    rate limit of a :class:`MonitorFilter` are coalesced the same way.
+    """
+    def __init__(self, record, connection, requestID, filter_=None):
+        self.record = record
+        self.connection = connection
+        self.requestID = requestID
+        self.filter = filter_
+        self.pending = BitSet()
+        self.overrun = BitSet()
+        self.started = False
+        self.waiting = False
+        self.timer = None
+
+    def start(self):
+        with self.record.lock:
+            if self.started:
+                return
+            self.started = True
+            self.record.monitors.append(self)
+            # the first update carries the complete structure
+            self.pending = BitSet(1)
+            self._send_pending()
+        self.record.flush()
+
+    def stop(self):
+        with self.record.lock:
+            if not self.started:
+                return
+            self.started = False
+            self.record.monitors.remove(self)
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+    def destroy(self):
+        self.stop()
+        with self.record.lock:
+            if self.waiting:
+                self.waiting = False
+                self.connection.remove_writable_callback(self._writable)
+
+    def post(self, update):
+        """
+        Called with the record lock held, the update is queued and sent by :meth:`Record.flush`.
+
+        :param update: :class:`Update`
+        """
+        if not self.started:
+            return
+        changed = update.changed
+        if self.filter is not None:
+            if not self.filter.accept(changed, self.record.values):
+                return
+            if self.timer is not None:
+                self._add_pending(changed)
+                return
+            delay = self.filter.delay()
+            if delay > 0:
+                if self.filter.coalesce:
+                    self._add_pending(changed)
+                    self.timer = scheduler.schedule(delay, self._release)
+                return
+        writable = self.connection.writable()
+        if writable and self.pending.is_empty():
+            self._send(update.body())
+            return
+        self._add_pending(changed)
+        if writable:
+            self._send_pending()
+        elif not self.waiting:
+            self.waiting = True
+            self.connection.add_writable_callback(self._writable)
+
+    def _add_pending(self, changed):
+        self.overrun.bits |= self.pending.bits & changed.bits
+        self.pending.bits |= changed.bits
+
+    def _release(self):
+        """
+        End of a rate interval, send what was held back.
+        """
+        with self.record.lock:
+            self.timer = None
+            if not self.started or self.pending.is_empty():
+                return
+            if self.connection.writable():
+                self._send_pending()
+            elif not self.waiting:
+                self.waiting = True
+                self.connection.add_writable_callback(self._writable)
+        self.record.flush()
+
+    def _writable(self, connection):
+        with self.record.lock:
+            if not self.waiting:
+                return
+            self.waiting = False
+            connection.remove_writable_callback(self._writable)
+            if self.started and self.timer is None and not self.pending.is_empty():
+                self._send_pending()
+        self.record.flush()
+
+    def _send_pending(self):
+        body = encode_monitor_body(self.record, self.pending, self.overrun)
+        self.pending = BitSet()
+        self.overrun = BitSet()
+        self._send(body)
+
+    def _send(self, body):
+        if self.filter is not None:
+            self.filter.sent(self.record.values)
+        prefix = _monitor_prefix.pack(constants.PVA_MAGIC, constants.PVA_VERSION, _monitor_flags,
+                                      ApplicationMessageCode.ChannelMonitor, 5 + len(body),
+                                      self.requestID, Subcommand.Default)
+        self.connection.queue_buffers((prefix, body))
+        self.record.queued(self.connection)
@@ -0,0 +1,702 @@
+"""
+pvAccess gateway.
+
+Downstream clients are served by the usual :class:`ServerMessageDispatcher` from a :class:`GatewayDatabase`,
+whose records mirror upstream PVs. The first downstream request for a name makes the gateway search for it
+upstream, connect to the server and start a single monitor. Its updates are applied to the mirror record and
+fanned out to all downstream monitors, gets are answered from the last value and puts are forwarded upstream,
+the downstream client gets the upstream put status. However many clients subscribe, an upstream server sees one
+connection and one monitor per PV, and once the last downstream channel of a PV is gone for a while, the
+upstream channel is destroyed. Downstream CreateChannel requests are answered once the upstream channel is
+connected, without blocking the connection meanwhile, and when an upstream server is lost the downstream
+channels of its PVs are destroyed, so that their clients search again.
+
+Searches from downstream are answered with the gateway address once the name was found upstream, the
+:class:`Resolver` caches the upstream answers, found and not found.
+
+Run with::
+
+    python -m e4py.gateway --upstream 10.0.0.255 --upstream ioc1:5076
+"""
+import argparse
+import collections
+import ipaddress
+import itertools
+import random
+import socket
+import struct
+import threading
+
+from . import constants
+from . import health
+from .database import Record
+from .messages import *
+from .messages import BufferWriter, StatusType
+from .search import SearchScheduler, parse_address
+from .server import serve_connection
+from .timer import now, scheduler
+from .transport import Connection, configure_socket
+
+
+class Resolver(object):
+    """
+    Locate PVs on the upstream servers by UDP search and remember the answers.
+
+    :param addresses: [(*host*, *port*)] search destinations, unicast or broadcast
+    :param ttl: seconds a found server is remembered
+    :param negative_ttl: seconds a name nobody answered for is remembered
+    :param timeout: seconds to wait for a search response
+    """
+    def __init__(self, addresses, ttl=300., negative_ttl=10., timeout=1.):
+        self.searcher = SearchScheduler(addresses)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.timeout = timeout
+        # name -> (address or None, expiry)
+        self.cache = {}
+        # name -> (callbacks, timer)
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def lookup(self, name):
+        """
+        :return: (*host*, *port*) of the server, None if known to be absent
+        :raises KeyError: if *name* is not in the cache
+        """
+        with self.lock:
+            address, expiry = self.cache[name]
+            if expiry < now():
+                del self.cache[name]
+                raise KeyError(name)
+            return address
+
+    def forget(self, name):
+        with self.lock:
+            self.cache.pop(name, None)
+
+    def resolve(self, name, callback):
+        """
+        Call *callback(name, address)* with the (*host*, *port*) of the server or None, right away if *name*
+        is cached, otherwise once the search is answered or timed out.
+        """
+        try:
+            address = self.lookup(name)
+        except KeyError:
+            pass
+        else:
+            callback(name, address)
+            return
+        with self.lock:
+            if name in self.pending:
+                self.pending[name][0].append(callback)
+                return
+            timer = scheduler.schedule(self.timeout, self._done, name, None)
+            self.pending[name] = ([callback], timer)
+        self.searcher.search(name, self._done)
+
+    def resolve_wait(self, name, timeout=None):
+        """
+        Blocking :meth:`resolve`.
+
+        :return: (*host*, *port*) or None
+        """
+        event = threading.Event()
+        result = []
+
+        def found(name, address):
+            result.append(address)
+            event.set()
+
+        self.resolve(name, found)
+        event.wait(timeout)
+        return result[0] if result else None
+
+    def _done(self, name, address):
+        with self.lock:
+            entry = self.pending.pop(name, None)
+            if entry is None:
+                return
+            callbacks, timer = entry
+            timer.cancel()
+            ttl = self.ttl if address is not None else self.negative_ttl
+            self.cache[name] = (address, now() + ttl)
+        if address is None:
+            self.searcher.cancel(name)
+        for callback in callbacks:
+            callback(name, address)
+
+
+class MirrorRecord(Record):
+    """
+    Record holding the last value monitored from upstream. Puts are forwarded to the upstream channel.
+
+    Each downstream channel registers a lost callback, they count the references to the upstream channel.
+    """
+    __slots__ = ('channel', 'lost_callbacks')
+
+    def __init__(self, name, type_, channel):
+        Record.__init__(self, name, type_)
+        self.channel = channel
+        self.lost_callbacks = []
+
+    def put(self, values, bitset):
+        self.channel.put(values, bitset)
+
+    def put_async(self, values, bitset, callback):
+        """
+        Forward a put, *callback(status)* gets the upstream outcome.
+        """
+        self.channel.put(values, bitset, callback)
+
+    def add_lost_callback(self, callback):
+        """
+        Call *callback(record)* when the upstream channel is lost.
+        """
+        with self.lock:
+            self.lost_callbacks.append(callback)
+
+    def remove_lost_callback(self, callback):
+        with self.lock:
+            self.lost_callbacks.remove(callback)
+            unused = not self.lost_callbacks
+        if unused:
+            self.channel.unused()
+
+    def lost(self):
+        with self.lock:
+            callbacks = list(self.lost_callbacks)
+        for callback in callbacks:
+            callback(self)
+
+
+class UpstreamChannel(object):
+    """
+    A channel on an upstream server with its monitor.
+
+    The channel is released, destroyed upstream, once no downstream channel used it for *linger* seconds.
+    """
+    def __init__(self, upstream, name, clientChannelID, linger=10.):
+        self.upstream = upstream
+        self.name = name
+        self.clientChannelID = clientChannelID
+        self.serverChannelID = None
+        self.monitorID = None
+        self.putID = None
+        self.record = None
+        self.ready = threading.Event()
+        # (callback, timer) waiting for ready
+        self.waiters = []
+        # callbacks of the puts sent, answered in order
+        self.puts = collections.deque()
+        self.lock = threading.Lock()
+        self.linger = linger
+        # last time the record was handed out
+        self.used = now()
+        self.release_timer = None
+        # the CreateChannel or the monitor failed
+        self.failed = False
+        # no longer in the tables of the upstream connection
+        self.removed = False
+
+    def when_ready(self, callback, timeout):
+        """
+        Call *callback(record)* once the first value arrived, with None if the channel failed or *timeout* expired.
+        """
+        with self.lock:
+            if not self.ready.is_set():
+                timer = scheduler.schedule(timeout, self._expired, callback)
+                self.waiters.append((callback, timer))
+                return
+            self.used = now()
+            # a released channel no longer gets updates
+            record = None if self.removed else self.record
+        callback(record)
+
+    def _expired(self, callback):
+        with self.lock:
+            for waiter in self.waiters:
+                if waiter[0] is callback:
+                    self.waiters.remove(waiter)
+                    break
+            else:
+                return
+        callback(None)
+
+    def _set_ready(self):
+        with self.lock:
+            self.ready.set()
+            self.used = now()
+            waiters = self.waiters
+            self.waiters = []
+        for callback, timer in waiters:
+            timer.cancel()
+            callback(self.record)
+        if self.record is not None:
+            # released unless a downstream channel takes it
+            self.unused()
+
+    def _failed(self):
+        """
+        Drop the channel, so that the name is looked up again, and fail what waits.
+        """
+        self.failed = True
+        self.upstream.remove(self)
+        self._set_ready()
+
+    def unused(self):
+        """
+        The last downstream channel is gone, release the channel unless it is used again within *linger*.
+        """
+        with self.lock:
+            if self.release_timer is None and not self.removed:
+                self.release_timer = scheduler.schedule(self.linger, self._check_release)
+
+    def _check_release(self):
+        with self.lock:
+            self.release_timer = None
+            if self.removed:
+                return
+            with self.record.lock:
+                if self.record.lost_callbacks:
+                    return
+            idle = now() - self.used
+            if idle < self.linger:
+                self.release_timer = scheduler.schedule(self.linger - idle, self._check_release)
+                return
+        self.upstream.remove(self)
+        # not on the scheduler thread, the send may block
+        request = DestroyChannelRequest(self.serverChannelID, self.clientChannelID)
+        thread = threading.Thread(target=self._send_quietly, args=(request.to_buffer(),))
+        thread.daemon = True
+        thread.start()
+
+    def _send_quietly(self, data):
+        try:
+            self.upstream.send(data)
+        except EnvironmentError:
+            pass
+
+    def created(self, response):
+        if not response.status.is_ok():
+            self._failed()
+            return
+        self.serverChannelID = response.serverChannelID
+        self.monitorID = self.upstream.add_request(self)
+        request = ChannelRequestInit(ApplicationMessageCode.ChannelMonitor, self.serverChannelID, self.monitorID,
+                                     PVRequest.create())
+        self.upstream.send(request.to_buffer())
+
+    def init_received(self, requestID, response):
+        if requestID == self.putID:
+            # a failed init fails the puts that follow
+            return
+        if not response.status.is_ok():
+            self._failed()
+            return
+        self.record = MirrorRecord(self.name, response.types[0], self)
+        request = ChannelRequest(ApplicationMessageCode.ChannelMonitor, self.serverChannelID, self.monitorID,
+                                 Subcommand.Start)
+        self.upstream.send(request.to_buffer())
+
+    def update_received(self, buffer):
+        changed = BitSet.from_buffer(buffer)
+        values = self.record.type_.decode(buffer, bitset=changed)
+        Record.put(self.record, values, changed)
+        if not self.ready.is_set():
+            self._set_ready()
+
+    def put(self, values, bitset, callback=None):
+        """
+        Forward a put, *callback(status)* gets the status of the upstream response.
+        """
+        body = BufferWriter()
+        body.put_raw(bitset.to_buffer())
+        self.record.type_.encode(body, values, bitset)
+        # queued under the lock, so that one INIT precedes the puts in the order of their callbacks
+        with self.lock:
+            self.puts.append(callback)
+            if self.putID is None:
+                self.putID = self.upstream.add_request(self)
+                request = ChannelRequestInit(ApplicationMessageCode.ChannelPut, self.serverChannelID, self.putID,
+                                             PVRequest.create())
+                self.upstream.queue(request.to_buffer())
+            request = ChannelRequest(ApplicationMessageCode.ChannelPut, self.serverChannelID, self.putID,
+                                     Subcommand.Default, bytes(body.get_buffer()))
+            self.upstream.queue(request.to_buffer())
+        self.upstream.flush()
+
+    def put_done(self, status):
+        with self.lock:
+            callback = self.puts.popleft() if self.puts else None
+        if callback is not None:
+            callback(status)
+
+    def lost(self):
+        """
+        The upstream connection is gone, fail what waits and tell the downstream channels.
+        """
+        with self.lock:
+            self.removed = True
+            if self.release_timer is not None:
+                self.release_timer.cancel()
+                self.release_timer = None
+            puts = list(self.puts)
+            self.puts.clear()
+        status = Status(StatusType.ERROR, b'upstream connection lost')
+        for callback in puts:
+            if callback is not None:
+                callback(status)
+        self._set_ready()
+        if self.record is not None:
+            self.record.lost()
+
+
+class UpstreamDispatcher(MessageDispatcher):
+    """
+    Client side of an upstream connection, feeding the channels of an :class:`Upstream`.
+    """
+    def __init__(self, transport, upstream):
+        MessageDispatcher.__init__(self, transport)
+        self.upstream = upstream
+        # keep the connection running between messages
+        self.pending = True
+
+    def message_received(self, header, buffer):
+        upstream = self.upstream
+        if header.messageCommand == ApplicationMessageCode.ConnectionValidation:
+            request = ConnectionValidationRequest.from_buffer(buffer)
+            self.transport.set_send_buffer_size(request.serverReceiverBufferSize)
+            response = ConnectionValidationResponse(self.transport.receive_buffer_size,
+                                                    request.serverIntrospectionRegistryMaxSize, 0, b'')
+            self.send_data(response.to_buffer())
+        elif header.messageCommand == ApplicationMessageCode.ConnectionValidated:
+            upstream.validated.set()
+        elif header.messageCommand == ApplicationMessageCode.CreateChannel:
+            response = CreateChannelResponse.from_buffer(buffer)
+            channel = upstream.channels.get(response.clientChannelID)
+            if channel is not None:
+                channel.created(response)
+        elif header.messageCommand in (ApplicationMessageCode.ChannelMonitor, ApplicationMessageCode.ChannelPut):
+            requestID, subcommand = struct.unpack_from('IB', buffer.source, buffer.index)
+            channel = upstream.requests.get(requestID)
+            if channel is None:
+                return
+            if subcommand & Subcommand.Init:
+                channel.init_received(requestID, ChannelResponseInit.from_buffer(buffer, header.messageCommand))
+            elif header.messageCommand == ApplicationMessageCode.ChannelPut:
+                channel.put_done(ChannelResponse.from_buffer(buffer, header.messageCommand).status)
+            elif channel.record is not None:
+                ChannelResponse.from_buffer(buffer, header.messageCommand)
+                channel.update_received(buffer)
+
+    def connection_lost(self):
+        self.upstream.lost()
+
+
+class Upstream(object):
+    """
+    Connection to one upstream server, shared by all channels of the gateway on that server.
+
+    :param lost_callback: *lost_callback(upstream)* when the connection is lost
+    :param removed_callback: *removed_callback(channel)* when a channel failed or was released
+    :param linger: see :class:`UpstreamChannel`
+    :raises EnvironmentError: if the server cannot be reached or does not validate the connection in *timeout*
+    """
+    def __init__(self, address, timeout=5., lost_callback=None, removed_callback=None, linger=10.):
+        self.address = address
+        self.lost_callback = lost_callback
+        self.removed_callback = removed_callback
+        self.linger = linger
+        self.channels = {}
+        self.names = {}
+        self.requests = {}
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.validated = threading.Event()
+
+        family, type_, proto, canonname, sockaddr = socket.getaddrinfo(address[0], address[1], 0,
+                                                                       socket.SOCK_STREAM)[0]
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        configure_socket(sock, constants.PVA_RECEIVE_BUFFER_SIZE)
+        sock.settimeout(timeout)
+        sock.connect(sockaddr)
+        sock.settimeout(None)
+
+        self.connection = Connection(sock)
+        self.connection.dispatcher = UpstreamDispatcher(self.connection, self)
+        health.monitor.register(self.connection)
+        self.thread = threading.Thread(target=self.connection.run, name='e4py-upstream')
+        self.thread.daemon = True
+        self.thread.start()
+        if not self.validated.wait(timeout):
+            self.connection.close()
+            raise socket.timeout('connection to %s:%d not validated' % address)
+
+    def send(self, data):
+        self.connection.send(data)
+
+    def queue(self, data):
+        """
+        Queue *data* for the next :meth:`flush`, e.g. while holding a lock.
+        """
+        self.connection.queue_buffers((data,))
+
+    def flush(self):
+        if not self.connection.dispatching:
+            self.connection.flush()
+
+    def add_request(self, channel):
+        with self.lock:
+            requestID = next(self.ids) & 0xffffffff
+            self.requests[requestID] = channel
+        return requestID
+
+    def channel(self, name):
+        """
+        :return: :class:`UpstreamChannel` for *name*, created on first use
+        """
+        with self.lock:
+            channel = self.names.get(name)
+            if channel is not None:
+                return channel
+            channel = UpstreamChannel(self, name, next(self.ids) & 0xffffffff, self.linger)
+            self.names[name] = channel
+            self.channels[channel.clientChannelID] = channel
+        self.send(CreateChannelRequest([(channel.clientChannelID, name)]).to_buffer())
+        return channel
+
+    def remove(self, channel):
+        """
+        Forget *channel*, the next use of its name creates a new one.
+        """
+        with self.lock:
+            channel.removed = True
+            if self.names.get(channel.name) is channel:
+                del self.names[channel.name]
+            self.channels.pop(channel.clientChannelID, None)
+            for requestID in (channel.monitorID, channel.putID):
+                if self.requests.get(requestID) is channel:
+                    del self.requests[requestID]
+        if self.removed_callback is not None:
+            self.removed_callback(channel)
+
+    def lost(self):
+        with self.lock:
+            channels = list(self.names.values())
+            self.names.clear()
+            self.channels.clear()
+            self.requests.clear()
+        # forget the channels before their clients search again
+        if self.lost_callback is not None:
+            self.lost_callback(self)
+        for channel in channels:
+            channel.lost()
+
+
+class GatewayDatabase(object):
+    """
+    Database of mirror records, created on demand from upstream PVs.
+
+    :param resolver: :class:`Resolver` for the upstream servers
+    :param timeout: seconds to wait for an upstream PV to connect
+    :param linger: seconds an upstream channel is kept after its last downstream channel is gone
+    """
+    def __init__(self, resolver, timeout=5., linger=10.):
+        self.resolver = resolver
+        self.timeout = timeout
+        self.linger = linger
+        self.upstreams = {}
+        self.channels = {}
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        """
+        Blocking :meth:`get_async`.
+
+        :return: :class:`MirrorRecord` once the upstream monitor delivered the first value, None if the PV
+                 cannot be found or connected in time
+        """
+        event = threading.Event()
+        result = []
+
+        def found(record):
+            result.append(record)
+            event.set()
+
+        self.get_async(name, found)
+        # resolving, connecting and the first value each time out on their own
+        event.wait(3 * self.timeout + self.resolver.timeout)
+        return result[0] if result else None
+
+    def get_async(self, name, callback):
+        """
+        Call *callback(record)* with the :class:`MirrorRecord` once the upstream monitor delivered the first
+        value, with None if the PV cannot be found or connected in time. Never blocks, connecting to a new
+        upstream server takes a thread of its own.
+        """
+        with self.lock:
+            channel = self.channels.get(name)
+        if channel is not None:
+            channel.when_ready(callback, self.timeout)
+        else:
+            self.resolver.resolve(name, lambda name, address: self._resolved(name, address, callback))
+
+    def _resolved(self, name, address, callback):
+        if address is None:
+            callback(None)
+            return
+        with self.lock:
+            upstream = self.upstreams.get(address)
+        if upstream is not None:
+            self._open(upstream, name, callback)
+            return
+        thread = threading.Thread(target=self._connect, args=(name, address, callback), name='e4py-upstream-connect')
+        thread.daemon = True
+        thread.start()
+
+    def _connect(self, name, address, callback):
+        try:
+            upstream = self._upstream(address)
+        except EnvironmentError:
+            self.resolver.forget(name)
+            callback(None)
+            return
+        self._open(upstream, name, callback)
+
+    def _open(self, upstream, name, callback):
+        channel = upstream.channel(name)
+        with self.lock:
+            # a channel that failed meanwhile answers the callback, but is not kept
+            if not channel.removed:
+                channel = self.channels.setdefault(name, channel)
+        channel.when_ready(callback, self.timeout)
+
+    def _upstream(self, address):
+        with self.lock:
+            upstream = self.upstreams.get(address)
+        if upstream is None:
+            # connect outside the lock, a concurrent connect to the same server is closed again
+            upstream = Upstream(address, self.timeout, self._lost, self._removed, self.linger)
+            with self.lock:
+                existing = self.upstreams.setdefault(address, upstream)
+            if existing is not upstream:
+                upstream.connection.close()
+                upstream = existing
+        return upstream
+
+    def _lost(self, upstream):
+        with self.lock:
+            if self.upstreams.get(upstream.address) is upstream:
+                del self.upstreams[upstream.address]
+            for name, channel in list(self.channels.items()):
+                if channel.upstream is upstream:
+                    del self.channels[name]
+                    self.resolver.forget(name)
+
+    def _removed(self, channel):
+        with self.lock:
+            if self.channels.get(channel.name) is channel:
+                del self.channels[channel.name]
+        if channel.failed:
+            # do not answer from the cache what failed upstream
+            self.resolver.forget(channel.name)
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+
+class Gateway(object):
+    """
+    Serve upstream PVs to downstream clients.
+
+    :param upstream: [(*host*, *port*)] where to search upstream PVs
+    :param port: TCP port for downstream clients
+    :param search_port: UDP port for downstream searches
+    :param linger: seconds an unused upstream channel is kept
+    """
+    def __init__(self, upstream, port=constants.PVA_SERVER_PORT, search_port=constants.PVA_BROADCAST_PORT,
+                 timeout=5., linger=10.):
+        self.resolver = Resolver(upstream, timeout=min(timeout, 1.))
+        self.database = GatewayDatabase(self.resolver, timeout, linger)
+        self.port = port
+        self.search_port = search_port
+        self.guid = random.getrandbits(96)
+
+    def serve_tcp(self):
+        sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        configure_socket(sock, constants.PVA_RECEIVE_BUFFER_SIZE)
+        sock.bind(('', self.port))
+        sock.listen(64)
+        while True:
+            client, addr = sock.accept()
+            tid = threading.Thread(target=serve_connection, args=(client, self.database))
+            tid.daemon = True
+            tid.start()
+
+    def serve_search(self):
+        sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(('', self.search_port))
+        while True:
+            chunk, sender = sock.recvfrom(0x10000)
+            buffer = BufferReader(chunk)
+            try:
+                header = MessageHeader.from_buffer(buffer)
+                if header.messageCommand != ApplicationMessageCode.SearchRequest:
+                    continue
+                request = SearchRequest.from_buffer(buffer)
+            except (ValueError, struct.error):
+                continue
+            self.search_received(sock, request, sender)
+
+    def search_received(self, sock, request, sender):
+        """
+        Answer the names known upstream, those still searched for are answered once found.
+        """
+        destination = (sender[0], request.responsePort)
+        found = []
+
+        def reply(instanceIds):
+            response = SearchResponse(self.guid, request.sequenceId, ipaddress.ip_address(u'::ffff:0.0.0.0'),
+                                      self.port, b'tcp', True, instanceIds)
+            try:
+                sock.sendto(response.to_buffer(), destination)
+            except EnvironmentError:
+                pass
+
+        for instanceId, name in request.channels:
+            try:
+                if self.resolver.lookup(name) is not None:
+                    found.append(instanceId)
+            except KeyError:
+                self.resolver.resolve(name, lambda name, address, instanceId=instanceId:
+                                      address is not None and reply([instanceId]))
+        if found:
+            reply(found)
+
+    def run(self):
+        tid = threading.Thread(target=self.serve_search, name='e4py-gateway-search')
+        tid.daemon = True
+        tid.start()
+        self.serve_tcp()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='pvAccess gateway')
+    parser.add_argument('--upstream', action='append', required=True,
+                        help='search address of upstream servers, host[:port], may be repeated')
+    parser.add_argument('--port', type=int, default=constants.PVA_SERVER_PORT,
+                        help='TCP port for downstream clients')
+    parser.add_argument('--search-port', type=int, default=constants.PVA_BROADCAST_PORT,
+                        help='UDP port for downstream searches')
+    args = parser.parse_args(argv)
+
+    upstream = [parse_address(text) for text in args.upstream]
+    Gateway(upstream, args.port, args.search_port).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+"""
+Connection liveness based on echo messages.
+
+Idle client connections are probed with an application Echo message, which servers answer. The round trip time
+of each echo feeds a smoothed estimate (RFC 6298), and a server that does not answer in time is declared dead and
+its connection closed. It is the clients that send echoes, so servers do not probe and only close connections
+that stayed silent for two echo periods and the echo timeout.
+All connections are checked by one periodic job of the shared :data:`e4py.timer.scheduler`.
+"""
+import itertools
+import struct
+import threading
+
+from . import constants
+from .messages import EchoMessage, MessageDirection
+from .timer import now, scheduler
+
+
+class RoundTripEstimator(object):
+    """
+    Exponentially weighted round trip time estimate.
+    """
+    alpha = 0.125
+    beta = 0.25
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.last = None
+        self.minimum = None
+        self.samples = 0
+
+    def add_sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2.
+        else:
+            self.rttvar = (1 - self.beta) * self.rttvar + self.beta * abs(self.srtt - rtt)
+            self.srtt = (1 - self.alpha) * self.srtt + self.alpha * rtt
+        self.last = rtt
+        if self.minimum is None or rtt < self.minimum:
+            self.minimum = rtt
+        self.samples += 1
+
+    def timeout(self):
+        """
+        Retransmission timeout, srtt + 4 * rttvar, or None before the first sample.
+        """
+        if self.srtt is None:
+            return None
+        return self.srtt + 4 * self.rttvar
+
+    def __str__(self):
+        if self.srtt is None:
+            return 'RTT no samples'
+        return 'RTT srtt %.6f rttvar %.6f last %.6f min %.6f samples %d' % \
+            (self.srtt, self.rttvar, self.last, self.minimum, self.samples)
+
+
+class ConnectionHealth(object):
+    """
+    Echo state of one connection.
+    """
+    def __init__(self, connection, monitor):
+        self.connection = connection
+        self.monitor = monitor
+        self.rtt = RoundTripEstimator()
+        self.echo_token = None
+        self.echo_sent = None
+        self.dead = False
+
+    def echo_received(self, token):
+        if token != self.echo_token:
+            return
+        self.rtt.add_sample(now() - self.echo_sent)
+        self.echo_token = None
+        self.echo_sent = None
+
+    def stats(self):
+        return {
+            'srtt': self.rtt.srtt,
+            'rttvar': self.rtt.rttvar,
+            'last': self.rtt.last,
+            'min': self.rtt.minimum,
+            'samples': self.rtt.samples,
+            'idle': now() - self.connection.last_received,
+        }
+
+
+class HealthMonitor(object):
+    """
+    Probe idle connections and close those whose peer stopped answering.
+
+    :param echo_period: idle seconds before an echo request is sent
+    :param echo_timeout: minimum seconds to wait for the echo response,
+                         the effective timeout grows with the measured round trip time
+    :param tick: interval of the periodic check
+    """
+    def __init__(self, echo_period=constants.PVA_ECHO_PERIOD, echo_timeout=constants.PVA_ECHO_TIMEOUT, tick=None):
+        self.echo_period = echo_period
+        self.echo_timeout = echo_timeout
+        self.tick = tick or min(echo_period, echo_timeout) / 4.
+        self.connections = set()
+        self.tokens = itertools.count(1)
+        self.lock = threading.Lock()
+        self.timer = None
+        self.dead_callbacks = []
+
+    def add_dead_callback(self, callback):
+        """
+        Call *callback(connection)* when a connection is declared dead.
+        """
+        self.dead_callbacks.append(callback)
+
+    def register(self, connection):
+        connection.health = ConnectionHealth(connection, self)
+        with self.lock:
+            self.connections.add(connection)
+            if self.timer is None:
+                self.timer = scheduler.schedule_periodic(self.tick, self.check)
+
+    def unregister(self, connection):
+        with self.lock:
+            self.connections.discard(connection)
+            if not self.connections and self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+    def check(self):
+        with self.lock:
+            connections = list(self.connections)
+        t = now()
+        for connection in connections:
+            health = connection.health
+            if health.echo_sent is not None:
+                timeout = max(self.echo_timeout, health.rtt.timeout() or 0)
+                if t - health.echo_sent > timeout:
+                    if connection.last_received < health.echo_sent:
+                        self.declare_dead(connection)
+                    else:
+                        # the peer does not answer echoes, but the data it sent proves it alive
+                        health.echo_token = None
+                        health.echo_sent = None
+            elif connection.direction == MessageDirection.Server:
+                if t - connection.last_received > 2 * self.echo_period + self.echo_timeout:
+                    self.declare_dead(connection)
+            elif t - connection.last_received >= self.echo_period:
+                health.echo_token = next(self.tokens) & 0xffffffff
+                health.echo_sent = t
+                # never block the shared scheduler on a stuck connection, a send that cannot proceed
+                # is left to the echo timeout like an unanswered request
+                try:
+                    connection.try_send(EchoMessage(struct.pack('I', health.echo_token),
+                                                    connection.direction).to_buffer())
+                except EnvironmentError:
+                    self.declare_dead(connection)
+
+    def declare_dead(self, connection):
+        connection.health.dead = True
+        self.unregister(connection)
+        connection.close()
+        for callback in self.dead_callbacks:
+            callback(connection)
+
+# singleton
+monitor = HealthMonitor()
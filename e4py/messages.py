@@ -4,9 +4,10 @@ import ipaddress
 import itertools
 import enum
 import sys
+import threading
 
 from . import constants
-from .data import DataObject, DataFlag
+from .data import ArrayFlag, DataObject, DataFlag, FieldEncoding
 
 if sys.hexversion < 0x03000000:
     def int_from_bytes(s, byteorder):
@@ -28,9 +29,12 @@ else:
 __all__ =['MessageHeader', 'BeaconMessage', 'SearchRequest', 'SearchResponse', 'ConnectionValidationRequest',
           'ConnectionValidationResponse', 'ConnectionValidatedResponse',
           'CreateChannelRequest', 'CreateChannelResponse',
-          'ChannelGetRequestInit', 'ChannelGetResponseInit',
-          'ApplicationMessageCode',
-          'BufferReader', 'ClientMessageDispatcher', 'ServerMessageDispatcher']
+          'ChannelRequestInit', 'ChannelResponseInit', 'ChannelRequest', 'ChannelResponse', 'DestroyRequest',
+          'DestroyChannelRequest',
+          'ChannelGetFieldRequest', 'ChannelGetFieldResponse', 'Subcommand', 'BitSet', 'PVRequest', 'Status',
+          'ControlMessage', 'EchoMessage',
+          'ApplicationMessageCode', 'ControlMessageCode',
+          'BufferReader', 'MessageDispatcher', 'ClientMessageDispatcher', 'ServerMessageDispatcher']
 
 
 class BufferWriter(object):
@@ -61,8 +65,7 @@ class BufferWriter(object):
 
     def put_integer_array(self, value):
         self._put_size(len(value))
-        for v in value:
-            self.put_integer(v)
+        self.buffer.extend(struct.pack('%dI' % len(value), *value))
 
     def put_string(self, value):
         self._put_size(len(value))
@@ -73,14 +76,34 @@ class BufferWriter(object):
         for v in value:
             self.put_string(v)
 
+    def put_value(self, code, value):
+        """
+        Append *value* packed with the struct format *code*.
+        """
+        self.buffer.extend(struct.pack(code, value))
+
+    def put_value_array(self, typecode, value):
+        """
+        Append a numeric array, an :class:`array.array` or NumPy array of matching type, or a sequence.
+        """
+        if not hasattr(value, 'tobytes') and not hasattr(value, 'tostring'):
+            value = array.array(typecode, value)
+        self._put_size(len(value))
+        if hasattr(value, 'tobytes'):
+            self.buffer.extend(value.tobytes())
+        else:
+            self.buffer.extend(value.tostring())
+
     def _put_size(self, size):
-        if size < 0xff:
+        if size < 0:
+            self.buffer.append(0xff)
+        elif size < 0xfe:
             self.buffer.append(size)
         elif size < 0x7fffffff:
-            self.buffer.append(255)
+            self.buffer.append(0xfe)
             self.buffer.extend(struct.pack('I', size))
         else:
-            self.buffer.append(255)
+            self.buffer.append(0xfe)
             self.buffer.extend(struct.pack('I', 0x7fffffff))
             self.buffer.extend(struct.pack('Q', size))
 
@@ -90,7 +113,9 @@ class BufferWriter(object):
 
 class BufferReader(object):
     """
-    Wrap read access to a bytes object
+    Wrap read access to a bytes-like object, e.g. bytes, a memoryview of a receive buffer or a mmap.
+
+    Values are unpacked in place, only strings and raw bytes are copied out of the source.
     """
     def __init__(self, source):
         self.source = source
@@ -109,7 +134,7 @@ class BufferReader(object):
         :param n: number of bytes to read
         :return:
         """
-        v = self.source[self.index:self.index + n]
+        v = bytes(self.source[self.index:self.index + n])
         self.index += n
         return v
 
@@ -121,42 +146,69 @@ class BufferReader(object):
         return v
 
     def get_short(self):
-        v = struct.unpack('H', self.source[self.index:self.index + 2])[0]
+        v = struct.unpack_from('H', self.source, self.index)[0]
         self.index += 2
         return v
 
     def get_integer(self):
-        v = struct.unpack('I', self.source[self.index:self.index + 4])[0]
+        v = struct.unpack_from('I', self.source, self.index)[0]
         self.index += 4
         return v
 
     def get_integer_array(self):
-        size = self._get_size()
-        v = struct.unpack('%dI'%size, self.source[self.index:self.index + 4*size])
+        size = max(self._get_size(), 0)
+        v = struct.unpack_from('%dI'%size, self.source, self.index)
         self.index += size*4
         return v
 
     def get_long(self):
-        v = struct.unpack('Q', self.source[self.index:self.index + 8])[0]
+        v = struct.unpack_from('Q', self.source, self.index)[0]
         self.index += 8
         return v
 
     def get_string(self):
-        size = self._get_size()
-        v = self.source[self.index:self.index + size]
+        size = max(self._get_size(), 0)
+        v = bytes(self.source[self.index:self.index + size])
         self.index += size
         return v
 
     def get_string_array(self):
-        size = self._get_size()
+        size = max(self._get_size(), 0)
         v = []
         for i in range(size):
             v.append(self.get_string())
         return v
 
+    def get_value(self, code, size):
+        """
+        Unpack a value of struct format *code* and *size* bytes.
+        """
+        v = struct.unpack_from(code, self.source, self.index)[0]
+        self.index += size
+        return v
+
+    def get_value_array(self, typecode, size):
+        """
+        Read a numeric array into an :class:`array.array` of *typecode* with elements of *size* bytes.
+        """
+        n = max(self._get_size(), 0)
+        v = array.array(typecode)
+        data = self.source[self.index:self.index + n * size]
+        if hasattr(v, 'frombytes'):
+            v.frombytes(data)
+        else:
+            v.fromstring(bytes(data))
+        self.index += n * size
+        return v
+
     def _get_size(self):
+        """
+        :return: size, -1 for null, which the readers above decode as empty
+        """
         size = self.get_byte()
-        if size == 255:
+        if size == 0xff:
+            return -1
+        if size == 0xfe:
             size = self.get_integer()
             if size == 2 ** 31 - 1:
                 size = self.get_long()
@@ -301,6 +353,173 @@ class Status(object):
         return '%s %s %s' % (self.type_, self.message, self.callTree)
 
 
+class BitSet(object):
+    """
+    Set of field offsets, kept as an integer bit mask.
+
+    Serialized as the Size of the byte array followed by the little endian bytes of the mask.
+    """
+    __slots__ = ('bits',)
+
+    def __init__(self, bits=0):
+        self.bits = bits
+
+    @staticmethod
+    def from_offsets(offsets):
+        bits = 0
+        for offset in offsets:
+            bits |= 1 << offset
+        return BitSet(bits)
+
+    @staticmethod
+    def from_buffer(buffer):
+        size = max(buffer._get_size(), 0)
+        return BitSet(int_from_bytes(buffer.get_raw(size), 'little'))
+
+    def to_buffer(self):
+        size = (self.bits.bit_length() + 7) // 8
+        buffer = BufferWriter()
+        buffer._put_size(size)
+        buffer.put_raw(int_to_bytes(self.bits, size, 'little'))
+        return buffer.get_buffer()
+
+    def set(self, offset):
+        self.bits |= 1 << offset
+
+    def get(self, offset):
+        return (self.bits >> offset) & 1
+
+    def clear(self):
+        self.bits = 0
+
+    def is_empty(self):
+        return self.bits == 0
+
+    def copy(self):
+        return BitSet(self.bits)
+
+    def __or__(self, other):
+        return BitSet(self.bits | other.bits)
+
+    def __and__(self, other):
+        return BitSet(self.bits & other.bits)
+
+    def __eq__(self, other):
+        return isinstance(other, BitSet) and self.bits == other.bits
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __iter__(self):
+        bits = self.bits
+        offset = 0
+        while bits:
+            if bits & 1:
+                yield offset
+            bits >>= 1
+            offset += 1
+
+    def __str__(self):
+        return '{%s}' % ', '.join(str(offset) for offset in self)
+
+
+class PVRequest(object):
+    """
+    Request options sent with INIT, a structure like
+
+        field
+            value
+            timeStamp
+        record
+            _options
+                queueSize = '4'
+
+    An empty field list requests the whole structure.
+    """
+    def __init__(self, type_=None, values=None):
+        self.type_ = type_
+        self.values = values
+
+    @staticmethod
+    def create(fields=(), options=None):
+        """
+        Build a request for the field *paths* with record *options*, {name: value}.
+        """
+        tree = {}
+        for path in fields:
+            node = tree
+            for name in path.split('.'):
+                node = node.setdefault(name, {})
+
+        def build(node):
+            return DataObject.structure(b'', [(name.encode(), build(sub)) for name, sub in node.items()])
+
+        top = [(b'field', build(tree))]
+        option_values = {}
+        if options:
+            option_fields = [(name.encode(), DataObject.scalar(DataFlag.String)) for name in options]
+            top.append((b'record', DataObject.structure(b'', [(b'_options', DataObject.structure(b'', option_fields))])))
+            option_values = {'record': {'_options': dict((name, _to_bytes(value)) for name, value in options.items())}}
+        type_ = DataObject.structure(b'', top)
+        return PVRequest(type_, type_.from_dict(option_values))
+
+    @staticmethod
+    def from_buffer(buffer):
+        type_ = DataObject.from_buffer(buffer)
+        values = None
+        if type_ is not None:
+            values = type_.decode(buffer)
+        return PVRequest(type_, values)
+
+    def to_buffer(self):
+        if self.type_ is None:
+            return bytearray([FieldEncoding.No])
+        buffer = BufferWriter()
+        buffer.put_raw(self.type_.to_buffer())
+        self.type_.encode(buffer, self.values)
+        return buffer.get_buffer()
+
+    def fields(self):
+        """
+        :return: requested field paths, empty for all fields
+        """
+        if self.type_ is None:
+            return []
+        try:
+            field = self.type_.field(b'field')
+        except KeyError:
+            return []
+        return [path.decode() for path, (offset, type_) in field.offsets().items()
+                if path and not type_.fields]
+
+    def options(self):
+        """
+        :return: record options, {name: value} with string values
+        """
+        if self.type_ is None:
+            return {}
+        try:
+            options = self.type_.field(b'record._options')
+        except KeyError:
+            return {}
+        offset = self.type_.field_offset(b'record._options')
+        result = {}
+        for key, value in options.to_dict(self.values, offset).items():
+            if isinstance(value, bytes):
+                value = value.decode()
+            result[key] = value
+        return result
+
+    def __str__(self):
+        return 'PVRequest fields %s options %s' % (self.fields(), self.options())
+
+
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode()
+
+
 class MessageHeader(object):
     """
     Each protocol message has a fixed 8-byte header
@@ -326,6 +545,20 @@ class MessageHeader(object):
         """
         return self.magic == constants.PVA_MAGIC
 
+    def is_control(self):
+        """
+        True for control messages. Their payloadSize field carries a value and no payload follows the header.
+        """
+        return self.flags.type_ == MessageType.Control
+
+    def message_size(self):
+        """
+        Number of bytes the message occupies on the wire, header included.
+        """
+        if self.is_control():
+            return constants.PVA_MESSAGE_HEADER_SIZE
+        return constants.PVA_MESSAGE_HEADER_SIZE + self.payloadSize
+
     @staticmethod
     def from_buffer(buffer):
         magic, version, flags, messageCommand, payloadSize = struct.unpack('BBBBI', buffer.get_raw(8))
@@ -333,7 +566,7 @@ class MessageHeader(object):
         if flags.type_ == MessageType.Application:
             messageCommand = ApplicationMessageCode(messageCommand)
         else:
-            messageCommand = ApplicationMessageCode(messageCommand)
+            messageCommand = ControlMessageCode(messageCommand)
 
         return MessageHeader(magic, version, flags, messageCommand, payloadSize)
 
@@ -351,6 +584,48 @@ class MessageHeader(object):
             (self.magic, self.version, str(self.flags), self.messageCommand, self.payloadSize)
 
 
+class ControlMessage(object):
+    """
+    Header-only message with a :class:`ControlMessageCode`. The payloadSize field carries *value*.
+    """
+    def __init__(self, code, value=0, direction=MessageDirection.Client):
+        self.code = code
+        self.value = value
+        self.direction = direction
+
+    @staticmethod
+    def from_header(header):
+        return ControlMessage(header.messageCommand, header.payloadSize, header.flags.direction)
+
+    def to_buffer(self):
+        header = MessageHeader(
+            flags=HeaderFlag(type=MessageType.Control, direction=self.direction),
+            messageCommand=self.code,
+            payloadSize=self.value & 0xffffffff
+        )
+        return header.to_buffer()
+
+    def __str__(self):
+        return 'ControlMessage %s %d\n' % (self.code, self.value)
+
+
+class EchoMessage(object):
+    """
+    Application echo, the receiver sends the payload back unchanged.
+    """
+    def __init__(self, payload=b'', direction=MessageDirection.Client):
+        self.payload = payload
+        self.direction = direction
+
+    def to_buffer(self):
+        header = MessageHeader(
+            flags=HeaderFlag(direction=self.direction),
+            messageCommand=ApplicationMessageCode.Echo,
+            payloadSize=len(self.payload)
+        )
+        return header.to_buffer() + self.payload
+
+
 class BeaconMessage(object):
     def __init__(self, *args):
         self.guid, self.flags, self.sequenceId, self.changeCount, self.serverAddress, self.serverPort, self.protocol = args
@@ -379,6 +654,24 @@ class BeaconMessage(object):
      
         return message
 
+    def to_buffer(self):
+        header = MessageHeader(
+            flags=HeaderFlag(direction=MessageDirection.Server),
+            messageCommand=ApplicationMessageCode.Beacon
+        )
+
+        buffer = BufferWriter()
+        buffer.put_raw(int_to_bytes(self.guid, 12, 'little'))
+        buffer.put_raw(struct.pack('BBH', self.flags, self.sequenceId, self.changeCount))
+        buffer.put_raw(ipaddress.ip_address(self.serverAddress).packed)
+        buffer.put_short(self.serverPort)
+        buffer.put_string(self.protocol)
+        # no server status
+        buffer.put_byte(TypeCode.NULL)
+
+        header.payloadSize = len(buffer)
+        return header.to_buffer() + buffer.get_buffer()
+
     def __str__(self):
         return \
             'BeaconMessage\n'\
@@ -502,7 +795,6 @@ class SearchResponse(object):
         buffer.put_integer_array(self.instanceIds)
 
         header.payloadSize = len(buffer)
-        print(header)
         return header.to_buffer() + buffer.get_buffer()
 
     def __str__(self):
@@ -726,49 +1018,313 @@ class CreateChannelResponse(object):
             '  accessRights:    %d\n' % (self.clientChannelID, self.serverChannelID, self.status, self.accessRights)
 
 
-class ChannelGetRequestInit(object):
-    def __init__(self, *args):
-        self.serverChannelID, self.requestID = args
-        self.subcommand = 0x08
-
+class Subcommand(object):
+    """
+    Subcommand bits of channel requests.
+    """
+    Default = 0x00
+    Process = 0x04
+    Init = 0x08
+    Destroy = 0x10
+    Get = 0x40
+    GetPut = 0x80
+    # monitor
+    Start = 0x44
+    Stop = 0x04
+    Pipeline = 0x80
+    # array
+    SetLength = 0x80
+    GetLength = 0x04
+
+
+class ChannelRequestInit(object):
+    """
+    INIT of a get, put, put-get, monitor, array or RPC request.
+
+    struct channelRequestInit {
+        int serverChannelID;
+        int requestID;
+        byte subcommand = 0x08;
+        PVRequest pvRequest;
+        int queueSize;  // monitor with pipeline bit only
+    };
+    """
+    def __init__(self, command, serverChannelID, requestID, pvRequest, queueSize=0):
+        self.command = command
+        self.serverChannelID = serverChannelID
+        self.requestID = requestID
+        self.pvRequest = pvRequest
+        self.queueSize = queueSize
 
     @staticmethod
-    def from_buffer(buffer):
+    def from_buffer(buffer, command=ApplicationMessageCode.ChannelGet):
         """
-        Create ChannelGetRequestInit from *buffer*
+        Create ChannelRequestInit from *buffer*
 
         :param :class:`BufferReader` buffer:
-        :return: :class:`ChannelGetRequestInit` instance
+        :param command: :class:`ApplicationMessageCode` of the message
+        :return: :class:`ChannelRequestInit` instance
         """
         serverChannelID = buffer.get_integer()
         requestID = buffer.get_integer()
         subcommand = buffer.get_byte()
+        pvRequest = PVRequest.from_buffer(buffer)
+        queueSize = 0
+        if command == ApplicationMessageCode.ChannelMonitor and subcommand & Subcommand.Pipeline:
+            queueSize = buffer.get_integer()
 
+        return ChannelRequestInit(command, serverChannelID, requestID, pvRequest, queueSize)
 
     def to_buffer(self):
-        pass
+        header = MessageHeader(
+            messageCommand=self.command
+        )
+        subcommand = Subcommand.Init
+        if self.queueSize:
+            subcommand |= Subcommand.Pipeline
+        buffer = BufferWriter()
+        buffer.put_integer(self.serverChannelID)
+        buffer.put_integer(self.requestID)
+        buffer.put_byte(subcommand)
+        buffer.put_raw(self.pvRequest.to_buffer())
+        if self.queueSize:
+            buffer.put_integer(self.queueSize)
 
+        header.payloadSize = len(buffer)
+        return header.to_buffer() + buffer.get_buffer()
 
-class ChannelGetResponseInit(object):
-    def __init__(self, *args):
-        self.requestID, self.subcommand, self.status = args
+    def __str__(self):
+        return \
+            'ChannelRequestInit\n'\
+            '  command:         %s\n'\
+            '  serverChannelID: %d\n'\
+            '  requestID:       %d\n'\
+            '  pvRequest:       %s\n' % (self.command, self.serverChannelID, self.requestID, self.pvRequest)
+
+
+class ChannelResponseInit(object):
+    """
+    Response to :class:`ChannelRequestInit` with the introspection data of the request,
+    two types for put-get (put, get), none for RPC.
+    """
+    def __init__(self, command, requestID, status, types):
+        self.command = command
+        self.requestID = requestID
+        self.status = status
+        self.types = types
 
     @staticmethod
-    def from_buffer(buffer):
+    def from_buffer(buffer, command=ApplicationMessageCode.ChannelGet):
         """
-        Create ChannelGetRequestInit from *buffer*
+        Create ChannelResponseInit from *buffer*
 
         :param :class:`BufferReader` buffer:
-        :return: :class:`ChannelGetRequestInit` instance
+        :param command: :class:`ApplicationMessageCode` of the message
+        :return: :class:`ChannelResponseInit` instance
         """
         requestID = buffer.get_integer()
         subcommand = buffer.get_byte()
         status = Status.from_buffer(buffer)
+        types = []
+        if status.is_ok() and command != ApplicationMessageCode.ChannelRPC:
+            types.append(DataObject.from_buffer(buffer))
+            if command == ApplicationMessageCode.ChannelPutGet:
+                types.append(DataObject.from_buffer(buffer))
 
-        return ChannelGetResponseInit(requestID, subcommand, status)
+        return ChannelResponseInit(command, requestID, status, types)
 
     def to_buffer(self):
-        pass
+        header = MessageHeader(
+            flags=HeaderFlag(direction=MessageDirection.Server),
+            messageCommand=self.command
+        )
+        buffer = BufferWriter()
+        buffer.put_integer(self.requestID)
+        buffer.put_byte(Subcommand.Init)
+        buffer.put_raw(self.status.to_buffer())
+        if self.status.is_ok():
+            for type_ in self.types:
+                buffer.put_raw(type_.to_buffer())
+
+        header.payloadSize = len(buffer)
+        return header.to_buffer() + buffer.get_buffer()
+
+    def __str__(self):
+        return \
+            'ChannelResponseInit\n'\
+            '  command:   %s\n'\
+            '  requestID: %d\n'\
+            '  status:    %s\n' % (self.command, self.requestID, self.status)
+
+
+class ChannelRequest(object):
+    """
+    Any channel request after INIT. The subcommand dependant body follows the fixed part.
+
+    struct channelRequest {
+        int serverChannelID;
+        int requestID;
+        byte subcommand;
+        // body
+    };
+    """
+    def __init__(self, command, serverChannelID, requestID, subcommand, body=b''):
+        self.command = command
+        self.serverChannelID = serverChannelID
+        self.requestID = requestID
+        self.subcommand = subcommand
+        self.body = body
+
+    @staticmethod
+    def from_buffer(buffer, command=ApplicationMessageCode.ChannelGet):
+        """
+        Create ChannelRequest from *buffer*. The body is left in the buffer.
+
+        :param :class:`BufferReader` buffer:
+        :param command: :class:`ApplicationMessageCode` of the message
+        :return: :class:`ChannelRequest` instance
+        """
+        serverChannelID = buffer.get_integer()
+        requestID = buffer.get_integer()
+        subcommand = buffer.get_byte()
+        return ChannelRequest(command, serverChannelID, requestID, subcommand)
+
+    def to_buffer(self):
+        header = MessageHeader(
+            messageCommand=self.command,
+            payloadSize=9 + len(self.body)
+        )
+        return header.to_buffer() + struct.pack('IIB', self.serverChannelID, self.requestID, self.subcommand) + \
+            self.body
+
+    def __str__(self):
+        return \
+            'ChannelRequest\n'\
+            '  command:         %s\n'\
+            '  serverChannelID: %d\n'\
+            '  requestID:       %d\n'\
+            '  subcommand:      %x\n' % (self.command, self.serverChannelID, self.requestID, self.subcommand)
+
+
+class ChannelResponse(object):
+    """
+    Any channel response after INIT. The subcommand dependant body follows the status if it is OK.
+
+    struct channelResponse {
+        int requestID;
+        byte subcommand;
+        Status status;
+        // body
+    };
+    """
+    def __init__(self, command, requestID, subcommand, status=Status(), body=b''):
+        self.command = command
+        self.requestID = requestID
+        self.subcommand = subcommand
+        self.status = status
+        self.body = body
+
+    @staticmethod
+    def from_buffer(buffer, command=ApplicationMessageCode.ChannelGet):
+        """
+        Create ChannelResponse from *buffer*. The body is left in the buffer.
+
+        :param :class:`BufferReader` buffer:
+        :param command: :class:`ApplicationMessageCode` of the message
+        :return: :class:`ChannelResponse` instance
+        """
+        requestID = buffer.get_integer()
+        subcommand = buffer.get_byte()
+        if command == ApplicationMessageCode.ChannelMonitor:
+            # monitor updates carry no status
+            return ChannelResponse(command, requestID, subcommand)
+        status = Status.from_buffer(buffer)
+        return ChannelResponse(command, requestID, subcommand, status)
+
+    def prefix(self):
+        """
+        Header and fixed part of the message, the body is to be sent right after it.
+        """
+        status = b''
+        if self.command != ApplicationMessageCode.ChannelMonitor:
+            status = self.status.to_buffer()
+        header = MessageHeader(
+            flags=HeaderFlag(direction=MessageDirection.Server),
+            messageCommand=self.command,
+            payloadSize=5 + len(status) + len(self.body)
+        )
+        return header.to_buffer() + struct.pack('IB', self.requestID, self.subcommand) + status
+
+    def to_buffer(self):
+        return self.prefix() + self.body
+
+    def __str__(self):
+        return \
+            'ChannelResponse\n'\
+            '  command:    %s\n'\
+            '  requestID:  %d\n'\
+            '  subcommand: %x\n'\
+            '  status:     %s\n' % (self.command, self.requestID, self.subcommand, self.status)
+
+
+class DestroyChannelRequest(object):
+    """
+    Destroy a channel (0x08), the server answers with the same message.
+    """
+    def __init__(self, serverChannelID, clientChannelID, direction=MessageDirection.Client):
+        self.serverChannelID = serverChannelID
+        self.clientChannelID = clientChannelID
+        self.direction = direction
+
+    @staticmethod
+    def from_buffer(buffer):
+        serverChannelID = buffer.get_integer()
+        clientChannelID = buffer.get_integer()
+        return DestroyChannelRequest(serverChannelID, clientChannelID)
+
+    def to_buffer(self):
+        header = MessageHeader(
+            flags=HeaderFlag(direction=self.direction),
+            messageCommand=ApplicationMessageCode.DestroyChannel,
+            payloadSize=8
+        )
+        return header.to_buffer() + struct.pack('II', self.serverChannelID, self.clientChannelID)
+
+    def __str__(self):
+        return \
+            'DestroyChannelRequest\n'\
+            '  serverChannelID: %d\n'\
+            '  clientChannelID: %d\n' % (self.serverChannelID, self.clientChannelID)
+
+
+class DestroyRequest(object):
+    """
+    Destroy (0x0F) or cancel (0x15) a channel request.
+    """
+    def __init__(self, serverChannelID, requestID, command=ApplicationMessageCode.DestroyRequest):
+        self.serverChannelID = serverChannelID
+        self.requestID = requestID
+        self.command = command
+
+    @staticmethod
+    def from_buffer(buffer, command=ApplicationMessageCode.DestroyRequest):
+        serverChannelID = buffer.get_integer()
+        requestID = buffer.get_integer()
+        return DestroyRequest(serverChannelID, requestID, command)
+
+    def to_buffer(self):
+        header = MessageHeader(
+            messageCommand=self.command,
+            payloadSize=8
+        )
+        return header.to_buffer() + struct.pack('II', self.serverChannelID, self.requestID)
+
+    def __str__(self):
+        return \
+            'DestroyRequest\n'\
+            '  command:         %s\n'\
+            '  serverChannelID: %d\n'\
+            '  requestID:       %d\n' % (self.command, self.serverChannelID, self.requestID)
 
 
 class ChannelGetFieldRequest(object):
@@ -791,7 +1347,6 @@ class ChannelGetFieldRequest(object):
 
     def to_buffer(self):
         header = MessageHeader(
-            flags=HeaderFlag(direction=MessageDirection.Server),
             messageCommand=ApplicationMessageCode.ChannelIF
         )
         buffer = BufferWriter()
@@ -831,11 +1386,18 @@ class ChannelGetFieldResponse(object):
         return ChannelGetFieldResponse(requestID, status, object_)
 
     def to_buffer(self):
+        header = MessageHeader(
+            flags=HeaderFlag(direction=MessageDirection.Server),
+            messageCommand=ApplicationMessageCode.ChannelIF
+        )
         buffer = BufferWriter()
         buffer.put_integer(self.requestID)
         buffer.put_raw(self.status.to_buffer())
-        buffer.put_raw(self.subFieldIF.to_buffer())
-        return buffer.get_buffer()
+        if self.subFieldIF is not None:
+            buffer.put_raw(self.subFieldIF.to_buffer())
+
+        header.payloadSize = len(buffer)
+        return header.to_buffer() + buffer.get_buffer()
 
     def __str__(self):
         return \
@@ -846,10 +1408,15 @@ class ChannelGetFieldResponse(object):
             % (self.requestID, self.status, self.subFieldIF)
 
 
-class ClientMessageDispatcher(object):
+class MessageDispatcher(object):
+    """
+    Split received data into messages.
 
-    def __init__(self, tranport):
-        self.transport = tranport
+    Control messages are handed to the transport, application messages to :meth:`message_received`
+    with the buffer positioned at the payload.
+    """
+    def __init__(self, transport):
+        self.transport = transport
         self.pending = False
 
     def data_received(self, data):
@@ -860,91 +1427,476 @@ class ClientMessageDispatcher(object):
                 return -1
 
             header = MessageHeader.from_buffer(buffer)
-            print(header)
+            if header.is_control():
+                self.transport.control_received(header)
+                continue
 
             if len(buffer) < header.payloadSize:
                 return -1
 
-            if header.messageCommand == ApplicationMessageCode.ConnectionValidation:
-                request = ConnectionValidationRequest.from_buffer(buffer)
-                print(request)
-
-                response = ConnectionValidationResponse(request.serverReceiverBufferSize,
-                                                        request.serverIntrospectionRegistryMaxSize,
-                                                        0,
-                                                        b'')
-                self.send_data(response.to_buffer())
-                self.pending = True
-            elif header.messageCommand == ApplicationMessageCode.ConnectionValidated:
-                response = ConnectionValidatedResponse.from_buffer(buffer)
-                print(response)
-
-                request = CreateChannelRequest([(1, b'testMP')])
-                self.send_data(request.to_buffer())
-                self.pending = True
-            elif header.messageCommand == ApplicationMessageCode.CreateChannel:
-                response = CreateChannelResponse.from_buffer(buffer)
-                print(response)
-
-                request = ChannelGetFieldRequest(response.serverChannelID, 1, b'')
-                self.send_data(request.to_buffer())
-                self.pending = True
-            elif header.messageCommand == ApplicationMessageCode.ChannelIF:
-                response = ChannelGetFieldResponse.from_buffer(buffer)
-                print(response)
-                #fieldDesc = buffer.get_raw(header.payloadSize - 5)
-                #object_ = DataObject.from_buffer(BufferReader(fieldDesc))
-                #print(object_)
-                #print(fieldDesc)
-                #print(fieldDesc.encode('hex'))
-                self.pending = False
+            end = buffer.index + header.payloadSize
+            if header.messageCommand == ApplicationMessageCode.Echo:
+                self.echo_received(header, buffer)
             else:
-                buffer.skip_bytes(header.payloadSize)
+                self.message_received(header, buffer)
+            buffer.index = end
 
         return self.pending
 
+    def message_received(self, header, buffer):
+        """
+        Handle an application message, *buffer* is positioned at the payload. Ignored by default.
+        """
+        pass
+
+    def connection_lost(self):
+        """
+        Called when the transport is closed, to release resources held for the peer.
+        """
+        pass
+
+    def echo_received(self, header, buffer):
+        """
+        Servers answer echo requests with the same payload, clients pass the response to the transport.
+        """
+        payload = buffer.get_raw(header.payloadSize)
+        if self.transport.direction == MessageDirection.Server:
+            self.send_data(EchoMessage(payload, MessageDirection.Server).to_buffer())
+        elif len(payload) == 4:
+            self.transport.echo_received(struct.unpack('I', payload)[0])
+
     def send_data(self, data):
         self.transport.send(data)
 
 
-class ServerMessageDispatcher(object):
+class ClientMessageDispatcher(MessageDispatcher):
+    """
+    Print the introspection of channel *name*. With an *introspection* cache, such as
+    :class:`e4py.client.IntrospectionCache`, it is only asked for once per server *key* (guid, host, port).
+    """
+    def __init__(self, transport, name=b'testMP', introspection=None, key=None):
+        MessageDispatcher.__init__(self, transport)
+        self.request_ids = itertools.count(1)
+        self.name = name
+        self.introspection = introspection
+        self.key = key
+        # requestID -> channel name of the ChannelGetField requests sent
+        self.names = {}
+
+    def message_received(self, header, buffer):
+        if header.messageCommand == ApplicationMessageCode.ConnectionValidation:
+            request = ConnectionValidationRequest.from_buffer(buffer)
+            print(request)
+
+            self.transport.set_send_buffer_size(request.serverReceiverBufferSize)
+            response = ConnectionValidationResponse(self.transport.receive_buffer_size,
+                                                    request.serverIntrospectionRegistryMaxSize,
+                                                    0,
+                                                    b'')
+            self.send_data(response.to_buffer())
+            self.pending = True
+        elif header.messageCommand == ApplicationMessageCode.ConnectionValidated:
+            response = ConnectionValidatedResponse.from_buffer(buffer)
+            print(response)
+
+            request = CreateChannelRequest([(1, self.name)])
+            self.send_data(request.to_buffer())
+            self.pending = True
+        elif header.messageCommand == ApplicationMessageCode.CreateChannel:
+            response = CreateChannelResponse.from_buffer(buffer)
+            print(response)
+
+            cached = None
+            if self.introspection is not None:
+                cached = self.introspection.get(self.key, self.name, b'')
+            if cached is not None:
+                print(cached)
+                self.pending = False
+                return
+            requestID = next(self.request_ids)
+            self.names[requestID] = self.name
+            request = ChannelGetFieldRequest(response.serverChannelID, requestID, b'')
+            self.send_data(request.to_buffer())
+            self.pending = True
+        elif header.messageCommand == ApplicationMessageCode.ChannelIF:
+            response = ChannelGetFieldResponse.from_buffer(buffer)
+            print(response)
+            name = self.names.pop(response.requestID, None)
+            if self.introspection is not None and name is not None and response.status.is_ok():
+                self.introspection.put(self.key, name, b'', response.subFieldIF)
+            #fieldDesc = buffer.get_raw(header.payloadSize - 5)
+            #object_ = DataObject.from_buffer(BufferReader(fieldDesc))
+            #print(object_)
+            #print(fieldDesc)
+            #print(fieldDesc.encode('hex'))
+            self.pending = False
+
+
+# rough bytes taken by the table entries of a channel, besides its name, and of a request
+_CHANNEL_BYTES = 512
+_REQUEST_BYTES = 256
+
+
+class ServerMessageDispatcher(MessageDispatcher):
+    """
+    Serve channels from *database*, a :class:`e4py.database.Database`.
+    Without a database every channel name is accepted and nothing is served.
 
-    def __init__(self, transport):
-        self.transport = transport
-        self.pending = False
+    A connection holds at most *max_channels* channels and *max_requests* requests, further ones are refused
+    with an error status. Destroying a channel destroys its requests, so clients that keep creating and
+    destroying channels do not grow the tables. :attr:`memory` estimates the bytes they take.
 
-    def data_received(self, data):
-        buffer = BufferReader(data)
+    A database with ``get_async(name, callback)``, such as the gateway's, answers CreateChannel once
+    *callback(record)* is called, records with ``put_async(values, bitset, callback)`` answer puts with the
+    *callback(status)* they report. Channels of a record with ``add_lost_callback`` are destroyed towards the
+    client when the record is lost. The tables are guarded by :attr:`lock` against these callbacks.
+    """
+    def __init__(self, transport, database=None, max_channels=constants.PVA_MAX_CHANNELS,
+                 max_requests=constants.PVA_MAX_REQUESTS):
+        MessageDispatcher.__init__(self, transport)
+        self.database = database
+        self.max_channels = max_channels
+        self.max_requests = max_requests
+        # serverChannelID -> record
+        self.channels = {}
+        # serverChannelID -> (clientChannelID, name, requestIDs)
+        self.channel_state = {}
+        # clientChannelID -> serverChannelID
+        self.client_ids = {}
+        self.channel_ids = itertools.count(1)
+        # requestID -> (command, record, monitor, offset of the array field of a ChannelArray, serverChannelID)
+        self.requests = {}
+        self.memory = 0
+        # requestID -> token of the RPC call running, the response of a cancelled or replaced call is dropped
+        self.calls = {}
+        self.lock = threading.RLock()
+        self.lost = False
+
+    def message_received(self, header, buffer):
+        with self.lock:
+            self._message_received(header, buffer)
+
+    def _message_received(self, header, buffer):
+        if header.messageCommand == ApplicationMessageCode.ConnectionValidation:
+            response = ConnectionValidationResponse.from_buffer(buffer)
+            self.transport.set_send_buffer_size(response.clientReceiveBufferSize)
+
+            response = ConnectionValidatedResponse()
+            self.send_data(response.to_buffer())
+            self.pending = True
+        elif header.messageCommand == ApplicationMessageCode.CreateChannel:
+            request = CreateChannelRequest.from_buffer(buffer)
+            for id_, name in request.channels:
+                if self.database is None:
+                    response = CreateChannelResponse(id_, id_, Status(), 0)
+                elif hasattr(self.database, 'get_async'):
+                    self.database.get_async(name, lambda record, id_=id_, name=name:
+                                            self.channel_found(id_, name, record))
+                    continue
+                else:
+                    response = self.create_channel(id_, name)
+                self.send_data(response.to_buffer())
+        elif header.messageCommand == ApplicationMessageCode.DestroyChannel:
+            request = DestroyChannelRequest.from_buffer(buffer)
+            self.destroy_channel(request.serverChannelID)
+            response = DestroyChannelRequest(request.serverChannelID, request.clientChannelID, MessageDirection.Server)
+            self.send_data(response.to_buffer())
+        elif header.messageCommand == ApplicationMessageCode.ChannelIF:
+            request = ChannelGetFieldRequest.from_buffer(buffer)
+            record = self.channels.get(request.serverChannelID)
+            if record is None:
+                response = ChannelGetFieldResponse(request.requestID, Status(StatusType.ERROR, b'no such channel'), None)
+            else:
+                try:
+                    response = ChannelGetFieldResponse(request.requestID, Status(),
+                                                       record.type_.field(request.subFieldName))
+                except KeyError:
+                    response = ChannelGetFieldResponse(request.requestID, Status(StatusType.ERROR, b'no such field'), None)
+            self.send_data(response.to_buffer())
+        elif header.messageCommand in (ApplicationMessageCode.ChannelGet, ApplicationMessageCode.ChannelPut,
+                                       ApplicationMessageCode.ChannelPutGet, ApplicationMessageCode.ChannelMonitor,
+                                       ApplicationMessageCode.ChannelArray, ApplicationMessageCode.ChannelRPC):
+            if struct.unpack_from('B', buffer.source, buffer.index + 8)[0] & Subcommand.Init:
+                self.request_init(header.messageCommand, ChannelRequestInit.from_buffer(buffer, header.messageCommand))
+            else:
+                self.request(ChannelRequest.from_buffer(buffer, header.messageCommand), buffer)
+        elif header.messageCommand == ApplicationMessageCode.DestroyRequest:
+            request = DestroyRequest.from_buffer(buffer)
+            self.destroy_request(request.requestID)
+        elif header.messageCommand == ApplicationMessageCode.CancelRequest:
+            request = DestroyRequest.from_buffer(buffer, ApplicationMessageCode.CancelRequest)
+            self.cancel_request(request.requestID)
+
+    def request_init(self, command, request):
+        record = self.channels.get(request.serverChannelID)
+        if record is None:
+            status = Status(StatusType.ERROR, b'no such channel')
+            types = []
+        elif request.requestID not in self.requests and len(self.requests) >= self.max_requests:
+            status = Status(StatusType.ERROR, b'too many requests')
+            types = []
+        else:
+            status = Status()
+            types = [record.type_]
+            monitor = None
+            offset = None
+            service = hasattr(record, 'call')
+            if service != (command == ApplicationMessageCode.ChannelRPC):
+                status = Status(StatusType.ERROR, b'channel supports RPC only' if service else
+                                b'channel does not support RPC')
+                types = []
+            elif command == ApplicationMessageCode.ChannelRPC:
+                types = []
+            elif command == ApplicationMessageCode.ChannelPutGet:
+                types = [record.type_, record.type_]
+            elif command == ApplicationMessageCode.ChannelArray:
+                fields = request.pvRequest.fields()
+                try:
+                    offset = record.type_.field_offset(fields[0] if fields else b'value')
+                    field = record.type_.field_at(offset)
+                    if field.type_.array_flag == ArrayFlag.Scalar:
+                        raise KeyError(field)
+                    types = [field]
+                except KeyError:
+                    status = Status(StatusType.ERROR, b'no such array field')
+                    types = []
+            elif command == ApplicationMessageCode.ChannelMonitor:
+                try:
+                    monitor = record.create_monitor(self.transport, request.requestID, request.pvRequest.options())
+                except ValueError as e:
+                    status = Status(StatusType.ERROR, str(e).encode())
+                    types = []
+            if status.is_ok():
+                self.destroy_request(request.requestID)
+                self.requests[request.requestID] = (command, record, monitor, offset, request.serverChannelID)
+                self.channel_state[request.serverChannelID][2].add(request.requestID)
+                self.memory += _REQUEST_BYTES
+        self.send_data(ChannelResponseInit(command, request.requestID, status, types).to_buffer())
+
+    def request(self, request, buffer):
+        state = self.requests.get(request.requestID)
+        if state is None:
+            if request.command != ApplicationMessageCode.ChannelMonitor:
+                response = ChannelResponse(request.command, request.requestID, request.subcommand,
+                                           Status(StatusType.ERROR, b'no such request'))
+                self.send_data(response.to_buffer())
+            return
+
+        command, record, monitor, offset, serverChannelID = state
+        status = Status()
+        body = BufferWriter()
+        if command == ApplicationMessageCode.ChannelRPC:
+            type_ = DataObject.from_buffer(buffer)
+            values = type_.decode(buffer) if type_ is not None else None
+            # registered before a destroy, which releases the request but leaves the call to finish
+            token = self.calls[request.requestID] = object()
+            if request.subcommand & Subcommand.Destroy:
+                self.destroy_request(request.requestID)
+            record.call(type_, values, lambda status, type_, values:
+                        self.rpc_done(request.requestID, token, request.subcommand, status, type_, values))
+            return
+        elif command == ApplicationMessageCode.ChannelArray:
+            status = self.array_request(request, buffer, record, offset, body)
+        elif command == ApplicationMessageCode.ChannelGet:
+            body.put_raw(BitSet(1).to_buffer())
+            record.encode(body)
+        elif command in (ApplicationMessageCode.ChannelPut, ApplicationMessageCode.ChannelPutGet):
+            if not request.subcommand & (Subcommand.Get | Subcommand.GetPut):
+                bitset = BitSet.from_buffer(buffer)
+                values = record.type_.decode(buffer, bitset=bitset)
+                if hasattr(record, 'put_async'):
+                    if request.subcommand & Subcommand.Destroy:
+                        self.destroy_request(request.requestID)
+                    record.put_async(values, bitset, lambda status:
+                                     self.put_done(command, request.requestID, request.subcommand, record, status))
+                    return
+                record.put(values, bitset)
+            # put-get reads back after the put, put and put-get structures are the record's
+            if request.subcommand & (Subcommand.Get | Subcommand.GetPut) or \
+                    command == ApplicationMessageCode.ChannelPutGet:
+                body.put_raw(BitSet(1).to_buffer())
+                record.encode(body)
+        elif command == ApplicationMessageCode.ChannelMonitor:
+            if request.subcommand & Subcommand.Start == Subcommand.Start:
+                monitor.start()
+            elif request.subcommand & Subcommand.Stop:
+                monitor.stop()
+
+        if command != ApplicationMessageCode.ChannelMonitor:
+            response = ChannelResponse(command, request.requestID, request.subcommand, status, body.get_buffer())
+            self.send_data(response.to_buffer())
+        if request.subcommand & Subcommand.Destroy:
+            self.destroy_request(request.requestID)
+
+    def array_request(self, request, buffer, record, offset, body):
+        """
+        Get (offset, count, stride), put (offset, stride, elements), set length or get length of the array field
+        at *offset*.
 
-        while len(buffer) > 0:
-            if len(buffer) < constants.PVA_MESSAGE_HEADER_SIZE:
-                return -1
+        :return: :class:`Status` of the response, *body* filled for get and get length
+        """
+        field = record.type_.field_at(offset)
+        try:
+            if request.subcommand & Subcommand.Get:
+                start, count, stride = buffer._get_size(), buffer._get_size(), buffer._get_size()
+                field.put_value(body, record.get_array(offset, start, count, stride))
+            elif request.subcommand & Subcommand.SetLength:
+                record.set_array_length(offset, buffer._get_size())
+            elif request.subcommand & Subcommand.GetLength:
+                body._put_size(len(record.get_array(offset)))
+            else:
+                start, stride = buffer._get_size(), buffer._get_size()
+                record.put_array(offset, field.get_value(buffer), start, stride)
+        except ValueError as e:
+            return Status(StatusType.ERROR, str(e).encode())
+        return Status()
 
-            header = MessageHeader.from_buffer(buffer)
-            print(header)
+    def rpc_done(self, requestID, token, subcommand, status, type_, values):
+        """
+        Send the result of the RPC call *token*, from the thread that ran it.
+        """
+        body = BufferWriter()
+        if status.is_ok():
+            body.put_raw(type_.to_buffer())
+            type_.encode(body, values)
+        response = ChannelResponse(ApplicationMessageCode.ChannelRPC, requestID, subcommand, status,
+                                   bytes(body.get_buffer()))
+        with self.lock:
+            if self.calls.get(requestID) is not token:
+                # cancelled, or the connection is lost
+                return
+            del self.calls[requestID]
+            try:
+                self.send_data(response.to_buffer())
+            except EnvironmentError:
+                # the client is gone
+                pass
 
-            if len(buffer) < header.payloadSize:
-                return -1
+    def put_done(self, command, requestID, subcommand, record, status):
+        """
+        Answer a put handed to ``record.put_async`` with its *status*, from the thread that reports it.
+        """
+        body = BufferWriter()
+        if status.is_ok() and command == ApplicationMessageCode.ChannelPutGet:
+            body.put_raw(BitSet(1).to_buffer())
+            record.encode(body)
+        response = ChannelResponse(command, requestID, subcommand, status, body.get_buffer())
+        with self.lock:
+            if self.lost:
+                return
+            try:
+                self.send_data(response.to_buffer())
+            except EnvironmentError:
+                # the client is gone
+                pass
 
-            if header.messageCommand == ApplicationMessageCode.ConnectionValidation:
-                response = ConnectionValidationResponse.from_buffer(buffer)
-                print(response)
+    def create_channel(self, clientChannelID, name):
+        """
+        :return: :class:`CreateChannelResponse` for channel *name*, created again if the client reuses its ID
+        """
+        return self.add_channel(clientChannelID, name, self.database.get(name))
 
-                response = ConnectionValidatedResponse()
+    def channel_found(self, clientChannelID, name, record):
+        """
+        Answer a CreateChannel looked up with ``database.get_async``, from the thread that found *record*.
+        """
+        with self.lock:
+            if self.lost:
+                return
+            response = self.add_channel(clientChannelID, name, record)
+            try:
                 self.send_data(response.to_buffer())
-                self.pending = True
-            elif header.messageCommand == ApplicationMessageCode.CreateChannel:
-                request = CreateChannelRequest.from_buffer(buffer)
-                print(request)
-
-                for id_, name in request.channels:
-                    response = CreateChannelResponse(id_, id_, Status(), 0)
-                    self.send_data(response.to_buffer())
-            elif header.messageCommand == ApplicationMessageCode.ChannelIF:
-                request = ChannelGetFieldRequest.from_buffer(buffer)
-                print(request)
-            else:
-                buffer.skip_bytes(header.payloadSize)
+            except EnvironmentError:
+                pass
 
-    def send_data(self, data):
-        self.transport.send(data)
\ No newline at end of file
+    def add_channel(self, clientChannelID, name, record):
+        """
+        :param record: what *name* refers to, None if not found
+        :return: :class:`CreateChannelResponse`
+        """
+        if record is None:
+            return CreateChannelResponse(clientChannelID, 0, Status(StatusType.ERROR, b'channel not found'), 0)
+        previous = self.client_ids.get(clientChannelID)
+        if previous is not None:
+            self.destroy_channel(previous)
+        if len(self.channels) >= self.max_channels:
+            return CreateChannelResponse(clientChannelID, 0, Status(StatusType.ERROR, b'too many channels'), 0)
+        serverChannelID = next(self.channel_ids) & 0xffffffff
+        while not serverChannelID or serverChannelID in self.channels:
+            serverChannelID = next(self.channel_ids) & 0xffffffff
+        self.channels[serverChannelID] = record
+        self.channel_state[serverChannelID] = (clientChannelID, name, set())
+        self.client_ids[clientChannelID] = serverChannelID
+        self.memory += _CHANNEL_BYTES + len(name)
+        if hasattr(record, 'add_lost_callback'):
+            record.add_lost_callback(self.record_lost)
+        return CreateChannelResponse(clientChannelID, serverChannelID, Status(), 0)
+
+    def record_lost(self, record):
+        """
+        *record* is gone, e.g. its upstream server disconnected. Destroy its channels, the client searches again.
+        """
+        with self.lock:
+            for serverChannelID, channel_record in list(self.channels.items()):
+                if channel_record is not record:
+                    continue
+                clientChannelID = self.channel_state[serverChannelID][0]
+                self.destroy_channel(serverChannelID)
+                try:
+                    self.send_data(DestroyChannelRequest(serverChannelID, clientChannelID,
+                                                         MessageDirection.Server).to_buffer())
+                except EnvironmentError:
+                    pass
+
+    def destroy_channel(self, serverChannelID):
+        """
+        Drop the channel and its requests.
+        """
+        record = self.channels.pop(serverChannelID, None)
+        if record is None:
+            return
+        clientChannelID, name, requestIDs = self.channel_state.pop(serverChannelID)
+        if self.client_ids.get(clientChannelID) == serverChannelID:
+            del self.client_ids[clientChannelID]
+        if hasattr(record, 'remove_lost_callback'):
+            record.remove_lost_callback(self.record_lost)
+        for requestID in list(requestIDs):
+            self.calls.pop(requestID, None)
+            self.destroy_request(requestID)
+        self.memory -= _CHANNEL_BYTES + len(name)
+
+    def stats(self):
+        return {
+            'channels': len(self.channels),
+            'requests': len(self.requests),
+            'memory': self.memory,
+        }
+
+    def destroy_request(self, requestID):
+        state = self.requests.pop(requestID, None)
+        if state is None:
+            return
+        if state[2] is not None:
+            state[2].destroy()
+        channel = self.channel_state.get(state[4])
+        if channel is not None:
+            channel[2].discard(requestID)
+        self.memory -= _REQUEST_BYTES
+
+    def cancel_request(self, requestID):
+        """
+        Stop what the request is doing, it stays until destroyed.
+        """
+        self.calls.pop(requestID, None)
+        state = self.requests.get(requestID)
+        if state is not None and state[2] is not None:
+            state[2].stop()
+
+    def connection_lost(self):
+        with self.lock:
+            self.lost = True
+            self.calls.clear()
+            for serverChannelID in list(self.channels):
+                self.destroy_channel(serverChannelID)
+            for requestID in list(self.requests):
+                self.destroy_request(requestID)
@@ -0,0 +1,309 @@
+"""
+TCP name server.
+
+Clients send their search requests over a persistent TCP connection to a name server instead of
+broadcasting them on every subnet. The name server answers from a channel to server index, fed by
+registrations and by searching the servers it learned about from their beacons.
+
+Run with::
+
+    python -m e4py.nameserver --port 5075
+
+and point the clients to it with EPICS_PVA_NAME_SERVERS.
+"""
+import argparse
+import ipaddress
+import random
+import socket
+import sys
+import threading
+
+from . import constants
+from . import health
+from .beacon import BeaconListener, BeaconTable
+from .messages import *
+from .messages import MessageDirection
+from .search import SearchScheduler, address_list
+from .timer import scheduler
+from .transport import Connection, configure_socket
+
+
+def _mapped(host):
+    """
+    IPv6 address of *host*, IPv4 addresses mapped.
+    """
+    if ':' in host:
+        return ipaddress.ip_address(u'%s' % host)
+    return ipaddress.ip_address(u'::ffff:%s' % socket.gethostbyname(host))
+
+
+class NameServerDispatcher(ServerMessageDispatcher):
+    """
+    Server dispatcher answering search requests received over TCP from the index of a :class:`NameServer`.
+    """
+    def __init__(self, transport, name_server):
+        ServerMessageDispatcher.__init__(self, transport)
+        self.name_server = name_server
+        self.closed = False
+
+    def message_received(self, header, buffer):
+        if header.messageCommand == ApplicationMessageCode.SearchRequest:
+            self.name_server.search_received(self, SearchRequest.from_buffer(buffer))
+        else:
+            ServerMessageDispatcher.message_received(self, header, buffer)
+
+    def found(self, sequenceId, address, instanceIds):
+        """
+        Send the response for channels served at *address*.
+        """
+        if self.closed:
+            return
+        response = SearchResponse(self.name_server.guid, sequenceId, _mapped(address[0]), address[1], b'tcp',
+                                  True, instanceIds)
+        try:
+            self.send_data(response.to_buffer())
+        except EnvironmentError:
+            self.closed = True
+
+    def connection_lost(self):
+        self.closed = True
+        ServerMessageDispatcher.connection_lost(self)
+
+
+class NameServer(object):
+    """
+    Channel to server index.
+
+    Names not in the index are searched on the servers announced by beacons, and on *search_addresses*.
+
+    :param timeout: seconds to search for a name asked by a client before giving up, the client retries
+    """
+    def __init__(self, search_addresses=(), timeout=5.):
+        self.guid = random.getrandbits(96)
+        self.timeout = timeout
+        # name -> (host, port)
+        self.index = {}
+        # (dispatcher, sequenceId, address) -> instance IDs resolved since the last batch was sent
+        self.replies = {}
+        self.lock = threading.Lock()
+        self.searcher = SearchScheduler(list(search_addresses))
+        self.searcher.add_batch_callback(self._send_replies)
+        self.beacons = BeaconTable(self.searcher)
+        self.beacons.add_server_callback(self._server_seen)
+        self.beacons.add_anomaly_callback(self._server_changed)
+
+    def register(self, names, address):
+        """
+        Enter the channels *names* served at (*host*, *port*) into the index.
+        """
+        with self.lock:
+            for name in names:
+                self.index[name] = address
+
+    def unregister(self, address):
+        """
+        Remove all channels of the server at *address*.
+        """
+        with self.lock:
+            for name, served in list(self.index.items()):
+                if served == address:
+                    del self.index[name]
+
+    def lookup(self, name):
+        """
+        :return: (*host*, *port*) or None
+        """
+        return self.index.get(name)
+
+    def resolve(self, name, callback):
+        """
+        Call *callback(name, address)* once *name* is known.
+        """
+        address = self.index.get(name)
+        if address is not None:
+            callback(name, address)
+            return
+
+        def found(name, address):
+            with self.lock:
+                self.index[name] = address
+            callback(name, address)
+
+        self.searcher.search(name, found)
+        # other clients may wait for the same name
+        scheduler.schedule(self.timeout, self.searcher.cancel, name, found)
+
+    def search_received(self, dispatcher, request):
+        """
+        Answer the indexed names of *request* in one response per server. The others are answered as they
+        are found, those found by one search response again in one response per server.
+        """
+        # instance IDs by server
+        found = {}
+        for instanceId, name in request.channels:
+            address = self.index.get(name)
+            if address is not None:
+                found.setdefault(address, []).append(instanceId)
+            else:
+                self.resolve(name, lambda name, address, instanceId=instanceId:
+                             self._add_reply(dispatcher, request.sequenceId, address, instanceId))
+        for address, instanceIds in found.items():
+            dispatcher.found(request.sequenceId, address, instanceIds)
+        # names indexed meanwhile were answered right away
+        self._send_replies()
+
+    def _add_reply(self, dispatcher, sequenceId, address, instanceId):
+        with self.lock:
+            self.replies.setdefault((dispatcher, sequenceId, address), []).append(instanceId)
+
+    def _send_replies(self):
+        with self.lock:
+            replies = self.replies
+            self.replies = {}
+        for (dispatcher, sequenceId, address), instanceIds in replies.items():
+            dispatcher.found(sequenceId, address, instanceIds)
+
+    def _server_seen(self, address):
+        search_address = (address[0], constants.PVA_BROADCAST_PORT)
+        if search_address not in self.searcher.addresses:
+            self.searcher.addresses.append(search_address)
+
+    def _server_changed(self, address):
+        self.unregister(address)
+
+    def serve_connection(self, client):
+        connection = Connection(client, direction=MessageDirection.Server)
+        connection.dispatcher = NameServerDispatcher(connection, self)
+        health.monitor.register(connection)
+        request = ConnectionValidationRequest(connection.receive_buffer_size, 0x7fff, [])
+        connection.send(request.to_buffer())
+        connection.run()
+
+    def run(self, port=constants.PVA_SERVER_PORT, beacon_port=constants.PVA_BROADCAST_PORT):
+        BeaconListener(self.beacons, beacon_port).start()
+        sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        configure_socket(sock, constants.PVA_RECEIVE_BUFFER_SIZE)
+        sock.bind(('', port))
+        sock.listen(64)
+        while True:
+            client, addr = sock.accept()
+            tid = threading.Thread(target=self.serve_connection, args=(client,))
+            tid.daemon = True
+            tid.start()
+
+
+class NameClientDispatcher(MessageDispatcher):
+    """
+    Client side of a name server connection.
+    """
+    def __init__(self, transport, client):
+        MessageDispatcher.__init__(self, transport)
+        self.client = client
+        # keep the connection running between messages
+        self.pending = True
+
+    def message_received(self, header, buffer):
+        if header.messageCommand == ApplicationMessageCode.ConnectionValidation:
+            request = ConnectionValidationRequest.from_buffer(buffer)
+            self.transport.set_send_buffer_size(request.serverReceiverBufferSize)
+            response = ConnectionValidationResponse(self.transport.receive_buffer_size,
+                                                    request.serverIntrospectionRegistryMaxSize, 0, b'')
+            self.send_data(response.to_buffer())
+        elif header.messageCommand == ApplicationMessageCode.ConnectionValidated:
+            self.client.validated(self.transport)
+        elif header.messageCommand == ApplicationMessageCode.SearchResponse:
+            self.client.searcher.response_received(SearchResponse.from_buffer(buffer), self.client.address)
+
+
+class NameServerClient(object):
+    """
+    Persistent connection to a name server, used by a :class:`SearchScheduler` like a search address.
+    The connection is re-established every *reconnect* seconds while it is down.
+    """
+    def __init__(self, address, searcher, reconnect=5.):
+        self.address = address
+        self.searcher = searcher
+        self.reconnect = reconnect
+        # validated connection, searches go out on it
+        self.connection = None
+        # connection being validated or in use, closed by :meth:`close`
+        self.current = None
+        self.closed = threading.Event()
+        searcher.connections.append(self)
+        self.thread = threading.Thread(target=self._run, name='e4py-nameserver')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def try_send(self, data):
+        """
+        Send *data* if connected and the connection takes it without blocking.
+
+        :return: True if sent
+        """
+        connection = self.connection
+        if connection is None:
+            return False
+        try:
+            return connection.try_send(data)
+        except EnvironmentError:
+            return False
+
+    def validated(self, connection):
+        self.connection = connection
+        # what was searched while disconnected goes out now
+        self.searcher.boost()
+
+    def close(self):
+        """
+        Stop using the name server: close the connection and end the reconnect loop.
+        """
+        self.closed.set()
+        if self in self.searcher.connections:
+            self.searcher.connections.remove(self)
+        connection = self.current
+        if connection is not None:
+            connection.close()
+        self.thread.join()
+
+    def _run(self):
+        while not self.closed.is_set():
+            try:
+                family, type_, proto, canonname, sockaddr = socket.getaddrinfo(
+                    self.address[0], self.address[1], 0, socket.SOCK_STREAM)[0]
+                sock = socket.socket(family, socket.SOCK_STREAM)
+                configure_socket(sock, constants.PVA_RECEIVE_BUFFER_SIZE)
+                sock.connect(sockaddr)
+            except EnvironmentError:
+                self.closed.wait(self.reconnect)
+                continue
+            connection = Connection(sock)
+            connection.dispatcher = NameClientDispatcher(connection, self)
+            health.monitor.register(connection)
+            self.current = connection
+            if self.closed.is_set():
+                # closed while connecting
+                connection.close()
+                break
+            connection.run()
+            self.connection = self.current = None
+            self.closed.wait(self.reconnect)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='e4py.nameserver', description='pvAccess TCP name server')
+    parser.add_argument('--port', type=int, default=constants.PVA_SERVER_PORT, help='TCP port for clients')
+    parser.add_argument('--register', action='append', default=[], metavar='NAME=HOST:PORT',
+                        help='channel served at a fixed address, may be repeated')
+    args = parser.parse_args(argv)
+
+    name_server = NameServer(address_list(auto=False))
+    for registration in args.register:
+        name, address = registration.split('=', 1)
+        host, port = address.rsplit(':', 1)
+        name_server.register([name.encode()], (host, int(port)))
+    name_server.run(args.port)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
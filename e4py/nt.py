@@ -0,0 +1,226 @@
+"""
+Normative types, see `EPICS V4 Normative Types <http://epics-pvdata.sourceforge.net/alpha/normativeTypes/normativeTypes.html>`_.
+"""
+import array
+import collections
+import struct
+
+from .data import ArrayFlag, DataObject, DataFlag, LazyStructure
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# serialized time_t and the numeric head of alarm_t
+_time = struct.Struct('=qii')
+_alarm = struct.Struct('=ii')
+
+alarm_t = DataObject.structure(b'alarm_t', [
+    (b'severity', DataObject.scalar(DataFlag.Int)),
+    (b'status', DataObject.scalar(DataFlag.Int)),
+    (b'message', DataObject.scalar(DataFlag.String)),
+])
+
+time_t = DataObject.structure(b'time_t', [
+    (b'secondsPastEpoch', DataObject.scalar(DataFlag.Long)),
+    (b'nanoseconds', DataObject.scalar(DataFlag.Int)),
+    (b'userTag', DataObject.scalar(DataFlag.Int)),
+])
+
+
+def nt_scalar(type_code, array=False):
+    """
+    NTScalar or NTScalarArray of *type_code* with value, alarm and timeStamp.
+    """
+    if array:
+        return DataObject.structure(b'epics:nt/NTScalarArray:1.0', [
+            (b'value', DataObject.array(type_code)),
+            (b'alarm', alarm_t),
+            (b'timeStamp', time_t),
+        ])
+    return DataObject.structure(b'epics:nt/NTScalar:1.0', [
+        (b'value', DataObject.scalar(type_code)),
+        (b'alarm', alarm_t),
+        (b'timeStamp', time_t),
+    ])
+
+
+def nt_table(columns):
+    """
+    NTTable with the columns [(*name*, *type_code*)], labelled by their names.
+    """
+    return DataObject.structure(b'epics:nt/NTTable:1.0', [
+        (b'labels', DataObject.array(DataFlag.String)),
+        (b'value', DataObject.structure(b'', [(name, DataObject.array(type_code)) for name, type_code in columns])),
+        (b'descriptor', DataObject.scalar(DataFlag.String)),
+        (b'alarm', alarm_t),
+        (b'timeStamp', time_t),
+    ])
+
+
+def is_table(type_):
+    return type_.name.startswith(b'epics:nt/NTTable:')
+
+
+def is_scalar_array(type_):
+    return type_.name.startswith(b'epics:nt/NTScalarArray:')
+
+
+def _column(field, value, path, use_numpy):
+    """
+    Numeric arrays straight from the serialized data of a :class:`LazyStructure`, or from the
+    flat values, as NumPy arrays if *use_numpy*, else as :class:`array.array`.
+    """
+    data_type = field.type_
+    if data_type.typecode is None or data_type.array_flag == ArrayFlag.Scalar:
+        return value.get(path) if isinstance(value, LazyStructure) else value[1][value[0].field_offset(path)]
+    if isinstance(value, LazyStructure):
+        buffer = value.reader(path)
+        count = max(buffer._get_size(), 0)
+        data = buffer.source[buffer.index:buffer.index + count * data_type.element_size]
+        if use_numpy:
+            column = numpy.frombuffer(data, data_type.struct_code)
+            # bytes do not change, other sources may be receive buffers
+            return column if isinstance(buffer.source, bytes) else column.copy()
+        column = array.array(data_type.typecode)
+        if hasattr(column, 'frombytes'):
+            column.frombytes(data)
+        else:
+            column.fromstring(bytes(data))
+        return column
+    column = value[1][value[0].field_offset(path)]
+    # decoded values hold array.array, values built from dicts may hold lists
+    if use_numpy:
+        return column if hasattr(column, 'dtype') else numpy.asarray(column, data_type.struct_code)
+    if not isinstance(column, array.array):
+        column = array.array(data_type.typecode, column)
+    return column
+
+
+def columns(value, use_numpy=None):
+    """
+    Columns of an NTTable, or the value of an NTScalarArray as column 'value', as arrays and without making
+    an object per row: NumPy arrays if *use_numpy*, by default when NumPy is installed, else
+    :class:`array.array`. String columns are lists of bytes.
+
+    :param value: :class:`LazyStructure`, e.g. from :meth:`e4py.client.Channel.get` with *lazy*, or
+                  (:class:`DataObject`, flat value list), e.g. of an :class:`e4py.client.RPCCall`
+    :return: {*column name*: array} in column order
+    :raises ValueError: if *value* is neither an NTTable nor an NTScalarArray
+    """
+    if use_numpy is None:
+        use_numpy = numpy is not None
+    elif use_numpy and numpy is None:
+        raise ValueError('NumPy is not installed')
+    type_ = value.type_ if isinstance(value, LazyStructure) else value[0]
+    if is_table(type_):
+        return collections.OrderedDict(
+            (name.decode(), _column(field, value, b'value.' + name, use_numpy))
+            for name, field in type_.field('value').fields)
+    if is_scalar_array(type_):
+        return collections.OrderedDict([('value', _column(type_.field('value'), value, b'value', use_numpy))])
+    raise ValueError('%s is neither an NTTable nor an NTScalarArray' % type_.name.decode())
+
+
+def _find(type_, path, template):
+    """
+    Path of the substructure at *path* if it has the fields of *template*, else of the first such
+    substructure, None if there is none.
+    """
+    names = [name for name, field in template.fields]
+    candidates = sorted(type_.offsets().items(), key=lambda item: (item[0] != path, item[1][0]))
+    for candidate, (offset, field) in candidates:
+        if candidate and field.is_structure() and [name for name, sub in field.fields][:len(names)] == names:
+            return candidate
+    return None
+
+
+class TimeAlarmRing(object):
+    """
+    The timestamps and alarms of the last *capacity* values of a channel of type *type_*, in preallocated
+    columns: int64 secondsPastEpoch, int32 nanoseconds, userTag, severity and status. Alarm messages are
+    not kept.
+
+    The timeStamp and alarm fields, or else the first time_t and alarm_t like substructures, are located
+    once. From a :class:`LazyStructure` they are unpacked straight from the serialized data, nothing else
+    is decoded.
+
+    :raises ValueError: if *type_* has neither a timestamp nor an alarm
+    """
+    time_columns = (('secondsPastEpoch', 'q'), ('nanoseconds', 'i'), ('userTag', 'i'))
+    alarm_columns = (('severity', 'i'), ('status', 'i'))
+
+    def __init__(self, type_, capacity=0x10000):
+        self.type_ = type_
+        self.capacity = capacity
+        self.time_path = _find(type_, b'timeStamp', time_t)
+        self.alarm_path = _find(type_, b'alarm', alarm_t)
+        if self.time_path is None and self.alarm_path is None:
+            raise ValueError('%s has neither a timestamp nor an alarm' % type_.name.decode())
+        self.time_offsets = None
+        self.alarm_offsets = None
+        if self.time_path is not None:
+            # fields follow the structure, unpacked in one go if typed as in time_t
+            self.time_offsets = [type_.field_offset(self.time_path) + 1 + i for i in range(3)]
+            time = type_.field(self.time_path)
+            self.packed_time = [field.struct_format() for name, field in time.fields[:3]] == ['q', 'i', 'i']
+        if self.alarm_path is not None:
+            self.alarm_offsets = [type_.field_offset(self.alarm_path) + 1 + i for i in range(2)]
+            alarm = type_.field(self.alarm_path)
+            self.packed_alarm = all(field.struct_format() == 'i' for name, field in alarm.fields[:2])
+        self.data = collections.OrderedDict()
+        for name, typecode in self.time_columns + self.alarm_columns:
+            column = array.array(typecode)
+            self.data[name] = column + array.array(typecode, b'\x00' * (column.itemsize * capacity))
+        # values appended so far
+        self.count = 0
+
+    def append(self, value):
+        """
+        Record the timestamp and alarm of *value*, a flat value list of *type_* or a :class:`LazyStructure`.
+        """
+        index = self.count % self.capacity
+        data = self.data
+        if self.time_offsets is not None:
+            if not isinstance(value, LazyStructure):
+                seconds, nanoseconds, user_tag = [value[offset] for offset in self.time_offsets]
+            elif self.packed_time:
+                seconds, nanoseconds, user_tag = _time.unpack_from(value.source, value.locate(self.time_offsets[0]))
+            else:
+                seconds, nanoseconds, user_tag = [value.value(offset) for offset in self.time_offsets]
+            data['secondsPastEpoch'][index] = seconds
+            data['nanoseconds'][index] = nanoseconds
+            data['userTag'][index] = user_tag
+        if self.alarm_offsets is not None:
+            if not isinstance(value, LazyStructure):
+                severity, status = [value[offset] for offset in self.alarm_offsets]
+            elif self.packed_alarm:
+                severity, status = _alarm.unpack_from(value.source, value.locate(self.alarm_offsets[0]))
+            else:
+                severity, status = [value.value(offset) for offset in self.alarm_offsets]
+            data['severity'][index] = severity
+            data['status'][index] = status
+        self.count += 1
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def columns(self, use_numpy=None):
+        """
+        :return: {*column name*: array} of the recorded values, oldest first, copied out of the ring:
+                 NumPy arrays if *use_numpy*, by default when NumPy is installed, else :class:`array.array`
+        """
+        if use_numpy is None:
+            use_numpy = numpy is not None
+        elif use_numpy and numpy is None:
+            raise ValueError('NumPy is not installed')
+        start = self.count % self.capacity if self.count > self.capacity else 0
+        result = collections.OrderedDict()
+        for name, column in self.data.items():
+            if use_numpy:
+                column = numpy.frombuffer(column, column.typecode)
+                result[name] = numpy.concatenate((column[start:len(self)], column[:start]))
+            else:
+                result[name] = column[start:len(self)] + column[:start]
+        return result
@@ -0,0 +1,434 @@
+"""
+UDP name resolution.
+
+:class:`SearchServer` answers search requests in batches: it drains all datagrams queued on the socket,
+drops requests already answered, merges the answers per requester and sends them in one burst.
+
+:class:`SearchScheduler` resolves channel names for clients, retrying with exponential backoff.
+"""
+import errno
+import ipaddress
+import itertools
+import os
+import socket
+import struct
+import threading
+
+from . import constants
+from .messages import *
+from .timer import now, scheduler
+from .transport import close_socket
+
+_MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0)
+
+# instance IDs per search response, keeping the datagram within PVA_MAX_UDP_PAYLOAD
+_MAX_INSTANCE_IDS = (constants.PVA_MAX_UDP_PAYLOAD - 64) // 4
+
+# search request flag asking for a response even if no channel is found
+_REPLY_REQUIRED = 0x01
+
+
+def parse_address(text, default_port=constants.PVA_BROADCAST_PORT):
+    """
+    (*host*, *port*) from 'host' or 'host:port'.
+    """
+    host, sep, port = text.rpartition(':')
+    if not sep:
+        return text, default_port
+    return host, int(port)
+
+
+def address_list(addresses=None, auto=None, port=None):
+    """
+    Search destinations.
+
+    :param addresses: unicast or broadcast addresses as a list or a space separated string of host[:port],
+                      by default EPICS_PVA_ADDR_LIST
+    :param auto: add the limited broadcast address, by default EPICS_PVA_AUTO_ADDR_LIST (YES)
+    :param port: default port, by default EPICS_PVA_BROADCAST_PORT or PVA_BROADCAST_PORT
+    :return: [(*host*, *port*)]
+    """
+    if port is None:
+        port = int(os.environ.get('EPICS_PVA_BROADCAST_PORT', constants.PVA_BROADCAST_PORT))
+    if addresses is None:
+        addresses = os.environ.get('EPICS_PVA_ADDR_LIST', '')
+    if isinstance(addresses, str):
+        addresses = addresses.split()
+    if auto is None:
+        auto = os.environ.get('EPICS_PVA_AUTO_ADDR_LIST', 'YES').upper() in ('YES', 'TRUE', '1')
+    result = [parse_address(address, port) for address in addresses]
+    if auto and ('255.255.255.255', port) not in result:
+        result.append(('255.255.255.255', port))
+    return result
+
+
+def name_server_list(addresses=None):
+    """
+    TCP name servers from *addresses*, by default EPICS_PVA_NAME_SERVERS.
+
+    :return: [(*host*, *port*)]
+    """
+    if addresses is None:
+        addresses = os.environ.get('EPICS_PVA_NAME_SERVERS', '')
+    if isinstance(addresses, str):
+        addresses = addresses.split()
+    return [parse_address(address, constants.PVA_SERVER_PORT) for address in addresses]
+
+
+def configure_search_socket(sock):
+    """
+    Enlarge the receive buffer of a search socket, so that a storm of requests queues instead of being dropped.
+    """
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, constants.PVA_SEARCH_RECEIVE_BUFFER_SIZE)
+
+
+def response_destination(request, sender, family=socket.AF_INET6):
+    """
+    Where to send the response to *request* received from *sender*, for a socket of *family*.
+    """
+    address = request.responseAddress
+    if address.ipv4_mapped is not None:
+        address = address.ipv4_mapped
+    host = sender[0] if address.is_unspecified else str(address)
+    if family == socket.AF_INET6 and ':' not in host:
+        host = '::ffff:' + host
+    elif family == socket.AF_INET and host.startswith('::ffff:'):
+        host = host[7:]
+    return host, request.responsePort
+
+
+def server_address(response, sender):
+    """
+    (*host*, *port*) of the server announced by *response*, received from *sender*.
+    """
+    address = response.serverAddress
+    if address.ipv4_mapped is not None:
+        address = address.ipv4_mapped
+    host = sender[0] if address.is_unspecified else str(address)
+    return host, response.serverPort
+
+
+class SearchServer(object):
+    """
+    Answer search requests for the channels of a server.
+
+    :param sock: bound UDP socket
+    :param lookup: *lookup(name)* returns the TCP port serving channel *name*, or None
+    :param guid: server GUID
+    :param batch_size: maximum datagrams handled in one batch
+    :param window: seconds a request is remembered to drop retransmissions and duplicates received on
+                   several interfaces
+    """
+    def __init__(self, sock, lookup, guid, batch_size=256, window=0.5):
+        self.sock = sock
+        self.lookup = lookup
+        self.guid = guid
+        self.batch_size = batch_size
+        self.window = window
+        # (destination, sequenceId) -> time answered
+        self.answered = {}
+        configure_search_socket(sock)
+
+    def receive_batch(self):
+        """
+        Wait for a datagram, then take all others already queued, up to *batch_size*.
+
+        :return: [(*data*, *sender*)]
+        """
+        datagrams = [self.sock.recvfrom(0x10000)]
+        while len(datagrams) < self.batch_size:
+            try:
+                datagrams.append(self.sock.recvfrom(0x10000, _MSG_DONTWAIT))
+            except EnvironmentError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+        return datagrams
+
+    def requests(self, datagrams):
+        """
+        Parse the search requests of a batch, several may share a datagram.
+
+        :return: [(:class:`SearchRequest`, *sender*)]
+        """
+        requests = []
+        for data, sender in datagrams:
+            buffer = BufferReader(data)
+            try:
+                while len(buffer) >= constants.PVA_MESSAGE_HEADER_SIZE:
+                    header = MessageHeader.from_buffer(buffer)
+                    end = buffer.index + header.payloadSize
+                    if header.messageCommand == ApplicationMessageCode.SearchRequest:
+                        requests.append((SearchRequest.from_buffer(buffer), sender))
+                    buffer.index = end
+            except (ValueError, struct.error):
+                # keep what was parsed before the malformed message
+                pass
+        return requests
+
+    def answers(self, requests):
+        """
+        Look up the channels of new requests.
+
+        :return: {(*destination*, *sequenceId*, *port*, *found*): [*instanceId*]}
+        """
+        t = now()
+        self.answered = dict((key, answered) for key, answered in self.answered.items()
+                             if t - answered < self.window)
+        answers = {}
+        family = self.sock.family
+        for request, sender in requests:
+            destination = response_destination(request, sender, family)
+            key = (destination, request.sequenceId)
+            if key in self.answered:
+                continue
+            self.answered[key] = t
+            missing = []
+            for instanceId, name in request.channels:
+                port = self.lookup(name)
+                if port is None:
+                    missing.append(instanceId)
+                else:
+                    answers.setdefault((destination, request.sequenceId, port, True), []).append(instanceId)
+            if missing and request.flags & _REPLY_REQUIRED:
+                answers.setdefault((destination, request.sequenceId, 0, False), []).extend(missing)
+        return answers
+
+    def responses(self, answers):
+        """
+        :return: [(*data*, *destination*)], one datagram per answer unless it has too many instance IDs
+        """
+        responses = []
+        address = ipaddress.ip_address(u'::ffff:0:0')
+        for (destination, sequenceId, port, found), instanceIds in answers.items():
+            for start in range(0, len(instanceIds), _MAX_INSTANCE_IDS):
+                response = SearchResponse(self.guid, sequenceId, address, port, b'tcp', found,
+                                          instanceIds[start:start + _MAX_INSTANCE_IDS])
+                responses.append((response.to_buffer(), destination))
+        return responses
+
+    def process(self, datagrams):
+        for data, destination in self.responses(self.answers(self.requests(datagrams))):
+            try:
+                self.sock.sendto(data, destination)
+            except EnvironmentError:
+                # unreachable requester, the others still get their answers
+                pass
+
+    def run(self):
+        while True:
+            self.process(self.receive_batch())
+
+
+class _Search(object):
+    """
+    A channel being searched.
+    """
+    __slots__ = ('name', 'instanceId', 'callbacks', 'attempt', 'slot')
+
+    def __init__(self, name, instanceId, callback):
+        self.name = name
+        self.instanceId = instanceId
+        self.callbacks = [callback]
+        self.attempt = 0
+        self.slot = None
+
+
+class SearchScheduler(object):
+    """
+    Resolve channel names by UDP search, retrying until found or cancelled.
+
+    Unresolved channels sit in the buckets of a timer wheel ticking every *period* seconds. A channel is
+    first searched on the next tick, then after 2, 4, 8... ticks, at most every *max_period* seconds. All
+    channels due on a tick go out together, packed into as few search requests as possible. Channels of a
+    live server are resolved within a few ticks, a name nobody serves costs a search every *max_period*.
+    When a new server announces itself, all unresolved channels are searched again right away.
+
+    Besides the UDP *addresses*, the requests go to the *connections*, objects with a nonblocking
+    ``try_send(data)`` method such as :class:`e4py.nameserver.NameServerClient`, which pass responses back to
+    :meth:`response_received`. A connection that cannot take a request right away misses that round.
+
+    :param addresses: [(*host*, *port*)] search destinations, unicast or broadcast, see :func:`address_list`
+    """
+    def __init__(self, addresses, period=0.1, max_period=30.):
+        self.addresses = addresses
+        self.period = period
+        self.max_ticks = max(1, int(round(max_period / period)))
+        self.wheel = [set() for i in range(self.max_ticks + 1)]
+        self.tick = 0
+        # instanceId -> _Search
+        self.searches = {}
+        # name -> _Search
+        self.names = {}
+        # (host, port) -> GUID of the server that last answered from there
+        self.guids = {}
+        self.connections = []
+        self.batch_callbacks = []
+        self.ids = itertools.count(1)
+        self.sequence = itertools.count(1)
+        self.lock = threading.Lock()
+        self.timer = None
+        self.closed = False
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.sock.bind(('0.0.0.0', 0))
+        self.thread = threading.Thread(target=self._run, name='e4py-search')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def search(self, name, callback):
+        """
+        Search for channel *name* and call *callback(name, (host, port))* once found.
+        """
+        with self.lock:
+            search = self.names.get(name)
+            if search is not None:
+                search.callbacks.append(callback)
+                return
+            search = _Search(name, next(self.ids) & 0xffffffff, callback)
+            self.searches[search.instanceId] = search
+            self.names[name] = search
+            self._place(search, 1)
+            if self.timer is None and not self.closed:
+                self.timer = scheduler.schedule_periodic(self.period, self._tick)
+
+    def add_batch_callback(self, callback):
+        """
+        Call *callback()* after the callbacks of the channels found by one search response, e.g. to send
+        what they collected together.
+        """
+        self.batch_callbacks.append(callback)
+
+    def cancel(self, name, callback=None):
+        """
+        Stop searching for *name*, or only drop *callback* and stop once no other callback is left.
+        """
+        with self.lock:
+            search = self.names.get(name)
+            if search is None:
+                return
+            if callback is not None:
+                if callback in search.callbacks:
+                    search.callbacks.remove(callback)
+                if search.callbacks:
+                    return
+            self._remove(search)
+
+    def pending(self):
+        """
+        :return: names not resolved yet
+        """
+        with self.lock:
+            return list(self.names)
+
+    def boost(self):
+        """
+        Search all unresolved channels on the next tick and restart their backoff.
+        """
+        with self.lock:
+            for search in self.searches.values():
+                self.wheel[search.slot].discard(search)
+                search.attempt = 0
+                self._place(search, 1)
+
+    def _place(self, search, delay):
+        search.slot = (self.tick + delay) % len(self.wheel)
+        self.wheel[search.slot].add(search)
+
+    def _remove(self, search):
+        self.wheel[search.slot].discard(search)
+        del self.searches[search.instanceId]
+        del self.names[search.name]
+        if not self.searches and self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def _tick(self):
+        with self.lock:
+            self.tick += 1
+            bucket = self.wheel[self.tick % len(self.wheel)]
+            due = list(bucket)
+            bucket.clear()
+            for search in due:
+                search.attempt += 1
+                self._place(search, min(2 ** search.attempt, self.max_ticks))
+            channels = [(search.instanceId, search.name) for search in due]
+        for data in self._requests(channels):
+            for address in self.addresses:
+                try:
+                    self.sock.sendto(data, address)
+                except EnvironmentError:
+                    pass
+            for connection in self.connections:
+                # the ticks of the shared scheduler must not wait for a slow name server
+                connection.try_send(data)
+
+    def _requests(self, channels):
+        """
+        Search requests for *channels*, each within PVA_MAX_UDP_PAYLOAD.
+        """
+        port = self.sock.getsockname()[1]
+        requests = []
+        batch = []
+        # header and fixed part of a request
+        size = 48
+        for instanceId, name in channels:
+            length = 9 + len(name)
+            if batch and size + length > constants.PVA_MAX_UDP_PAYLOAD:
+                requests.append(batch)
+                batch = []
+                size = 48
+            batch.append((instanceId, name))
+            size += length
+        if batch:
+            requests.append(batch)
+        return [SearchRequest(next(self.sequence) & 0xffffffff, 0, u'::ffff:0.0.0.0', port, [b'tcp'],
+                              batch).to_buffer() for batch in requests]
+
+    def response_received(self, response, sender):
+        address = server_address(response, sender)
+        found = []
+        with self.lock:
+            self.guids[address] = response.guid
+            for instanceId in response.instanceIds:
+                search = self.searches.get(instanceId)
+                if search is not None:
+                    self._remove(search)
+                    found.append(search)
+        for search in found:
+            for callback in search.callbacks:
+                callback(search.name, address)
+        if found:
+            for callback in self.batch_callbacks:
+                callback()
+
+    def close(self):
+        """
+        Stop searching and close the socket, which ends the receiving thread.
+        """
+        with self.lock:
+            self.closed = True
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        close_socket(self.sock)
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            try:
+                chunk, sender = self.sock.recvfrom(0x10000)
+            except EnvironmentError:
+                break
+            if self.closed:
+                break
+            buffer = BufferReader(chunk)
+            try:
+                header = MessageHeader.from_buffer(buffer)
+                if header.messageCommand != ApplicationMessageCode.SearchResponse:
+                    continue
+                response = SearchResponse.from_buffer(buffer)
+            except (ValueError, struct.error):
+                continue
+            if response.found:
+                self.response_received(response, sender)
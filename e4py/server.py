@@ -3,33 +3,46 @@ import socket
 import threading
 
 from . import constants
+from . import health
+from .beacon import BeaconEmitter
+from .data import DataFlag
+from .database import Database
+from .nt import nt_scalar
+from .search import SearchServer
 from .messages import *
+from .messages import MessageDirection
+from .transport import Connection, configure_socket
 
 GUID = 0xffffffff00000000ffffffff
 
-def run_server_socket():
+def run_server_socket(database):
     sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+    configure_socket(sock, constants.PVA_RECEIVE_BUFFER_SIZE)
     sock.bind(('::ffff:0:0', constants.PVA_SERVER_PORT))
     sock.listen(5)
 
     client, addr = sock.accept()
+    serve_connection(client, database)
 
-    dispatcher = ServerMessageDispatcher(client)
-
-    request = ConnectionValidationRequest(0x4400, 0x7fff, [])
-    client.send(request.to_buffer())
+    sock.close()
 
-    while True:
-        data = client.recv(1024)
-        status = dispatcher.data_received(data)
-        if status == 0:
-            break
+def serve_connection(client, database):
+    """
+    Serve *database* on the accepted socket *client* until the connection closes.
+    """
+    connection = Connection(client, direction=MessageDirection.Server)
+    connection.dispatcher = ServerMessageDispatcher(connection, database)
+    health.monitor.register(connection)
 
-    client.close()
+    request = ConnectionValidationRequest(connection.receive_buffer_size, 0x7fff, [])
+    connection.send(request.to_buffer())
 
-    sock.close()
+    connection.run()
 
 def run_server():
+    database = Database()
+    database.add(b'testMP', nt_scalar(DataFlag.Double), {'value': 0.0})
+
     sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     if hasattr(socket, 'SO_REUSEPORT'):
@@ -37,30 +50,17 @@ def run_server():
 
     sock.bind(('', constants.PVA_BROADCAST_PORT))
 
-    tid = threading.Thread(target=run_server_socket)
+    tid = threading.Thread(target=run_server_socket, args=(database,))
     tid.start()
 
-    while True:
-        chunk, addr = sock.recvfrom(1024)
-        buffer = BufferReader(chunk)
-        header = MessageHeader.from_buffer(buffer)
-        print(header)
-        if header.messageCommand == ApplicationMessageCode.Beacon:
-            beacon = BeaconMessage.from_buffer(buffer)
-            print(beacon)
-        elif header.messageCommand == ApplicationMessageCode.SearchRequest:
-            request = SearchRequest.from_buffer(buffer)
-            print(request)
-
-            response = SearchResponse(GUID, request.sequenceId,
-                                      ipaddress.ip_address(u'::ffff:0:0'), constants.PVA_SERVER_PORT,
-                                      b'tcp', 1,
-                                      list(id_ for id_,name in request.channels))
-            print(len(response.instanceIds))
-            sock.sendto(response.to_buffer(), (request.responseAddress.exploded, request.responsePort))
-            print(response)
-        else:
-            buffer.skip_bytes(header.payloadSize)
+    beacons = BeaconEmitter([('255.255.255.255', constants.PVA_BROADCAST_PORT)], GUID,
+                            change_count=lambda: database.change_count)
+    beacons.start()
+
+    def lookup(name):
+        return constants.PVA_SERVER_PORT if name in database else None
+
+    SearchServer(sock, lookup, GUID).run()
 
 
 if __name__ == '__main__':
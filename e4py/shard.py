@@ -0,0 +1,396 @@
+"""
+Multi-process server.
+
+The database is created once, then *workers* processes are forked, each encodes and sends in its own
+interpreter. Every PV is owned by one worker, chosen by a hash of its name.
+
+Partitioned (default)
+    A worker serves only the PVs it owns, on port *port* + 1 + *index*, and search responses point clients
+    to the port of the owner. Each worker sends the beacons of its port.
+
+Shared
+    Values live in a :class:`SharedStore` in shared memory. Every worker accepts TCP connections on a
+    listener bound with SO_REUSEPORT to the server port, so the kernel spreads the connections over the
+    workers, and any worker serves any PV: local updates are written to the store, and each worker polls
+    the store's change log and posts the changes made by others to its monitors. Search responses point to
+    the shared port, beacons are sent by worker 0.
+
+Searches are answered by worker 0 alone.
+"""
+import argparse
+import mmap
+import multiprocessing
+import os
+import signal
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+from . import constants
+from .beacon import BeaconEmitter
+from .messages import *
+from .messages import BufferWriter
+from .search import SearchServer
+from .server import GUID, serve_connection
+from .timer import scheduler
+from .transport import configure_socket
+
+# sequence number, length, capacity and file offset of the data in front of each slot
+_slot_header = struct.Struct('QIIQ')
+# end of the used part of the store file and generation, the number of writes so far, at its start
+_store_header = struct.Struct('QQ')
+# slot index written by each of the last generations, after the store header
+_change = struct.Struct('I')
+_CHANGE_LOG_SIZE = 4096
+
+# attempts of SharedStore.read, the first ones only yield the processor, the later ones sleep
+_READ_RETRIES = 1000
+_READ_SPINS = 100
+
+
+def owner(name, workers):
+    """
+    Index of the worker owning PV *name*.
+    """
+    return (zlib.crc32(name) & 0xffffffff) % workers
+
+
+def _differs(a, b):
+    try:
+        return bool(a != b)
+    except ValueError:
+        # NumPy arrays compare elementwise
+        return True
+
+
+class SharedStore(object):
+    """
+    Encoded record values in a shared file mapping, created before the workers are forked.
+
+    Each record has a slot guarded by a sequence number, odd while a write is in progress. Writers
+    serialize on one lock, readers retry until they read an even, unchanged sequence number. A value that
+    outgrows its slot moves to a block of twice its size appended to the file, the old block is not reused.
+    Every process maps the grown file on its next access.
+
+    Every write bumps the store generation and logs the slot in a ring of the last writes, so that readers
+    find what changed without looking at every slot, see :meth:`changes`.
+
+    :param slot_size: bytes reserved per record, by default four times the size of its initial value
+    """
+    def __init__(self, database, slot_size=None):
+        self.slots = {}
+        # slot index -> name
+        self.names = []
+        offset = _store_header.size + _change.size * _CHANGE_LOG_SIZE
+        for name in sorted(database.names()):
+            record = database.get(name)
+            if hasattr(record, 'call'):
+                # RPC services have no value to share
+                continue
+            size = slot_size
+            if size is None:
+                size = max(256, 4 * len(self._encode(record)))
+            self.slots[name] = (offset, size, len(self.names))
+            self.names.append(name)
+            offset += _slot_header.size + size
+        # the file descriptor is inherited by the workers
+        self.file = tempfile.TemporaryFile()
+        os.ftruncate(self.file.fileno(), offset)
+        self.memory = mmap.mmap(self.file.fileno(), offset)
+        _store_header.pack_into(self.memory, 0, offset, 0)
+        for name, (offset, size, index) in self.slots.items():
+            _slot_header.pack_into(self.memory, offset, 0, 0, size, offset + _slot_header.size)
+        self.lock = multiprocessing.Lock()
+        for name in self.slots:
+            self.write(database.get(name))
+
+    @staticmethod
+    def _encode(record):
+        buffer = BufferWriter()
+        record.encode(buffer)
+        return buffer.get_buffer()
+
+    def _map(self, end):
+        """
+        Map the file again if another process grew it past the current mapping.
+        """
+        if end > len(self.memory):
+            self.memory = mmap.mmap(self.file.fileno(), 0)
+
+    def write(self, record):
+        """
+        Store the current value of *record*.
+
+        :return: new sequence number of the slot
+        """
+        offset, size, index = self.slots[record.name]
+        data = self._encode(record)
+        with self.lock:
+            sequence, length, capacity, location = _slot_header.unpack_from(self.memory, offset)
+            _slot_header.pack_into(self.memory, offset, sequence + 1, length, capacity, location)
+            end, generation = _store_header.unpack_from(self.memory, 0)
+            if len(data) > capacity:
+                location = end
+                capacity = 2 * len(data)
+                end = location + capacity
+                os.ftruncate(self.file.fileno(), end)
+            self._map(location + len(data))
+            self.memory[location:location + len(data)] = bytes(data)
+            _slot_header.pack_into(self.memory, offset, sequence + 2, len(data), capacity, location)
+            # the log entry is in place before the generation announces it
+            _change.pack_into(self.memory, _store_header.size + _change.size * (generation % _CHANGE_LOG_SIZE), index)
+            _store_header.pack_into(self.memory, 0, end, generation + 1)
+        return sequence + 2
+
+    def generation(self):
+        """
+        Number of writes so far.
+        """
+        return _store_header.unpack_from(self.memory, 0)[1]
+
+    def changes(self, since):
+        """
+        :return: (*generation*, names of the slots written after generation *since*), the names are None if
+                 the change log no longer reaches back that far
+        """
+        generation = self.generation()
+        if generation - since > _CHANGE_LOG_SIZE:
+            return generation, None
+        names = set()
+        for g in range(since, generation):
+            position = _store_header.size + _change.size * (g % _CHANGE_LOG_SIZE)
+            names.add(self.names[_change.unpack_from(self.memory, position)[0]])
+        if self.generation() - since > _CHANGE_LOG_SIZE:
+            # overwritten while reading
+            return generation, None
+        return generation, names
+
+    def sequence(self, name):
+        return _slot_header.unpack_from(self.memory, self.slots[name][0])[0]
+
+    def read(self, name):
+        """
+        :return: (*sequence*, encoded value), None if a writer held the slot for all attempts
+        """
+        offset = self.slots[name][0]
+        for attempt in range(_READ_RETRIES):
+            sequence, length, capacity, location = _slot_header.unpack_from(self.memory, offset)
+            if not sequence & 1:
+                self._map(location + length)
+                data = self.memory[location:location + length]
+                if _slot_header.unpack_from(self.memory, offset)[0] == sequence:
+                    return sequence, data
+            time.sleep(0 if attempt < _READ_SPINS else 0.001)
+        return None
+
+
+class StoreWriter(object):
+    """
+    Subscriber of a record that writes every local change to the :class:`SharedStore`.
+    """
+    def __init__(self, record, store):
+        self.record = record
+        self.store = store
+        self.sequence = store.sequence(record.name)
+        self.applying = False
+
+    def post(self, update):
+        if not self.applying:
+            self.sequence = self.store.write(self.record)
+
+
+class StoreSync(object):
+    """
+    Keep the records of one worker in step with the :class:`SharedStore`. A poll costs one read of the
+    store generation while nothing changed, then only the slots in the change log are looked at.
+
+    :param period: seconds between polls of the store
+    """
+    def __init__(self, database, store, period=0.01):
+        self.store = store
+        # name -> StoreWriter
+        self.writers = {}
+        self.generation = store.generation()
+        for name in store.slots:
+            record = database.get(name)
+            writer = StoreWriter(record, store)
+            record.monitors.insert(0, writer)
+            self.writers[name] = writer
+        self.timer = scheduler.schedule_periodic(period, self.poll)
+
+    def poll(self):
+        if self.store.generation() == self.generation:
+            return
+        generation, names = self.store.changes(self.generation)
+        if names is None:
+            # more writes than the log holds since the last poll
+            names = self.writers
+        pending = False
+        for name in names:
+            writer = self.writers[name]
+            if self.store.sequence(name) != writer.sequence and not self.apply(writer):
+                pending = True
+        if not pending:
+            self.generation = generation
+
+    def apply(self, writer):
+        """
+        :return: False if the slot could not be read, to be tried again by the next poll
+        """
+        record = writer.record
+        result = self.store.read(record.name)
+        if result is None:
+            return False
+        sequence, data = result
+        values = record.type_.decode(BufferReader(data))
+        with record.lock:
+            changed = BitSet()
+            for offset, value in enumerate(values):
+                if value is not None and _differs(value, record.values[offset]):
+                    changed.set(offset)
+            writer.sequence = sequence
+            if changed.is_empty():
+                return True
+            writer.applying = True
+            try:
+                record.values[:] = values
+                record.notify(changed)
+            finally:
+                writer.applying = False
+        record.flush()
+        return True
+
+
+class PartitionDatabase(object):
+    """
+    View of the PVs owned by one worker.
+    """
+    def __init__(self, database, index, workers):
+        self.database = database
+        self.index = index
+        self.workers = workers
+
+    def get(self, name):
+        if owner(name, self.workers) != self.index:
+            return None
+        return self.database.get(name)
+
+    def names(self):
+        return [name for name in self.database.names() if owner(name, self.workers) == self.index]
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+
+def _listen(port):
+    sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    configure_socket(sock, constants.PVA_RECEIVE_BUFFER_SIZE)
+    sock.bind(('', port))
+    sock.listen(64)
+    return sock
+
+
+def _accept(sock, database):
+    while True:
+        client, addr = sock.accept()
+        tid = threading.Thread(target=serve_connection, args=(client, database))
+        tid.daemon = True
+        tid.start()
+
+
+def _serve_search(database, workers, shared, port, search_port):
+    sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(('', search_port))
+
+    def lookup(name):
+        if name not in database:
+            return None
+        return port if shared else port + 1 + owner(name, workers)
+
+    SearchServer(sock, lookup, GUID).run()
+
+
+def run_worker(index, workers, database, store=None, port=constants.PVA_SERVER_PORT,
+               search_port=constants.PVA_BROADCAST_PORT, worker_init=None):
+    """
+    Body of a forked worker process, never returns.
+    """
+    scheduler.after_fork()
+    if store is not None:
+        StoreSync(database, store)
+        served = database
+        listen_port = port
+    else:
+        # a worker can only serve its own PVs, so it does not share a port with the others
+        served = PartitionDatabase(database, index, workers)
+        listen_port = port + 1 + index
+    if index == 0:
+        tid = threading.Thread(target=_serve_search, args=(database, workers, store is not None, port, search_port))
+        tid.daemon = True
+        tid.start()
+    if index == 0 or store is None:
+        BeaconEmitter([('255.255.255.255', search_port)], GUID, listen_port,
+                      change_count=lambda: database.change_count).start()
+    if worker_init is not None:
+        worker_init(index, database)
+    _accept(_listen(listen_port), served)
+
+
+def run_sharded_server(database, workers=multiprocessing.cpu_count(), shared=False,
+                       port=constants.PVA_SERVER_PORT, search_port=constants.PVA_BROADCAST_PORT,
+                       worker_init=None):
+    """
+    Fork *workers* processes serving *database* and wait for them.
+
+    :param shared: serve every PV from every worker through a :class:`SharedStore`
+    :param worker_init: *worker_init(index, database)* is called in each worker, e.g. to start producing
+                        the values of the PVs it owns, see :func:`owner`
+    """
+    store = SharedStore(database) if shared else None
+    children = []
+    for index in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                run_worker(index, workers, database, store, port, search_port, worker_init)
+            finally:
+                os._exit(1)
+        children.append(pid)
+    # terminating the parent stops the workers too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+
+def main(argv=None):
+    from .data import DataFlag
+    from .database import Database
+    from .nt import nt_scalar
+
+    parser = argparse.ArgumentParser(prog='e4py.shard', description='Multi-process pvAccess server')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(), help='number of worker processes')
+    parser.add_argument('--shared', action='store_true', help='serve every PV from every worker')
+    args = parser.parse_args(argv)
+
+    database = Database()
+    database.add(b'testMP', nt_scalar(DataFlag.Double), {'value': 0.0})
+    run_sharded_server(database, args.workers, args.shared)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
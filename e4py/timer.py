@@ -0,0 +1,91 @@
+import heapq
+import itertools
+import threading
+import time
+import traceback
+
+now = getattr(time, 'monotonic', time.time)
+
+
+class Timer(object):
+    """
+    Handle of a scheduled callback.
+    """
+    __slots__ = ('deadline', 'period', 'callback', 'args', 'cancelled')
+
+    def __init__(self, deadline, period, callback, args):
+        self.deadline = deadline
+        self.period = period
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Scheduler(object):
+    """
+    Run callbacks after a delay or periodically, all on a single daemon thread.
+
+    Callbacks must return quickly, long work belongs to another thread.
+    """
+    def __init__(self):
+        self.queue = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def schedule(self, delay, callback, *args):
+        """
+        Call *callback(*args)* after *delay* seconds.
+
+        :return: :class:`Timer` which can be cancelled
+        """
+        return self._add(Timer(now() + delay, None, callback, args))
+
+    def schedule_periodic(self, period, callback, *args):
+        """
+        Call *callback(*args)* every *period* seconds until the returned :class:`Timer` is cancelled.
+        """
+        return self._add(Timer(now() + period, period, callback, args))
+
+    def after_fork(self):
+        """
+        Drop the timers and the thread inherited by a forked child process.
+        """
+        self.queue = []
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def _add(self, timer):
+        with self.condition:
+            heapq.heappush(self.queue, (timer.deadline, next(self.counter), timer))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='e4py-scheduler')
+                self.thread.daemon = True
+                self.thread.start()
+            elif self.queue[0][2] is timer:
+                self.condition.notify()
+        return timer
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.queue or self.queue[0][0] > now():
+                    self.condition.wait(self.queue[0][0] - now() if self.queue else None)
+                deadline, count, timer = heapq.heappop(self.queue)
+            if timer.cancelled:
+                continue
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                traceback.print_exc()
+            if timer.period is not None and not timer.cancelled:
+                # keep the phase, but skip ticks missed while busy
+                timer.deadline = max(timer.deadline + timer.period, now())
+                with self.condition:
+                    heapq.heappush(self.queue, (timer.deadline, next(self.counter), timer))
+
+# singleton
+scheduler = Scheduler()
@@ -0,0 +1,414 @@
+import collections
+import errno
+import itertools
+import socket
+import struct
+import threading
+
+from . import constants
+from .messages import ControlMessage, ControlMessageCode, MessageDirection
+from .timer import now
+
+_header = struct.Struct('BBBBI')
+
+_MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0)
+
+# buffers per sendmsg call, the POSIX minimum of IOV_MAX
+_MAX_SEND_BUFFERS = 1024
+
+
+def configure_socket(sock, receive_buffer_size):
+    """
+    Apply the receive buffer size and disable Nagle's algorithm on a TCP socket.
+
+    For the receive buffer to influence the TCP window scale, call it before connect (client) or listen (server).
+    """
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer_size)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def close_socket(sock):
+    """
+    Close *sock*, waking up a thread blocked receiving from it, which close alone does not do.
+    """
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except EnvironmentError:
+        # not connected, e.g. a datagram socket, it is woken up all the same on Linux
+        pass
+    sock.close()
+
+
+class ReceiveBuffer(object):
+    """
+    Preallocated buffer filled by :meth:`socket.socket.recv_into`.
+
+    Complete messages are handed out as a memoryview of the buffer. Bytes of an incomplete message are kept
+    and moved to the front before the next receive. The buffer doubles, up to *max_size*, whenever a receive
+    fills all the free space or a single message does not fit.
+    """
+    def __init__(self, size=constants.PVA_RECEIVE_BUFFER_SIZE, max_size=constants.PVA_MAX_RECEIVE_BUFFER_SIZE):
+        self.max_size = max(size, max_size)
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def resize(self, size):
+        """
+        Reallocate the buffer to *size* bytes, keeping the pending data.
+        """
+        size = max(size, self.end - self.start)
+        buffer = bytearray(size)
+        buffer[:self.end - self.start] = self.buffer[self.start:self.end]
+        self.buffer = buffer
+        self.view = memoryview(self.buffer)
+        self.end -= self.start
+        self.start = 0
+
+    def _make_room(self):
+        pending = self.end - self.start
+        needed = self._next_size()
+        if needed > len(self.buffer):
+            # a partial message bigger than the whole buffer
+            self.resize(max(needed, min(2 * len(self.buffer), self.max_size)))
+        elif self.start > 0:
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+            self.start = 0
+            self.end = pending
+
+    def _next_size(self):
+        """
+        Size of the first pending message, or 0 if its header is not complete.
+        """
+        if self.end - self.start < constants.PVA_MESSAGE_HEADER_SIZE:
+            return 0
+        magic, version, flags, command, size = _header.unpack_from(self.buffer, self.start)
+        if flags & 0x01:
+            return constants.PVA_MESSAGE_HEADER_SIZE
+        return constants.PVA_MESSAGE_HEADER_SIZE + size
+
+    def recv_from(self, sock):
+        """
+        Receive into the free space of the buffer.
+
+        :return: number of bytes received, 0 if the peer closed the connection
+        """
+        if self.end == len(self.buffer) or self.start > 0:
+            self._make_room()
+        n = sock.recv_into(self.view[self.end:])
+        self.end += n
+        if self.end == len(self.buffer) and len(self.buffer) < self.max_size:
+            # socket had more than we could take, grow for the next round
+            self.resize(min(2 * len(self.buffer), self.max_size))
+        return n
+
+    def frames(self):
+        """
+        :return: memoryview over the complete messages received so far, may be empty
+        :raises ValueError: if the data does not start with a pvAccess message header
+        """
+        offset = self.start
+        while self.end - offset >= constants.PVA_MESSAGE_HEADER_SIZE:
+            magic, version, flags, command, size = _header.unpack_from(self.buffer, offset)
+            if magic != constants.PVA_MAGIC:
+                raise ValueError('invalid magic byte %x at offset %d' % (magic, offset))
+            if flags & 0x01:
+                size = 0
+            if offset + constants.PVA_MESSAGE_HEADER_SIZE + size > self.end:
+                break
+            offset += constants.PVA_MESSAGE_HEADER_SIZE + size
+        return self.view[self.start:offset]
+
+    def consume(self, n):
+        self.start += n
+        if self.start == self.end:
+            self.start = self.end = 0
+
+
+class Connection(object):
+    """
+    A pvAccess TCP connection.
+
+    It owns the socket and the receive buffer and feeds complete messages to its *dispatcher*.
+
+    Messages sent while the dispatcher handles received data are queued and written together with a single
+    :meth:`socket.socket.sendmsg` once the dispatch cycle ends. Outside a dispatch cycle :meth:`send` flushes
+    immediately.
+
+    Once the peer has advertised its receive buffer size, a MarkSent control message is emitted whenever half of
+    that many bytes are in flight, and the peer answers with AcknowledgeSent after it has processed everything
+    before the mark. Many peers ignore marks, so the window only applies after the first AcknowledgeSent,
+    from then on at most the advertised size is in flight. Data beyond the window stays queued, and
+    producers are expected to check :meth:`writable` and hold back, e.g. keep only the latest value,
+    while the queue exceeds *max_queue_size*.
+    """
+    def __init__(self, sock, receive_buffer_size=constants.PVA_RECEIVE_BUFFER_SIZE,
+                 direction=MessageDirection.Client, max_queue_size=constants.PVA_MAX_SEND_QUEUE_SIZE):
+        self.sock = sock
+        self.dispatcher = None
+        self.direction = direction
+        self.receive_buffer_size = receive_buffer_size
+        self.send_buffer_size = None
+        self.receiver = ReceiveBuffer(receive_buffer_size)
+        self.send_queue = collections.deque()
+        self.send_lock = threading.Lock()
+        self.dispatching = False
+        # flow control, positions are modulo 2**32 as carried by control messages
+        self.send_window = None
+        self.bytes_sent = 0
+        self.bytes_acked = 0
+        self.mark_pending = False
+        # the peer answers marks, the send window applies
+        self.acknowledging = False
+        # the head of the send queue continues a message that is partially written
+        self.mid_message = False
+        self.queued_bytes = 0
+        self.max_queue_size = max_queue_size
+        self.congested = False
+        self.writable_callbacks = []
+        # liveness, see :mod:`e4py.health`
+        self.last_received = now()
+        self.health = None
+        configure_socket(sock, receive_buffer_size)
+
+    def set_send_buffer_size(self, size):
+        """
+        Match the socket send buffer and the send window to the receive buffer size advertised by the peer.
+        The window is enforced once the peer acknowledges a mark.
+        """
+        self.send_buffer_size = size
+        self.send_window = size
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, size)
+
+    def in_flight(self):
+        """
+        Number of bytes sent but not yet acknowledged by the peer.
+        """
+        return (self.bytes_sent - self.bytes_acked) & 0xffffffff
+
+    def writable(self):
+        """
+        False while the send queue is above *max_queue_size*, until it drained to half of it.
+        """
+        return not self.congested
+
+    def add_writable_callback(self, callback):
+        """
+        Call *callback(connection)* whenever the connection becomes writable again.
+        """
+        self.writable_callbacks.append(callback)
+
+    def remove_writable_callback(self, callback):
+        self.writable_callbacks.remove(callback)
+
+    def send(self, data):
+        """
+        Queue *data* for sending. The buffer must not be modified until it is flushed.
+        """
+        self.send_buffers((data,))
+
+    def send_buffers(self, buffers):
+        """
+        Queue the parts of one message, e.g. a per-connection prefix and a body shared with other connections.
+        Parts are referenced, not copied, and nothing else is queued or sent between them.
+        """
+        self.queue_buffers(buffers)
+        if not self.dispatching:
+            self.flush()
+
+    def queue_buffers(self, buffers):
+        """
+        Like :meth:`send_buffers`, but leave the sending to the next :meth:`flush`.
+        """
+        last = len(buffers) - 1
+        with self.send_lock:
+            for i, data in enumerate(buffers):
+                # queue entries are (buffer, ends a message)
+                self.send_queue.append((data, i == last))
+                self.queued_bytes += len(data)
+            if self.queued_bytes >= self.max_queue_size:
+                self.congested = True
+
+    def send_control(self, code, value=0):
+        """
+        Send a control message ahead of the queued data, flow control does not apply.
+        """
+        with self.send_lock:
+            # the send lock is only released on message boundaries
+            self.sock.sendall(ControlMessage(code, value, self.direction).to_buffer())
+
+    def try_send(self, data):
+        """
+        Send a complete message ahead of the queued data without blocking, flow control does not apply.
+        What the socket does not take right away is queued and flushed by a thread of its own.
+
+        :return: True if the message was sent or queued, False to give up
+        """
+        if not self.send_lock.acquire(False):
+            return False
+        try:
+            if self.mid_message:
+                return False
+            try:
+                sent = self.sock.send(data, _MSG_DONTWAIT)
+            except EnvironmentError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return False
+                raise
+            self.bytes_sent = (self.bytes_sent + sent) & 0xffffffff
+            if sent < len(data):
+                self.send_queue.appendleft((memoryview(data)[sent:], True))
+                self.queued_bytes += len(data) - sent
+                self.mid_message = True
+                # an idle connection has nobody else to complete the message
+                thread = threading.Thread(target=self._flush_remainder)
+                thread.daemon = True
+                thread.start()
+            return True
+        finally:
+            self.send_lock.release()
+
+    def _flush_remainder(self):
+        try:
+            self.flush()
+        except EnvironmentError:
+            # the receiving thread notices the broken connection
+            pass
+
+    def flush(self):
+        """
+        Write out the send queue as far as the send window allows, resuming partially written buffers.
+        """
+        with self.send_lock:
+            while self.send_queue:
+                buffers = self._window_buffers()
+                if not buffers:
+                    break
+                if hasattr(self.sock, 'sendmsg'):
+                    sent = self.sock.sendmsg(buffers)
+                else:
+                    sent = self.sock.send(b''.join(buffers))
+                self._advance(sent)
+                self._mark()
+            notify = self.congested and self.queued_bytes < self.max_queue_size // 2
+            if notify:
+                self.congested = False
+        if notify:
+            for callback in list(self.writable_callbacks):
+                callback(self)
+
+    def _mark(self):
+        """
+        Emit MarkSent once half of the send window is in flight. Called with the send lock held.
+        """
+        if self.send_window is None or self.mark_pending or self.mid_message:
+            return
+        if self.in_flight() >= self.send_window // 2:
+            self.mark_pending = True
+            self.sock.sendall(ControlMessage(ControlMessageCode.MarkSent, self.bytes_sent,
+                                             self.direction).to_buffer())
+
+    def _window_buffers(self):
+        """
+        Head buffers of the send queue that fit into the send window, the window only closes on message boundaries.
+        """
+        if self.send_window is None or not self.acknowledging:
+            return [data for data, last in itertools.islice(self.send_queue, _MAX_SEND_BUFFERS)]
+        allowed = self.send_window - self.in_flight()
+        # a partially written message is always completed, and one message passes an empty window
+        if allowed <= 0 and not self.mid_message and self.in_flight() > 0:
+            return []
+        buffers = []
+        for data, last in itertools.islice(self.send_queue, _MAX_SEND_BUFFERS):
+            buffers.append(data)
+            allowed -= len(data)
+            if last and allowed <= 0:
+                break
+        return buffers
+
+    def _advance(self, sent):
+        """
+        Drop *sent* bytes from the head of the send queue.
+        """
+        self.bytes_sent = (self.bytes_sent + sent) & 0xffffffff
+        self.queued_bytes -= sent
+        while sent > 0:
+            data, last = self.send_queue[0]
+            if sent < len(data):
+                self.send_queue[0] = (memoryview(data)[sent:], last)
+                self.mid_message = True
+                return
+            sent -= len(data)
+            self.send_queue.popleft()
+            self.mid_message = not last
+
+    def control_received(self, header):
+        """
+        Handle a control message from the peer.
+        """
+        if header.messageCommand == ControlMessageCode.MarkSent:
+            # everything before the mark has been dispatched by now
+            self.send_control(ControlMessageCode.AcknowledgeSent, header.payloadSize)
+        elif header.messageCommand == ControlMessageCode.AcknowledgeSent:
+            with self.send_lock:
+                self.bytes_acked = header.payloadSize
+                self.acknowledging = True
+                self.mark_pending = False
+                # data sent after the acknowledged mark needs a mark of its own
+                self._mark()
+            if not self.dispatching:
+                self.flush()
+        elif header.messageCommand == ControlMessageCode.EchoRequest:
+            self.send_control(ControlMessageCode.EchoResponse, header.payloadSize)
+        elif header.messageCommand == ControlMessageCode.EchoResponse:
+            self.echo_received(header.payloadSize)
+
+    def echo_received(self, token):
+        if self.health is not None:
+            self.health.echo_received(token)
+
+    def receive(self):
+        """
+        Receive once and dispatch the complete messages.
+
+        :return: 0 if the connection is closed, otherwise the dispatcher status
+        """
+        if self.receiver.recv_from(self.sock) == 0:
+            return 0
+        self.last_received = now()
+        try:
+            frames = self.receiver.frames()
+        except ValueError:
+            return 0
+        if len(frames) == 0:
+            return -1
+        self.dispatching = True
+        try:
+            status = self.dispatcher.data_received(frames)
+        finally:
+            self.dispatching = False
+            self.receiver.consume(len(frames))
+        self.flush()
+        return status
+
+    def run(self):
+        while True:
+            try:
+                status = self.receive()
+            except EnvironmentError:
+                # closed locally, e.g. by the health monitor, or reset by the peer
+                break
+            if status == 0:
+                break
+        self.close()
+
+    def close(self):
+        if self.health is not None:
+            self.health.monitor.unregister(self)
+        if self.dispatcher is not None:
+            self.dispatcher.connection_lost()
+        close_socket(self.sock)
@@ -0,0 +1,53 @@
+import socket
+import threading
+
+import pytest
+
+from e4py import client
+from e4py.database import Database
+from e4py.search import SearchServer
+from e4py.server import serve_connection
+
+
+def _accept(listener, database):
+    while True:
+        try:
+            sock, address = listener.accept()
+        except EnvironmentError:
+            return
+        thread = threading.Thread(target=serve_connection, args=(sock, database))
+        thread.daemon = True
+        thread.start()
+
+
+@pytest.fixture
+def database():
+    return Database()
+
+
+@pytest.fixture
+def server(database):
+    """
+    (TCP port, search port) of a server for *database* on ephemeral ports.
+    """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(5)
+    port = listener.getsockname()[1]
+    thread = threading.Thread(target=_accept, args=(listener, database))
+    thread.daemon = True
+    thread.start()
+    search = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+    search.bind(('::', 0))
+    thread = threading.Thread(target=SearchServer(search, lambda name: port if name in database else None, 42).run)
+    thread.daemon = True
+    thread.start()
+    yield port, search.getsockname()[1]
+    listener.close()
+
+
+@pytest.fixture
+def context(server):
+    context = client.Context(addresses='127.0.0.1:%d' % server[1], name_servers=[], beacon_port=None)
+    yield context
+    context.close()
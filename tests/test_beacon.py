@@ -0,0 +1,27 @@
+import ipaddress
+import time
+
+from e4py.beacon import BeaconTable
+from e4py.messages import BeaconMessage
+
+
+def beacon(guid, changeCount=0):
+    return BeaconMessage(guid, 0, 1, changeCount, ipaddress.ip_address(u'::ffff:0.0.0.0'), 5075, b'tcp')
+
+
+def test_silent_servers_expire():
+    table = BeaconTable()
+    table.beacon_received(beacon(1), ('10.0.0.1', 5076))
+    table.start_expiry(period=0.05, timeout=0.3)
+    try:
+        time.sleep(0.2)
+        table.beacon_received(beacon(2), ('10.0.0.2', 5076))
+        assert set(table.servers) == set([1, 2])
+        time.sleep(0.2)
+        # 0.4 s after the first beacon, 0.2 s after the second
+        assert set(table.servers) == set([2])
+        assert table.addresses == {('10.0.0.2', 5075): 2}
+        time.sleep(0.3)
+        assert not table.servers
+    finally:
+        table.stop_expiry()
@@ -0,0 +1,59 @@
+import pytest
+
+from e4py import capture
+from e4py.messages import *
+from e4py.messages import ControlMessage, ControlMessageCode, Status
+
+
+def build(count=50):
+    """
+    A capture with a truncated start, and the offsets of its messages.
+    """
+    data = b'\x00\xca\x01\x02'
+    offsets = []
+    for i in range(count):
+        # names with magic bytes, which must not be taken for headers
+        name = b'pv\xca%d' % i
+        for message in (CreateChannelRequest([(i, name)]), CreateChannelResponse(i, 100 + i, Status(), 0),
+                        ChannelGetFieldRequest(100 + i, i, b''), ControlMessage(ControlMessageCode.MarkSent, i)):
+            offsets.append(len(data))
+            data += message.to_buffer()
+    return data, offsets
+
+
+def test_scan_skips_garbage():
+    data, offsets = build()
+    assert [offset for offset, size in capture.scan_frames(data)] == offsets
+    assert capture.synchronize(data, offsets[3] + 1) == offsets[4]
+
+
+@pytest.mark.parametrize('parts', [1, 2, 3, 7, 50, 1000])
+def test_ranges_yield_every_message_once(parts):
+    data, offsets = build()
+    ranges = capture.split_ranges(len(data), parts)
+    assert ranges[0][0] == 0 and ranges[-1][1] == len(data)
+    found = [offset for start, stop in ranges for offset, size in capture.range_frames(data, start, stop)]
+    assert found == offsets
+
+
+@pytest.fixture
+def path(tmpdir):
+    path = tmpdir.join('capture.bin')
+    path.write_binary(build()[0])
+    return str(path)
+
+
+def test_summary(path, capsys):
+    capture.main(['--jobs', '2', path])
+    output = capsys.readouterr().out
+    assert 'CreateChannel' in output
+    # every channel is named through its CreateChannel request and response
+    assert '<sid' not in output and '<ioid' not in output
+
+
+def test_stream_in_order(path, capsys, monkeypatch):
+    monkeypatch.setattr(capture, '_STREAM_RANGE_SIZE', 100)
+    capture.main(['--stream', '--jobs', '2', path])
+    output = capsys.readouterr().out
+    offsets = [int(line[1:]) for line in output.splitlines() if line.startswith('@')]
+    assert offsets == build()[1]
@@ -0,0 +1,268 @@
+import array
+import socket
+import threading
+import time
+
+import pytest
+
+from e4py import client, messages
+from e4py.data import DataFlag
+from e4py.nt import nt_scalar
+
+
+def run(target, timeout=10.):
+    """
+    Run *target* on a thread, False if it did not finish in *timeout*.
+    """
+    thread = threading.Thread(target=target)
+    thread.daemon = True
+    thread.start()
+    thread.join(timeout)
+    return not thread.is_alive()
+
+
+def test_stream_flush_does_not_deadlock(database, context):
+    record = database.add('sp', nt_scalar(DataFlag.Double), {'value': 1.})
+    request = context.channel(b'sp').put_request()
+    plan = request.plan('value')
+    connection = request.client.connection
+
+    def put():
+        # held back until the connection drains
+        connection.congested = True
+        request.stream(plan, [2.])
+        # draining calls the writable callback of the stream
+        request.put_values(plan, [3.], wait=False)
+        request.get()
+
+    assert run(put)
+    assert record.get('value') == 2.
+
+
+def test_array_slices(database, context):
+    record = database.add('wf', nt_scalar(DataFlag.Double, True), {'value': [float(i) for i in range(100)]})
+    database.add('sc', nt_scalar(DataFlag.Double), {'value': 1.})
+    request = context.channel(b'wf').array()
+    assert request.get_length() == 100
+    assert list(request.get(10, 5)) == [10., 11., 12., 13., 14.]
+    assert list(request.get(10, 4, 3)) == [10., 13., 16., 19.]
+    assert list(request.get(97)) == [97., 98., 99.]
+
+    out = array.array('d', bytes(8 * 100))
+    assert request.read_into(out, chunk=7, window=3) == 100
+    assert list(out) == [float(i) for i in range(100)]
+    out = array.array('d', bytes(8 * 10))
+    assert request.read_into(out, offset=95) == 5
+    assert list(out[:5]) == [95., 96., 97., 98., 99.]
+
+    request.put([-1., -2., -3.], offset=5, stride=2)
+    assert list(request.get(4, 6)) == [4., -1., 6., -2., 8., -3.]
+    request.set_length(10)
+    assert request.get_length() == 10
+    # writing past the end grows the array with zeros
+    request.put([7.], offset=12)
+    assert list(record.get('value'))[9:] == [-3., 0., 0., 7.]
+
+    with pytest.raises(ValueError):
+        request.get(0, 1, 0)
+    with pytest.raises(ValueError):
+        context.channel(b'sc').array()
+
+
+@pytest.fixture
+def dispatchers(monkeypatch):
+    """
+    Server dispatchers as they are created, limited to 10 channels.
+    """
+    created = []
+    init = messages.ServerMessageDispatcher.__init__
+
+    def limited(self, *args, **kws):
+        init(self, *args, **kws)
+        self.max_channels = 10
+        created.append(self)
+
+    monkeypatch.setattr(messages.ServerMessageDispatcher, '__init__', limited)
+    return created
+
+
+def test_channel_tables_are_cleaned_up(database, context, dispatchers):
+    for i in range(12):
+        database.add('pv%d' % i, nt_scalar(DataFlag.Double), {'value': float(i)})
+    for round_ in range(10):
+        channels = [context.channel(b'pv%d' % i) for i in range(8)]
+        for channel in channels:
+            assert channel.wait_connected(5.)
+        channels[0].put_request()
+        for channel in channels:
+            channel.close()
+    time.sleep(0.3)
+    dispatcher = [dispatcher for dispatcher in dispatchers if dispatcher.database is database][0]
+    assert dispatcher.stats() == {'channels': 0, 'requests': 0, 'memory': 0}
+    assert not dispatcher.channel_state and not dispatcher.client_ids
+    for connection in context.pool.connections.values():
+        assert not connection.channels and not connection.server_ids
+
+    channels = [context.channel(b'pv%d' % i) for i in range(12)]
+    connected = [channel.wait_connected(2.) for channel in channels]
+    assert connected.count(True) == 10
+    refused = [channel for channel, ok in zip(channels, connected) if not ok]
+    assert [channel.status.message for channel in refused] == [b'too many channels'] * 2
+
+
+def test_server_destroys_channel(database, context, dispatchers):
+    database.add('pv', nt_scalar(DataFlag.Double), {'value': 3.})
+    channel = context.channel(b'pv')
+    assert channel.wait_connected(5.)
+    serverChannelID = channel.serverChannelID
+    dispatcher = [dispatcher for dispatcher in dispatchers if dispatcher.database is database][0]
+    with dispatcher.lock:
+        dispatcher.destroy_channel(serverChannelID)
+        dispatcher.send_data(messages.DestroyChannelRequest(serverChannelID, channel.clientChannelID,
+                                                            messages.MessageDirection.Server).to_buffer())
+    time.sleep(0.3)
+    # the client searches again and creates the channel anew
+    assert channel.wait_connected(5.)
+    assert channel.get()['value'] == 3.
+    assert dispatcher.stats()['channels'] == 1
+
+
+def test_close_releases_threads_and_sockets(server):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    # an unused port for the beacons
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    probe.bind(('', 0))
+    beacon_port = probe.getsockname()[1]
+    probe.close()
+    context = client.Context(addresses='127.0.0.1:%d' % server[1],
+                             name_servers='127.0.0.1:%d' % listener.getsockname()[1], beacon_port=beacon_port)
+    context.channel(b'missing')
+    name_server, = context.name_servers
+    # the name server is connected, though it never validates the connection
+    sock, address = listener.accept()
+    threads = [context.searcher.thread, context.listener.thread, name_server.thread]
+    assert all(thread.is_alive() for thread in threads)
+
+    assert run(context.close, 5.)
+    assert not any(thread.is_alive() for thread in threads)
+    assert context.searcher.timer is None and context.beacons.timer is None
+    assert context.searcher.sock.fileno() == -1 and context.listener.sock.fileno() == -1
+    # the connection to the name server is closed
+    assert sock.recv(1) == b''
+    sock.close()
+    listener.close()
+
+
+def test_put_plan_is_shared_by_requests(database, context):
+    record = database.add('sp', nt_scalar(DataFlag.Double), {'value': 1.})
+    channel = context.channel(b'sp')
+    first = channel.put_request()
+    second = channel.put_request()
+    plan = first.plan('value')
+    first.put_values(plan, [2.])
+    first.close()
+    # the message of the second request carries its own request ID
+    second.put_values(plan, [3.])
+    assert record.get('value') == 3.
+    second.close()
+
+
+def test_stream_without_connection_fails(database, context):
+    database.add('sp', nt_scalar(DataFlag.Double), {'value': 1.})
+    request = context.channel(b'sp').put_request()
+    plan = request.plan('value')
+    request.client.close()
+    with pytest.raises(ValueError, match='connection lost'):
+        request.stream(plan, [2.])
+
+
+def test_pipelined_rpc(database, context):
+    def handler(type_, values):
+        x = type_.to_dict(values)['x']
+        if x < 0:
+            raise RuntimeError('negative')
+        # later calls finish first
+        time.sleep(0.05 * (5 - x))
+        return type_, values
+    database.add_service('rpc', handler)
+    channel = context.channel(b'rpc')
+    done = []
+    calls = [channel.rpc_async({'x': x}, lambda call: done.append(call)) for x in range(5)]
+    assert [call.wait()['x'] for call in calls] == list(range(5))
+    assert done[0] is not calls[0]
+    assert len(channel.client.requests) == 0
+
+    failed = channel.rpc_async({'x': -1})
+    with pytest.raises(ValueError, match='negative'):
+        failed.wait()
+    assert b'RuntimeError' in failed.status.callTree
+
+
+def test_introspection_is_cached(database, context, monkeypatch):
+    database.add('a', nt_scalar(DataFlag.Double), {'value': 1.})
+    database.add('b', nt_scalar(DataFlag.Double), {'value': 2.})
+    sent = []
+    request = client._FieldRequest
+
+    def counted(channel, subFieldName, timeout=None):
+        sent.append((channel.name, subFieldName))
+        return request(channel, subFieldName, timeout)
+    monkeypatch.setattr(client, '_FieldRequest', counted)
+    a = context.channel(b'a')
+    type_ = a.introspect()
+    assert a.introspect() is type_
+    assert a.introspect(b'value') is a.introspect(b'value')
+    assert sent == [(b'a', b''), (b'a', b'value')]
+    # equal structures of other channels are interned
+    assert context.channel(b'b').introspect() is type_
+    assert len(context.introspection) == 3
+
+    # a restarted server is asked again
+    context.introspection.invalidate(a.address)
+    assert len(context.introspection) == 0 and context.introspection.interned == {}
+    assert a.introspect().to_buffer() == type_.to_buffer()
+    assert len(sent) == 4
+
+
+def test_introspection_cache_keys():
+    cache = client.IntrospectionCache()
+    type_ = nt_scalar(DataFlag.Double)
+    assert cache.put((1, 'host', 5075), b'a', b'', type_) is type_
+    assert cache.get((1, 'host', 5075), b'a', b'') is type_
+    # another GUID at the same address is a restarted server
+    assert cache.get((2, 'host', 5075), b'a', b'') is None
+    # without a GUID a restart would go unnoticed
+    assert cache.put((None, 'host', 5076), b'a', b'', nt_scalar(DataFlag.Double)) is type_
+    assert cache.get((None, 'host', 5076), b'a', b'') is None
+    assert len(cache) == 1
+
+
+class Transport(object):
+    receive_buffer_size = 0x4000
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, data):
+        self.sent.append(messages.MessageHeader.from_buffer(messages.BufferReader(data)).messageCommand)
+
+
+def _receive(dispatcher, message):
+    buffer = messages.BufferReader(message.to_buffer())
+    dispatcher.message_received(messages.MessageHeader.from_buffer(buffer), buffer)
+
+
+def test_dispatcher_uses_the_introspection_cache():
+    cache = client.IntrospectionCache()
+    key = (1, '127.0.0.1', 5075)
+    type_ = nt_scalar(DataFlag.Double)
+    for expected in ([messages.ApplicationMessageCode.ChannelIF], []):
+        transport = Transport()
+        dispatcher = messages.ClientMessageDispatcher(transport, b'pv', cache, key)
+        _receive(dispatcher, messages.CreateChannelResponse(1, 7, messages.Status(), 0))
+        assert transport.sent == expected
+        if expected:
+            _receive(dispatcher, messages.ChannelGetFieldResponse(1, messages.Status(), type_))
+    assert cache.get(key, b'pv', b'').to_buffer() == type_.to_buffer()
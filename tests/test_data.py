@@ -0,0 +1,43 @@
+import pickle
+
+import pytest
+
+from e4py.data import ArrayFlag, DataFlag, DataObject, DataType
+from e4py.messages import BufferReader
+
+_types = [DataType(type_code, array_flag) for type_code in DataFlag for array_flag in ArrayFlag]
+
+
+@pytest.mark.parametrize('data_type', _types, ids=str)
+def test_field_desc_round_trip(data_type):
+    field_desc = data_type.to_field_desc()
+    # a plain int, as written into buffers
+    assert type(field_desc) is int and 0 <= field_desc < 256
+    assert DataType.from_field_desc(field_desc) is data_type
+    assert DataType(data_type.type_code, data_type.array_flag) is data_type
+    assert pickle.loads(pickle.dumps(data_type)) is data_type
+
+
+def test_field_desc_table():
+    found = set()
+    for field_desc in range(256):
+        try:
+            data_type = DataType.from_field_desc(field_desc)
+        except ValueError:
+            continue
+        found.add(data_type)
+        assert data_type.array_flag == (field_desc & 0x18) >> 3
+        # bits the type ignores do not change it
+        assert DataType.from_field_desc(data_type.to_field_desc()) is data_type
+    assert found == set(_types)
+    for field_desc in (0x40, 0x45, 0x87, 0xa0, 0xe0):
+        with pytest.raises(ValueError):
+            DataType.from_field_desc(field_desc)
+
+
+def test_descriptor_round_trip():
+    fields = [(('s%d' % code).encode(), DataObject.scalar(code)) for code in DataFlag if code < DataFlag.Structure]
+    fields += [(('a%d' % code).encode(), DataObject.array(code)) for code in DataFlag if code < DataFlag.Structure]
+    type_ = DataObject.structure(b'all_t', fields)
+    encoded = bytes(type_.to_buffer())
+    assert bytes(DataObject.from_buffer(BufferReader(encoded)).to_buffer()) == encoded
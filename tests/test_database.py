@@ -0,0 +1,132 @@
+import threading
+import time
+
+from e4py.data import DataFlag, DataObject
+from e4py.database import Database
+from e4py.messages import BitSet, BufferReader
+from e4py.nt import nt_scalar
+
+
+class Connection(object):
+    """
+    Records whether the record lock is free while the queued updates are written.
+    """
+    dispatching = False
+
+    def __init__(self, record):
+        self.record = record
+        self.queued = []
+        self.flushed = []
+
+    def writable(self):
+        return True
+
+    def queue_buffers(self, buffers):
+        self.queued.append(buffers)
+
+    def flush(self):
+        result = []
+
+        def probe():
+            result.append(self.record.lock.acquire(False))
+            if result[0]:
+                self.record.lock.release()
+        thread = threading.Thread(target=probe)
+        thread.start()
+        thread.join()
+        self.flushed.append((len(self.queued), result[0]))
+
+
+def test_updates_are_sent_outside_the_record_lock():
+    record = Database().add('x', nt_scalar(DataFlag.Double), {'value': 1.0})
+    connection = Connection(record)
+    monitor = record.create_monitor(connection, 1)
+    monitor.start()
+    record.update({'value': 2.0})
+    record.put(record.values, BitSet.from_offsets([record.type_.field_offset(b'value')]))
+    assert connection.flushed == [(1, True), (2, True), (3, True)]
+
+
+class Subscriber(object):
+    """
+    Connection that decodes the monitor updates it is sent.
+    """
+    dispatching = False
+
+    def __init__(self, record):
+        self.record = record
+        self.values = record.type_.default_value()
+        self.updates = []
+
+    def writable(self):
+        return True
+
+    def queue_buffers(self, buffers):
+        buffer = BufferReader(buffers[1])
+        changed = BitSet.from_buffer(buffer)
+        self.record.type_.decode(buffer, self.values, changed)
+        self.updates.append(self.values[self.record.type_.field_offset(b'value')])
+
+    def flush(self):
+        pass
+
+
+def subscribe(record, **options):
+    connection = Subscriber(record)
+    record.create_monitor(connection, 1, options).start()
+    return connection
+
+
+def test_deadband():
+    record = Database().add('x', nt_scalar(DataFlag.Double), {'value': 1.0})
+    connection = subscribe(record, deadband='0.5')
+    for value in (1.2, 1.4, 1.6, 1.7, 2.2, 0.):
+        record.update({'value': value})
+    assert connection.updates == [1.0, 1.6, 2.2, 0.]
+    # other fields always pass
+    record.update({'alarm': {'severity': 1}})
+    assert len(connection.updates) == 5
+
+
+def test_relative_deadband():
+    record = Database().add('x', nt_scalar(DataFlag.Double), {'value': 100.})
+    connection = subscribe(record, deadbandRel='0.1')
+    for value in (105., 111., 115., 123.):
+        record.update({'value': value})
+    assert connection.updates == [100., 111., 123.]
+
+
+def test_deadband_covers_the_whole_timestamp():
+    # a timeStamp with a field beyond the usual three
+    time_t = DataObject.structure(b'time_t', [(b'secondsPastEpoch', DataObject.scalar(DataFlag.Long)),
+                                              (b'nanoseconds', DataObject.scalar(DataFlag.Int)),
+                                              (b'userTag', DataObject.scalar(DataFlag.Int)),
+                                              (b'clock', DataObject.scalar(DataFlag.Int))])
+    type_ = DataObject.structure(b'scalar_t', [(b'value', DataObject.scalar(DataFlag.Double)),
+                                               (b'timeStamp', time_t)])
+    record = Database().add('x', type_, {'value': 1.0})
+    connection = subscribe(record, deadband='0.5')
+    record.update({'value': 1.1, 'timeStamp.clock': 7})
+    assert connection.updates == [1.0]
+
+
+def test_max_rate_coalesces():
+    record = Database().add('x', nt_scalar(DataFlag.Double), {'value': 0.})
+    connection = subscribe(record, maxRate='10')
+    for value in range(1, 6):
+        record.update({'value': float(value)})
+    # the first update went out with the subscription, the rest waits for the interval and coalesces
+    assert connection.updates == [0.]
+    time.sleep(0.3)
+    assert connection.updates == [0., 5.]
+
+
+def test_max_rate_drops_without_coalescing():
+    record = Database().add('x', nt_scalar(DataFlag.Double), {'value': 0.})
+    connection = subscribe(record, maxRate='10', coalesce='false')
+    for value in range(1, 6):
+        record.update({'value': float(value)})
+    time.sleep(0.3)
+    assert connection.updates == [0.]
+    record.update({'value': 6.})
+    assert connection.updates == [0., 6.]
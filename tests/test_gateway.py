@@ -0,0 +1,256 @@
+import ipaddress
+import socket
+import threading
+import time
+
+import pytest
+
+from e4py import gateway
+from e4py.data import DataFlag
+from e4py.database import Database
+from e4py.messages import *
+from e4py.messages import ApplicationMessageCode, BufferWriter, MessageHeader
+from e4py.nt import nt_scalar
+from e4py.server import serve_connection
+
+
+def accept(listener, database, connections):
+    while True:
+        try:
+            sock, address = listener.accept()
+        except EnvironmentError:
+            return
+        connections.append(sock)
+        thread = threading.Thread(target=serve_connection, args=(sock, database))
+        thread.daemon = True
+        thread.start()
+
+
+def answer_searches(sock, database, port):
+    while True:
+        try:
+            chunk, sender = sock.recvfrom(0x10000)
+        except EnvironmentError:
+            return
+        buffer = BufferReader(chunk)
+        MessageHeader.from_buffer(buffer)
+        request = SearchRequest.from_buffer(buffer)
+        found = [instanceId for instanceId, name in request.channels if name in database]
+        if found:
+            response = SearchResponse(1, request.sequenceId, ipaddress.ip_address(u'::ffff:0.0.0.0'), port, b'tcp',
+                                      True, found)
+            sock.sendto(response.to_buffer(), sender)
+
+
+def serve(target, *args):
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+
+
+@pytest.fixture
+def upstream():
+    """
+    Upstream server with PV 'up', returns (database, record, accepted sockets, search address).
+    """
+    database = Database()
+    record = database.add('up', nt_scalar(DataFlag.Double), {'value': 1.5})
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(5)
+    connections = []
+    serve(accept, listener, database, connections)
+    search = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    search.bind(('127.0.0.1', 0))
+    serve(answer_searches, search, database, listener.getsockname()[1])
+    yield database, record, connections, search.getsockname()
+    listener.close()
+    search.close()
+
+
+@pytest.fixture
+def gw(upstream):
+    """
+    Gateway for the upstream server, releasing unused channels quickly.
+    """
+    return gateway.Gateway([upstream[3]], port=0, timeout=2., linger=0.2)
+
+
+@pytest.fixture
+def downstream(gw):
+    """
+    Client connected to the gateway.
+    """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(5)
+    serve(accept, listener, gw.database, [])
+    client = Client(listener.getsockname())
+    yield client
+    client.sock.close()
+    listener.close()
+
+
+class Client(object):
+    def __init__(self, address):
+        self.sock = socket.create_connection(address)
+        self.sock.settimeout(5.)
+        self.data = b''
+        self.receive()
+        self.sock.sendall(ConnectionValidationResponse(0x4400, 0x7fff, 0, b'').to_buffer())
+        self.receive()
+
+    def receive(self):
+        """
+        :return: (header, buffer) of the next message
+        """
+        while True:
+            if len(self.data) >= 8:
+                header = MessageHeader.from_buffer(BufferReader(self.data))
+                if len(self.data) >= 8 + header.payloadSize:
+                    buffer = BufferReader(self.data[:8 + header.payloadSize])
+                    MessageHeader.from_buffer(buffer)
+                    self.data = self.data[8 + header.payloadSize:]
+                    return header, buffer
+            self.data += self.sock.recv(0x10000)
+
+    def receive_command(self, command):
+        """
+        Skip monitor updates up to the next message of *command*.
+        """
+        while True:
+            header, buffer = self.receive()
+            if header.messageCommand == command:
+                return buffer
+
+    def create(self, clientChannelID, name):
+        self.sock.sendall(CreateChannelRequest([(clientChannelID, name)]).to_buffer())
+
+    def monitor(self, serverChannelID, requestID):
+        self.sock.sendall(ChannelRequestInit(ApplicationMessageCode.ChannelMonitor, serverChannelID, requestID,
+                                             PVRequest.create()).to_buffer())
+        response = ChannelResponseInit.from_buffer(self.receive_command(ApplicationMessageCode.ChannelMonitor),
+                                                   ApplicationMessageCode.ChannelMonitor)
+        self.sock.sendall(ChannelRequest(ApplicationMessageCode.ChannelMonitor, serverChannelID, requestID,
+                                         Subcommand.Start).to_buffer())
+        return response.types[0]
+
+
+def test_create_channel_does_not_block(downstream):
+    # 'nope' is not found upstream, which takes the resolver timeout
+    downstream.create(1, b'nope')
+    downstream.create(2, b'up')
+    first = CreateChannelResponse.from_buffer(downstream.receive_command(ApplicationMessageCode.CreateChannel))
+    second = CreateChannelResponse.from_buffer(downstream.receive_command(ApplicationMessageCode.CreateChannel))
+    assert (first.clientChannelID, first.status.is_ok()) == (2, True)
+    assert (second.clientChannelID, second.status.is_ok()) == (1, False)
+
+
+def test_put_status(upstream, downstream):
+    database, record, connections, search = upstream
+    downstream.create(1, b'up')
+    serverChannelID = CreateChannelResponse.from_buffer(
+        downstream.receive_command(ApplicationMessageCode.CreateChannel)).serverChannelID
+    type_ = downstream.monitor(serverChannelID, 5)
+    downstream.sock.sendall(ChannelRequestInit(ApplicationMessageCode.ChannelPut, serverChannelID, 6,
+                                               PVRequest.create()).to_buffer())
+    downstream.receive_command(ApplicationMessageCode.ChannelPut)
+
+    body = BufferWriter()
+    bitset = BitSet.from_offsets([type_.field_offset(b'value')])
+    values = type_.default_value()
+    values[type_.field_offset(b'value')] = 3.
+    body.put_raw(bitset.to_buffer())
+    type_.encode(body, values, bitset)
+    downstream.sock.sendall(ChannelRequest(ApplicationMessageCode.ChannelPut, serverChannelID, 6, Subcommand.Default,
+                                           bytes(body.get_buffer())).to_buffer())
+    response = ChannelResponse.from_buffer(downstream.receive_command(ApplicationMessageCode.ChannelPut),
+                                           ApplicationMessageCode.ChannelPut)
+    assert response.status.is_ok()
+    # answered after the upstream server applied the put
+    assert record.get('value') == 3.
+
+
+def test_upstream_lost(upstream, downstream):
+    database, record, connections, search = upstream
+    downstream.create(1, b'up')
+    serverChannelID = CreateChannelResponse.from_buffer(
+        downstream.receive_command(ApplicationMessageCode.CreateChannel)).serverChannelID
+    downstream.monitor(serverChannelID, 5)
+    for sock in connections:
+        sock.shutdown(socket.SHUT_RDWR)
+    response = DestroyChannelRequest.from_buffer(downstream.receive_command(ApplicationMessageCode.DestroyChannel))
+    assert (response.serverChannelID, response.clientChannelID) == (serverChannelID, 1)
+
+    # the channel connects again to a new upstream connection
+    downstream.create(2, b'up')
+    response = CreateChannelResponse.from_buffer(downstream.receive_command(ApplicationMessageCode.CreateChannel))
+    assert response.status.is_ok()
+
+
+def wait_for(condition, timeout=2.):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_failed_channel_is_not_cached(upstream, gw):
+    database, record, connections, search = upstream
+    database.add('late', nt_scalar(DataFlag.Double), {'value': 2.})
+    assert gw.resolver.resolve_wait(b'late', 2.) is not None
+    # found by the search, but gone by the time the gateway creates the channel
+    database.remove('late')
+    assert gw.database.get(b'late') is None
+    assert b'late' not in gw.database.channels
+    assert all(b'late' not in upstream_.names for upstream_ in gw.database.upstreams.values())
+    with pytest.raises(KeyError):
+        gw.resolver.lookup(b'late')
+
+    database.add('late', nt_scalar(DataFlag.Double), {'value': 3.})
+    assert gw.database.get(b'late').get('value') == 3.
+
+
+def test_unused_channel_is_released(upstream, downstream, gw):
+    database, record, connections, search = upstream
+    downstream.create(1, b'up')
+    serverChannelID = CreateChannelResponse.from_buffer(
+        downstream.receive_command(ApplicationMessageCode.CreateChannel)).serverChannelID
+    downstream.monitor(serverChannelID, 5)
+    time.sleep(0.4)
+    # the downstream channel keeps it
+    assert len(record.monitors) == 1
+
+    downstream.sock.sendall(DestroyChannelRequest(serverChannelID, 1).to_buffer())
+    downstream.receive_command(ApplicationMessageCode.DestroyChannel)
+    assert wait_for(lambda: not record.monitors)
+    assert b'up' not in gw.database.channels
+
+    # used again, the channel is created anew
+    downstream.create(2, b'up')
+    serverChannelID = CreateChannelResponse.from_buffer(
+        downstream.receive_command(ApplicationMessageCode.CreateChannel)).serverChannelID
+    downstream.monitor(serverChannelID, 6)
+    assert wait_for(lambda: len(record.monitors) == 1)
+
+
+def test_concurrent_puts_share_one_init(upstream, gw):
+    database, record, connections, search = upstream
+    mirror = gw.database.get(b'up')
+    channel = mirror.channel
+    requests = []
+    add_request = channel.upstream.add_request
+    channel.upstream.add_request = lambda channel_: requests.append(channel_) or add_request(channel_)
+    statuses = []
+    bitset = BitSet.from_offsets([mirror.type_.field_offset(b'value')])
+    values = mirror.type_.default_value()
+    values[mirror.type_.field_offset(b'value')] = 4.
+    threads = [threading.Thread(target=mirror.put_async, args=(values, bitset, statuses.append)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert wait_for(lambda: len(statuses) == 8)
+    assert all(status.is_ok() for status in statuses)
+    assert len(requests) == 1
+    assert record.get('value') == 4.
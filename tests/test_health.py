@@ -0,0 +1,78 @@
+import socket
+import threading
+import time
+
+import pytest
+
+from e4py.health import HealthMonitor
+from e4py.messages import MessageDirection, MessageDispatcher
+from e4py.transport import Connection
+
+
+class Dispatcher(MessageDispatcher):
+    def __init__(self, transport):
+        MessageDispatcher.__init__(self, transport)
+        self.pending = True
+
+    def message_received(self, header, buffer):
+        pass
+
+
+@pytest.fixture
+def sockets():
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    client = socket.create_connection(listener.getsockname())
+    server, _ = listener.accept()
+    listener.close()
+    yield client, server
+    client.close()
+    server.close()
+
+
+def start(sock, direction, monitor=None):
+    connection = Connection(sock, direction=direction)
+    connection.dispatcher = Dispatcher(connection)
+    if monitor is not None:
+        monitor.register(connection)
+    thread = threading.Thread(target=connection.run)
+    thread.daemon = True
+    thread.start()
+    return connection, thread
+
+
+def test_server_answers_echo(sockets):
+    monitor = HealthMonitor(echo_period=0.1, echo_timeout=0.3)
+    dead = []
+    monitor.add_dead_callback(dead.append)
+    client, server = sockets
+    start(server, MessageDirection.Server)
+    connection, thread = start(client, MessageDirection.Client, monitor)
+    time.sleep(1.)
+    assert connection.health.rtt.samples >= 3
+    assert not dead
+    connection.close()
+
+
+def test_silent_server_is_dead(sockets):
+    monitor = HealthMonitor(echo_period=0.1, echo_timeout=0.3)
+    client, server = sockets
+    connection, thread = start(client, MessageDirection.Client, monitor)
+    thread.join(2.)
+    assert not thread.is_alive()
+    assert connection.health.dead
+
+
+def test_server_waits_for_client_echoes(sockets):
+    monitor = HealthMonitor(echo_period=0.2, echo_timeout=0.2)
+    client, server = sockets
+    connection, thread = start(server, MessageDirection.Server, monitor)
+    # an idle client is given two echo periods and the timeout, the server does not probe
+    time.sleep(0.4)
+    assert not connection.health.dead
+    client.settimeout(0.)
+    with pytest.raises(EnvironmentError):
+        client.recv(1)
+    thread.join(2.)
+    assert connection.health.dead
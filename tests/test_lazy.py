@@ -0,0 +1,91 @@
+import array
+
+import pytest
+
+from e4py.data import DataFlag, DataObject, LazyStructure
+from e4py.messages import BufferReader, BufferWriter
+from e4py.nt import nt_scalar
+
+_element = DataObject.structure(b'element_t', [
+    (b'name', DataObject.scalar(DataFlag.String)),
+    (b'value', DataObject.scalar(DataFlag.Double)),
+])
+
+_type = DataObject.structure(b'test_t', [
+    (b'label', DataObject.scalar(DataFlag.String)),
+    (b'scalar', nt_scalar(DataFlag.Int, True)),
+    (b'names', DataObject.array(DataFlag.String)),
+    (b'choice', DataObject.union(b'', [(b'number', DataObject.scalar(DataFlag.Double)),
+                                       (b'text', DataObject.scalar(DataFlag.String))])),
+    (b'elements', DataObject.structure_array(_element)),
+    (b'count', DataObject.scalar(DataFlag.Long)),
+])
+
+
+def element(index):
+    values = _element.default_value()
+    _element.from_dict({'name': b'e%d' % index, 'value': float(index)}, values)
+    return values
+
+
+@pytest.fixture
+def values():
+    values = _type.default_value()
+    values[_type.field_offset(b'label')] = b'lazy'
+    values[_type.field_offset(b'scalar.value')] = array.array('i', range(100))
+    values[_type.field_offset(b'scalar.timeStamp.secondsPastEpoch')] = 1234
+    values[_type.field_offset(b'names')] = [b'a', b'bb', b'ccc']
+    values[_type.field_offset(b'choice')] = (1, b'text')
+    values[_type.field_offset(b'elements')] = [element(i) for i in range(5)]
+    values[_type.field_offset(b'count')] = 77
+    return values
+
+
+def encode(values):
+    buffer = BufferWriter()
+    _type.encode(buffer, values)
+    return bytes(buffer.get_buffer())
+
+
+def encode_field(field, value):
+    buffer = BufferWriter()
+    field.put_value(buffer, value)
+    return bytes(buffer.get_buffer())
+
+
+@pytest.mark.parametrize('prefix', [b'', b'xx'])
+def test_every_field_matches_full_decode(values, prefix):
+    data = encode(values)
+    full = _type.decode(BufferReader(data))
+    for path, (offset, field) in _type.offsets().items():
+        if not path:
+            continue
+        # a fresh structure for each field, so that it skips everything in front
+        got = LazyStructure(_type, memoryview(prefix + data), len(prefix)).value(offset)
+        if field.is_structure():
+            assert got == field.to_dict(full, offset), path
+        elif field.element is not None:
+            assert encode_field(field, got) == encode_field(field, full[offset]), path
+        else:
+            assert got == full[offset], path
+
+
+def test_access(values):
+    data = encode(values)
+    lazy = LazyStructure(_type, memoryview(b'xx' + data), 2)
+    assert lazy['count'] == 77
+    assert lazy.get('scalar.timeStamp.secondsPastEpoch') == 1234
+    assert lazy.size() == len(data)
+    assert lazy.locate(_type.field_offset(b'label')) == 2
+    with pytest.raises(KeyError):
+        lazy.get('missing')
+
+    view = lazy.view('scalar')
+    assert list(view['value']) == list(range(100))
+    assert view.size() == lazy.locate(_type.field_offset(b'names')) - lazy.locate(_type.field_offset(b'scalar'))
+
+    copy = lazy.copy()
+    assert copy.source == data
+    assert copy['names'] == [b'a', b'bb', b'ccc']
+    assert lazy.to_dict() == _type.to_dict(_type.decode(BufferReader(data)))
+    assert LazyStructure.from_values(_type, values)['choice'] == (1, b'text')
@@ -0,0 +1,105 @@
+import struct
+
+from e4py.data import DataFlag, DataObject
+from e4py.messages import (ApplicationMessageCode, BitSet, BufferReader, BufferWriter, ChannelRequest,
+                           ChannelRequestInit, ChannelResponse, DestroyRequest, MessageHeader, PVRequest,
+                           ServerMessageDispatcher, Status, Subcommand)
+
+# a null size followed by an integer that must still be read in place
+_null = b'\xff' + struct.pack('I', 42)
+
+
+def test_null_string():
+    buffer = BufferReader(_null)
+    assert buffer.get_string() == b''
+    assert buffer.get_integer() == 42
+
+
+def test_null_arrays():
+    buffer = BufferReader(_null * 4)
+    assert buffer.get_string_array() == []
+    assert buffer.get_integer() == 42
+    assert list(buffer.get_value_array('d', 8)) == []
+    assert buffer.get_integer() == 42
+    assert buffer.get_integer_array() == ()
+    assert buffer.get_integer() == 42
+    assert BitSet.from_buffer(buffer).bits == 0
+    assert buffer.get_integer() == 42
+
+
+def test_null_string_field():
+    type_ = DataObject.structure(b's', [(b'text', DataObject.scalar(DataFlag.String)),
+                                        (b'n', DataObject.scalar(DataFlag.UInt))])
+    assert type_.decode(BufferReader(_null)) == [None, b'', 42]
+
+
+class Transport(object):
+    def __init__(self):
+        self.responses = []
+
+    def send(self, data):
+        buffer = BufferReader(data)
+        header = MessageHeader.from_buffer(buffer)
+        self.responses.append(ChannelResponse.from_buffer(buffer, header.messageCommand))
+
+
+class Service(object):
+    """
+    An RPC record answering when told to.
+    """
+    type_ = DataObject.structure(b'', [])
+
+    def __init__(self):
+        self.callbacks = []
+
+    def call(self, type_, values, callback):
+        self.callbacks.append(callback)
+
+
+def _receive(dispatcher, message):
+    data = message.to_buffer()
+    buffer = BufferReader(data)
+    dispatcher.message_received(MessageHeader.from_buffer(buffer), buffer)
+
+
+def _call(dispatcher, serverChannelID, requestID, subcommand=Subcommand.Default):
+    argument = DataObject.structure(b'', [(b'x', DataObject.scalar(DataFlag.Int))])
+    body = BufferWriter()
+    body.put_raw(argument.to_buffer())
+    argument.encode(body, [None, 1])
+    _receive(dispatcher, ChannelRequestInit(ApplicationMessageCode.ChannelRPC, serverChannelID, requestID,
+                                            PVRequest.create()))
+    _receive(dispatcher, ChannelRequest(ApplicationMessageCode.ChannelRPC, serverChannelID, requestID, subcommand,
+                                        bytes(body.get_buffer())))
+
+
+def test_pipelined_rpc_with_destroy():
+    transport = Transport()
+    dispatcher = ServerMessageDispatcher(transport)
+    service = Service()
+    serverChannelID = dispatcher.add_channel(1, b'rpc', service).serverChannelID
+    for requestID in (1, 2, 3):
+        _call(dispatcher, serverChannelID, requestID, Subcommand.Destroy)
+    # the requests are released right away, the calls go on
+    assert dispatcher.requests == {} and sorted(dispatcher.calls) == [1, 2, 3]
+    # answered as they complete
+    for index in (2, 0, 1):
+        service.callbacks[index](Status(), service.type_, [None])
+    assert [response.requestID for response in transport.responses[3:]] == [3, 1, 2]
+    assert dispatcher.calls == {}
+
+
+def test_rpc_of_a_reused_request_id():
+    transport = Transport()
+    dispatcher = ServerMessageDispatcher(transport)
+    service = Service()
+    serverChannelID = dispatcher.add_channel(1, b'rpc', service).serverChannelID
+    _call(dispatcher, serverChannelID, 7, Subcommand.Destroy)
+    _receive(dispatcher, DestroyRequest(serverChannelID, 7, ApplicationMessageCode.CancelRequest))
+    _call(dispatcher, serverChannelID, 7, Subcommand.Destroy)
+    # the cancelled call is not answered, nor does it drop the one that reuses its ID
+    service.callbacks[0](Status(), service.type_, [None])
+    assert len(transport.responses) == 2
+    service.callbacks[1](Status(), service.type_, [None])
+    assert len(transport.responses) == 3 and transport.responses[-1].requestID == 7
+    assert dispatcher.calls == {}
@@ -0,0 +1,49 @@
+import socket
+import threading
+import time
+
+from e4py.messages import SearchRequest
+from e4py.nameserver import NameServer
+from e4py.search import SearchServer
+
+
+def test_resolve_timeout_cancels_only_its_caller():
+    server = NameServer(timeout=0.2)
+    server.resolve(b'pv', lambda name, address: None)
+    time.sleep(0.1)
+    server.resolve(b'pv', lambda name, address: None)
+    time.sleep(0.15)
+    # the first resolve timed out, the search goes on for the second
+    assert server.searcher.pending() == [b'pv']
+    time.sleep(0.1)
+    assert server.searcher.pending() == []
+
+
+class Dispatcher(object):
+    def __init__(self):
+        self.responses = []
+
+    def found(self, sequenceId, address, instanceIds):
+        self.responses.append((sequenceId, address[1], sorted(instanceIds)))
+
+
+def test_search_responses_are_batched():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    ports = {b'b': 5080, b'c': 5080, b'd': 5090}
+    thread = threading.Thread(target=SearchServer(sock, ports.get, 1).run)
+    thread.daemon = True
+    thread.start()
+
+    server = NameServer([sock.getsockname()], timeout=1.)
+    server.register([b'a', b'e'], ('127.0.0.1', 5070))
+    dispatcher = Dispatcher()
+    channels = [(1, b'a'), (2, b'b'), (3, b'c'), (4, b'd'), (5, b'e'), (6, b'x')]
+    server.search_received(dispatcher, SearchRequest(9, 0, u'::ffff:0.0.0.0', 0, [b'tcp'], channels))
+    deadline = time.time() + 2.
+    while len(dispatcher.responses) < 3 and time.time() < deadline:
+        time.sleep(0.01)
+    time.sleep(0.1)
+    # one response per server, indexed first
+    assert dispatcher.responses[0] == (9, 5070, [1, 5])
+    assert sorted(dispatcher.responses[1:]) == [(9, 5080, [2, 3]), (9, 5090, [4])]
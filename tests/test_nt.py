@@ -0,0 +1,95 @@
+import array
+
+import pytest
+
+from e4py.data import DataFlag, LazyStructure
+from e4py.messages import BufferReader, BufferWriter
+from e4py.nt import TimeAlarmRing, columns, nt_scalar, nt_table
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+table_t = nt_table([(b'x', DataFlag.Double), (b'id', DataFlag.Int), (b'name', DataFlag.String)])
+table = {
+    'labels': [b'x', b'id', b'name'],
+    'value': {'x': [1.5, 2.5], 'id': [7, 8], 'name': [b'p', b'q']},
+}
+
+
+def forms():
+    """
+    The same table built from dicts, decoded and lazy.
+    """
+    values = table_t.from_dict(table)
+    buffer = BufferWriter()
+    table_t.encode(buffer, values)
+    data = bytes(buffer.get_buffer())
+    return [(table_t, values), (table_t, table_t.decode(BufferReader(data))), LazyStructure(table_t, data)]
+
+
+@pytest.mark.parametrize('index', range(3))
+def test_table_columns_as_array(index):
+    result = columns(forms()[index], use_numpy=False)
+    assert list(result) == ['x', 'id', 'name']
+    assert isinstance(result['x'], array.array) and result['x'].typecode == 'd'
+    assert isinstance(result['id'], array.array)
+    assert list(result['x']) == [1.5, 2.5]
+    assert list(result['id']) == [7, 8]
+    assert list(result['name']) == [b'p', b'q']
+
+
+@pytest.mark.skipif(numpy is None, reason='needs NumPy')
+@pytest.mark.parametrize('index', range(3))
+def test_table_columns_as_numpy(index):
+    result = columns(forms()[index], use_numpy=True)
+    assert result['x'].dtype == numpy.float64
+    assert result['id'].dtype == numpy.int32
+    assert result['x'].tolist() == [1.5, 2.5]
+    assert result['id'].tolist() == [7, 8]
+    assert list(result['name']) == [b'p', b'q']
+
+
+def test_scalar_array_value():
+    type_ = nt_scalar(DataFlag.Short, True)
+    values = type_.from_dict({'value': [1, -2, 3]})
+    assert list(columns((type_, values), use_numpy=False)['value']) == [1, -2, 3]
+    assert list(columns(LazyStructure.from_values(type_, values), use_numpy=False)['value']) == [1, -2, 3]
+
+
+def test_not_a_table():
+    type_ = nt_scalar(DataFlag.Double)
+    with pytest.raises(ValueError):
+        columns((type_, type_.default_value()))
+
+
+def stamped(type_, index):
+    return type_.from_dict({'value': float(index), 'timeStamp': {'secondsPastEpoch': 1000 + index,
+                                                                 'nanoseconds': index, 'userTag': -index},
+                            'alarm': {'severity': index % 3, 'status': index % 5}})
+
+
+@pytest.mark.parametrize('use_numpy', [False, pytest.param(True, marks=pytest.mark.skipif(
+    numpy is None, reason='needs NumPy'))])
+@pytest.mark.parametrize('count', [0, 3, 4, 8, 10])
+def test_ring_keeps_the_latest_in_order(use_numpy, count):
+    type_ = nt_scalar(DataFlag.Double)
+    ring = TimeAlarmRing(type_, 4)
+    for index in range(count):
+        # lazy and decoded values alike
+        values = stamped(type_, index)
+        ring.append(LazyStructure.from_values(type_, values) if index % 2 else values)
+    assert len(ring) == min(count, 4)
+    expected = list(range(max(count - 4, 0), count))
+    result = ring.columns(use_numpy)
+    assert list(result) == ['secondsPastEpoch', 'nanoseconds', 'userTag', 'severity', 'status']
+    if use_numpy:
+        assert result['secondsPastEpoch'].dtype == numpy.int64
+    else:
+        assert result['secondsPastEpoch'].typecode == 'q'
+    assert list(result['secondsPastEpoch']) == [1000 + index for index in expected]
+    assert list(result['nanoseconds']) == expected
+    assert list(result['userTag']) == [-index for index in expected]
+    assert list(result['severity']) == [index % 3 for index in expected]
+    assert list(result['status']) == [index % 5 for index in expected]
@@ -0,0 +1,183 @@
+import socket
+import struct
+import threading
+import time
+
+import pytest
+
+from e4py import client
+from e4py.client import RequestManager
+from e4py.messages import ApplicationMessageCode
+
+
+def run(target, timeout):
+    """
+    Run *target* on a thread, False if it did not finish in *timeout*.
+    """
+    thread = threading.Thread(target=target)
+    thread.daemon = True
+    thread.start()
+    thread.join(timeout)
+    return not thread.is_alive()
+
+
+class Client(object):
+    def __init__(self):
+        self.sent = []
+
+    def send(self, data):
+        self.sent.append(data)
+
+    def commands(self):
+        """
+        (command, serverChannelID, requestID) of the messages sent.
+        """
+        result = []
+        for data in self.sent:
+            offset = 0
+            while offset < len(data):
+                size = struct.unpack_from('I', data, offset + 4)[0]
+                result.append((struct.unpack_from('B', data, offset + 3)[0],) +
+                              struct.unpack_from('II', data, offset + 8))
+                offset += 8 + size
+        return result
+
+
+class Handler(object):
+    serverChannelID = 9
+
+    def __init__(self):
+        self.status = None
+
+    def abort(self, status):
+        self.status = status
+
+
+def test_timeout():
+    connection = Client()
+    requests = RequestManager(connection, tick=0.02)
+    handler = Handler()
+    requestID = requests.add(handler, 0.1)
+    settled = Handler()
+    requests.settle(requests.add(settled, 0.1))
+    time.sleep(0.05)
+    assert handler.status is None
+    time.sleep(0.15)
+    assert handler.status is client._TIMED_OUT
+    assert settled.status is None
+    assert requests.get(requestID) is None
+    assert connection.commands() == [(ApplicationMessageCode.CancelRequest, 9, requestID),
+                                      (ApplicationMessageCode.DestroyRequest, 9, requestID)]
+    # nothing left to time out, the wheel stops
+    assert requests.timer is None
+
+
+class BlockedClient(Client):
+    """
+    A client whose connection does not take anything until *unblocked* is set.
+    """
+    def __init__(self):
+        Client.__init__(self)
+        self.unblocked = threading.Event()
+
+    def send(self, data):
+        self.unblocked.wait()
+        Client.send(self, data)
+
+
+def test_timeout_does_not_wait_for_the_connection():
+    connection = BlockedClient()
+    requests = RequestManager(connection, tick=10.)
+    handlers = [Handler(), Handler()]
+    requestIDs = [requests.add(handler, 1.) for handler in handlers]
+    # the tick returns at once, as the scheduler needs
+    assert run(requests._tick, 1.)
+    assert [handler.status for handler in handlers] == [client._TIMED_OUT] * 2
+    assert requests.timer is None
+    connection.unblocked.set()
+    deadline = time.time() + 2.
+    while not connection.sent and time.time() < deadline:
+        time.sleep(0.01)
+    # sent together once the connection takes them
+    assert sorted(connection.commands()) == sorted(
+        (command, 9, requestID) for requestID in requestIDs
+        for command in (ApplicationMessageCode.CancelRequest, ApplicationMessageCode.DestroyRequest))
+    assert len(connection.sent) == 1
+
+
+def test_cancel():
+    connection = Client()
+    requests = RequestManager(connection)
+    handler = Handler()
+    requestID = requests.add(handler, 5.)
+    requests.cancel(requestID)
+    assert handler.status is client._CANCELLED
+    assert len(requests) == 0
+    assert requests.timer is None
+    assert connection.commands() == [(ApplicationMessageCode.CancelRequest, 9, requestID),
+                                      (ApplicationMessageCode.DestroyRequest, 9, requestID)]
+    # cancelling again does nothing
+    requests.cancel(requestID)
+    assert len(connection.sent) == 1
+
+
+def test_ids_are_quarantined():
+    requests = RequestManager(Client())
+    first = requests.add(Handler())
+    requests.remove(first)
+    second = requests.add(Handler())
+    assert second != first
+
+
+def test_abort_all():
+    requests = RequestManager(Client())
+    handlers = [Handler() for i in range(3)]
+    for handler in handlers:
+        requests.add(handler, 5.)
+    requests.abort_all(client._DISCONNECTED)
+    assert [handler.status for handler in handlers] == [client._DISCONNECTED] * 3
+    assert len(requests) == 0
+    assert requests.timer is None
+
+
+class Connection(Client):
+    """
+    A :class:`client.ClientConnection` whose server never answers.
+    """
+    def __init__(self, state=client.ClientConnection.READY):
+        Client.__init__(self)
+        self.state = state
+        # no timeouts of its own, the request has to give up by itself
+        self.requests = RequestManager(self)
+
+    def add_request(self, handler, timeout=None):
+        return self.requests.add(handler)
+
+    def remove_request(self, requestID):
+        self.requests.remove(requestID)
+
+
+class Channel(object):
+    serverChannelID = 9
+
+    def __init__(self, connection):
+        self.client = connection
+
+
+def test_request_init_times_out():
+    connection = Connection()
+    started = time.time()
+    with pytest.raises(socket.timeout):
+        client.ChannelPut(Channel(connection), timeout=0.1)
+    assert time.time() - started < 1.
+    assert len(connection.requests) == 0
+    # the server is told to forget the request
+    assert [command for command, serverChannelID, requestID in connection.commands()] == \
+        [ApplicationMessageCode.ChannelPut, ApplicationMessageCode.CancelRequest, ApplicationMessageCode.DestroyRequest]
+
+
+def test_request_on_lost_connection_fails():
+    connection = Connection(client.ClientConnection.CLOSED)
+    with pytest.raises(ValueError, match='connection lost'):
+        client.ChannelPut(Channel(connection), timeout=None)
+    assert len(connection.requests) == 0
@@ -0,0 +1,115 @@
+import socket
+import time
+
+from e4py import constants, search
+from e4py.messages import *
+from e4py.messages import MessageHeader
+
+
+class Socket(object):
+    """
+    UDP socket stand-in recording the datagrams sent.
+    """
+    family = socket.AF_INET
+
+    def __init__(self):
+        self.sent = []
+
+    def setsockopt(self, *args):
+        pass
+
+    def sendto(self, data, destination):
+        buffer = BufferReader(data)
+        MessageHeader.from_buffer(buffer)
+        self.sent.append((SearchResponse.from_buffer(buffer), destination))
+
+
+def request(sequenceId, channels, port=5000, flags=0):
+    return SearchRequest(sequenceId, flags, u'::ffff:0.0.0.0', port, [b'tcp'], channels).to_buffer()
+
+
+def server(window=0.5):
+    ports = {b'a': 5075, b'b': 5075, b'c': 5090}
+    return search.SearchServer(Socket(), ports.get, 42, window=window)
+
+
+def answers(sock):
+    return sorted((destination, response.sequenceId, response.serverPort, response.found,
+                   sorted(response.instanceIds)) for response, destination in sock.sent)
+
+
+def test_duplicates_are_answered_once():
+    searcher = server()
+    # received twice, e.g. on two interfaces, and once more from another host
+    searcher.process([(request(1, [(1, b'a')]), ('10.0.0.1', 5076)), (request(1, [(1, b'a')]), ('10.0.0.1', 5076)),
+                      (request(1, [(1, b'a')]), ('10.0.0.2', 5076))])
+    assert answers(searcher.sock) == [(('10.0.0.1', 5000), 1, 5075, True, [1]),
+                                      (('10.0.0.2', 5000), 1, 5075, True, [1])]
+    # a retransmission within the window
+    searcher.process([(request(1, [(1, b'a')]), ('10.0.0.1', 5076))])
+    assert len(searcher.sock.sent) == 2
+
+
+def test_retransmission_after_window():
+    searcher = server(window=0.05)
+    searcher.process([(request(1, [(1, b'a')]), ('10.0.0.1', 5076))])
+    time.sleep(0.1)
+    searcher.process([(request(1, [(1, b'a')]), ('10.0.0.1', 5076))])
+    assert len(searcher.sock.sent) == 2
+
+
+def test_answers_are_aggregated():
+    searcher = server()
+    # two requests in one datagram, channels on two ports and one unknown
+    data = request(7, [(1, b'a'), (2, b'c'), (3, b'x')]) + request(7, [(4, b'b')], port=5001)
+    searcher.process([(data, ('10.0.0.1', 5076)), (request(8, [(5, b'b'), (6, b'a')]), ('10.0.0.1', 5076))])
+    assert answers(searcher.sock) == [(('10.0.0.1', 5000), 7, 5075, True, [1]),
+                                      (('10.0.0.1', 5000), 7, 5090, True, [2]),
+                                      (('10.0.0.1', 5000), 8, 5075, True, [5, 6]),
+                                      (('10.0.0.1', 5001), 7, 5075, True, [4])]
+
+
+def test_not_found_only_when_required():
+    searcher = server()
+    searcher.process([(request(1, [(1, b'x')]), ('10.0.0.1', 5076)),
+                      (request(2, [(2, b'x'), (3, b'y')], flags=0x01), ('10.0.0.1', 5076))])
+    assert answers(searcher.sock) == [(('10.0.0.1', 5000), 2, 0, False, [2, 3])]
+
+
+def test_large_answers_are_split():
+    searcher = server()
+    channels = [(i, b'a') for i in range(1000)]
+    searcher.process([(request(1, channels), ('10.0.0.1', 5076))])
+    instanceIds = [instanceId for response, destination in searcher.sock.sent for instanceId in response.instanceIds]
+    assert len(searcher.sock.sent) > 1
+    assert sorted(instanceIds) == list(range(1000))
+    assert all(len(response.to_buffer()) <= constants.PVA_MAX_UDP_PAYLOAD for response, destination in searcher.sock.sent)
+
+
+class NameServerConnection(object):
+    """
+    Connection of a :class:`search.SearchScheduler` that records requests, or refuses them while busy.
+    """
+    def __init__(self, busy=False):
+        self.busy = busy
+        self.requests = []
+
+    def try_send(self, data):
+        if self.busy:
+            return False
+        buffer = BufferReader(data)
+        MessageHeader.from_buffer(buffer)
+        self.requests.append(SearchRequest.from_buffer(buffer))
+        return True
+
+
+def test_scheduler_sends_to_connections_without_blocking():
+    scheduler = search.SearchScheduler([], period=0.02)
+    busy = NameServerConnection(busy=True)
+    connection = NameServerConnection()
+    scheduler.connections.extend([busy, connection])
+    scheduler.search(b'pv', lambda name, address: None)
+    time.sleep(0.1)
+    scheduler.cancel(b'pv')
+    # the busy connection did not hold up the other one
+    assert [request.channels[0][1] for request in connection.requests][:1] == [b'pv']
@@ -0,0 +1,168 @@
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+from e4py import shard
+from e4py.data import DataFlag
+from e4py.database import Database
+from e4py.messages import *
+from e4py.messages import ApplicationMessageCode, BufferReader, MessageHeader
+from e4py.nt import nt_scalar
+
+_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_store_grows_across_processes():
+    database = Database()
+    record = database.add('w', nt_scalar(DataFlag.Int, True), {'value': [1, 2]})
+    store = shard.SharedStore(database)
+    pid = os.fork()
+    if pid == 0:
+        try:
+            record.update({'value': list(range(1000))})
+            store.write(record)
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+    sequence, data = store.read(b'w')
+    values = record.type_.decode(BufferReader(data))
+    assert list(values[record.type_.field_offset(b'value')]) == list(range(1000))
+    assert sequence == store.sequence(b'w')
+
+
+def test_read_gives_up_on_a_stuck_writer(monkeypatch):
+    database = Database()
+    database.add('a', nt_scalar(DataFlag.Double), {'value': 1.})
+    store = shard.SharedStore(database)
+    monkeypatch.setattr(shard, '_READ_RETRIES', 10)
+    offset = store.slots[b'a'][0]
+    sequence, length, capacity, location = shard._slot_header.unpack_from(store.memory, offset)
+    shard._slot_header.pack_into(store.memory, offset, sequence + 1, length, capacity, location)
+    assert store.read(b'a') is None
+
+
+def workers_pair():
+    """
+    Records of two workers sharing a store, the second one synchronized.
+    """
+    databases = []
+    for i in range(2):
+        database = Database()
+        for name in ('a', 'b', 'c'):
+            database.add(name, nt_scalar(DataFlag.Double), {'value': 0.})
+        databases.append(database)
+    store = shard.SharedStore(databases[0])
+    sync = shard.StoreSync(databases[1], store, period=3600.)
+    sync.timer.cancel()
+    return databases[0], databases[1], store, sync
+
+
+def test_poll_reads_only_changed_slots(monkeypatch):
+    writer, reader, store, sync = workers_pair()
+    read = []
+    original = store.read
+    monkeypatch.setattr(store, 'read', lambda name: read.append(name) or original(name))
+    sync.poll()
+    assert read == []
+
+    record = writer.get('b')
+    record.update({'value': 2.})
+    store.write(record)
+    sync.poll()
+    assert read == [b'b']
+    assert reader.get('b').get('value') == 2.
+    sync.poll()
+    assert read == [b'b']
+
+
+def test_poll_scans_all_after_log_overflow(monkeypatch):
+    monkeypatch.setattr(shard, '_CHANGE_LOG_SIZE', 4)
+    writer, reader, store, sync = workers_pair()
+    for i in range(3):
+        for name in ('a', 'c'):
+            record = writer.get(name)
+            record.update({'value': float(i)})
+            store.write(record)
+    assert store.changes(sync.generation)[1] is None
+    sync.poll()
+    assert [reader.get(name).get('value') for name in ('a', 'b', 'c')] == [2., 0., 2.]
+    assert sync.generation == store.generation()
+
+
+_server = '''
+import sys
+sys.path.insert(0, sys.argv[1])
+from e4py.data import DataFlag
+from e4py.database import Database
+from e4py.nt import nt_scalar
+from e4py import shard
+database = Database()
+for i in range(6):
+    database.add('pv%d' % i, nt_scalar(DataFlag.Double), {'value': float(i)})
+shard.run_sharded_server(database, 3, port=int(sys.argv[2]), search_port=int(sys.argv[3]))
+'''
+
+
+def search(search_port, names):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.settimeout(0.5)
+    request = SearchRequest(1, 0, u'::ffff:0.0.0.0', sock.getsockname()[1], [b'tcp'], list(enumerate(names)))
+    ports = {}
+    try:
+        sock.sendto(request.to_buffer(), ('127.0.0.1', search_port))
+        while True:
+            buffer = BufferReader(sock.recvfrom(0x10000)[0])
+            MessageHeader.from_buffer(buffer)
+            response = SearchResponse.from_buffer(buffer)
+            for instanceId in response.instanceIds:
+                ports[names[instanceId]] = response.serverPort
+    except socket.timeout:
+        pass
+    finally:
+        sock.close()
+    return ports
+
+
+def create_channel(port, name):
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.settimeout(5.)
+    data = b''
+    try:
+        for step in range(3):
+            while len(data) < 8 or len(data) < 8 + MessageHeader.from_buffer(BufferReader(data)).payloadSize:
+                data += sock.recv(0x10000)
+            buffer = BufferReader(data)
+            header = MessageHeader.from_buffer(buffer)
+            data = data[8 + header.payloadSize:]
+            if step == 0:
+                sock.sendall(ConnectionValidationResponse(0x4400, 0x7fff, 0, b'').to_buffer())
+            elif step == 1:
+                sock.sendall(CreateChannelRequest([(1, name)]).to_buffer())
+        assert header.messageCommand == ApplicationMessageCode.CreateChannel
+        return CreateChannelResponse.from_buffer(buffer).status.is_ok()
+    finally:
+        sock.close()
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs fork')
+def test_partitioned_search_points_to_the_owner():
+    port = random.randrange(20000, 60000, 8)
+    process = subprocess.Popen([sys.executable, '-c', _server, _root, str(port), str(port + 5)])
+    try:
+        names = [b'pv%d' % i for i in range(6)]
+        ports = {}
+        deadline = time.time() + 10.
+        while len(ports) < len(names) and time.time() < deadline:
+            ports = search(port + 5, names)
+        assert ports == dict((name, port + 1 + shard.owner(name, 3)) for name in names)
+        time.sleep(0.2)
+        assert all(create_channel(ports[name], name) for name in names)
+    finally:
+        process.terminate()
+        process.wait()
@@ -0,0 +1,265 @@
+import socket
+import struct
+import time
+
+import pytest
+
+from e4py.messages import ControlMessage, ControlMessageCode, MessageHeader, BufferReader
+from e4py.transport import Connection, ReceiveBuffer
+
+_header = struct.Struct('BBBBI')
+
+
+@pytest.fixture
+def pair():
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    sock = socket.create_connection(listener.getsockname())
+    peer, _ = listener.accept()
+    listener.close()
+    peer.settimeout(0.2)
+    connection = Connection(sock)
+    yield connection, peer
+    connection.sock.close()
+    peer.close()
+
+
+def receive(peer):
+    """
+    Everything the peer has received so far, as a list of (is_control, command, payload or value).
+    """
+    data = b''
+    while True:
+        try:
+            chunk = peer.recv(65536)
+        except socket.timeout:
+            break
+        if not chunk:
+            break
+        data += chunk
+    frames = []
+    offset = 0
+    while offset < len(data):
+        magic, version, flags, command, size = _header.unpack_from(data, offset)
+        assert magic == 0xCA
+        offset += 8
+        if flags & 0x01:
+            frames.append((True, command, size))
+        else:
+            frames.append((False, command, data[offset:offset + size]))
+            offset += size
+    assert offset == len(data)
+    return frames
+
+
+def message(index, size=56):
+    """
+    A message in two parts, header prefix and body.
+    """
+    body = bytes(bytearray([index & 0xff])) * size
+    return _header.pack(0xCA, 2, 0, 2, size), body
+
+
+def control(connection, code, value):
+    connection.control_received(MessageHeader.from_buffer(BufferReader(ControlMessage(code, value).to_buffer())))
+
+
+class Stream(object):
+    """
+    Socket stand-in whose recv_into returns at most *chunk* bytes of *data* per call.
+    """
+    def __init__(self, data, chunk):
+        self.data = data
+        self.chunk = chunk
+
+    def recv_into(self, view):
+        n = min(len(view), self.chunk, len(self.data))
+        view[:n] = self.data[:n]
+        self.data = self.data[n:]
+        return n
+
+
+def drain(receiver, sock):
+    """
+    Receive everything from *sock*, return the payloads of the complete messages in order.
+    """
+    payloads = []
+    while receiver.recv_from(sock):
+        frames = receiver.frames()
+        offset = 0
+        while offset < len(frames):
+            size = _header.unpack_from(frames, offset)[4]
+            payloads.append(bytes(frames[offset + 8:offset + 8 + size]))
+            offset += 8 + size
+        receiver.consume(len(frames))
+    assert receiver.start == receiver.end == 0
+    return payloads
+
+
+@pytest.mark.parametrize('chunk', [1, 7, 8, 9, 100, 4096])
+def test_messages_split_across_receives(chunk):
+    bodies = [bytes(bytearray([i])) * (i * 13) for i in range(40)]
+    data = b''.join(_header.pack(0xCA, 2, 0, 2, len(body)) + body for body in bodies)
+    assert drain(ReceiveBuffer(64, 4096), Stream(data, chunk)) == bodies
+
+
+def test_buffer_grows_for_large_message():
+    receiver = ReceiveBuffer(64, 256)
+    body = b'x' * 1000
+    # a message beyond max_size still fits, the buffer grows to hold it
+    assert drain(receiver, Stream(_header.pack(0xCA, 2, 0, 2, len(body)) + body, 50)) == [body]
+    assert len(receiver) >= 1008
+
+
+def test_buffer_grows_when_filled():
+    receiver = ReceiveBuffer(64, 256)
+    data = b''.join(_header.pack(0xCA, 2, 0, 2, 8) + b'y' * 8 for i in range(100))
+    sock = Stream(data, 1 << 20)
+    sizes = []
+    while sock.data:
+        receiver.recv_from(sock)
+        receiver.consume(len(receiver.frames()))
+        sizes.append(len(receiver))
+    # doubles on every full receive, up to max_size
+    assert sizes[:3] == [128, 256, 256]
+
+
+def test_frames_rejects_bad_magic():
+    receiver = ReceiveBuffer(64)
+    receiver.recv_from(Stream(b'\x00' * 16, 16))
+    with pytest.raises(ValueError):
+        receiver.frames()
+
+
+class Writer(object):
+    """
+    Socket stand-in recording sendmsg calls, each takes at most *limit* bytes.
+    """
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.calls = []
+        self.data = b''
+
+    def setsockopt(self, *args):
+        pass
+
+    def sendmsg(self, buffers):
+        data = b''.join(bytes(buffer) for buffer in buffers)[:self.limit]
+        self.calls.append(len(buffers))
+        self.data += data
+        return len(data)
+
+    def send(self, data, flags=0):
+        return self.sendmsg([data])
+
+
+def test_sends_while_dispatching_are_coalesced():
+    sock = Writer()
+    connection = Connection(sock)
+    connection.dispatching = True
+    for i in range(10):
+        connection.send_buffers(message(i))
+    assert sock.calls == []
+    connection.dispatching = False
+    connection.flush()
+    assert sock.calls == [20]
+    assert sock.data == b''.join(b''.join(message(i)) for i in range(10))
+
+
+def test_partial_writes_resume():
+    sock = Writer(limit=37)
+    connection = Connection(sock)
+    connection.dispatching = True
+    for i in range(10):
+        connection.send_buffers(message(i))
+    connection.dispatching = False
+    connection.flush()
+    assert sock.data == b''.join(b''.join(message(i)) for i in range(10))
+    assert len(sock.calls) == -(-len(sock.data) // 37)
+    assert not connection.send_queue and connection.queued_bytes == 0
+
+
+def test_buffers_per_sendmsg_are_bounded():
+    sock = Writer()
+    connection = Connection(sock)
+    connection.dispatching = True
+    for i in range(1500):
+        connection.send(b'%d' % i)
+    connection.dispatching = False
+    connection.flush()
+    assert sock.calls == [1024, 476]
+
+
+def test_try_send_completes_partial_message():
+    sock = Writer(limit=5)
+    connection = Connection(sock)
+    data = b''.join(message(1))
+    assert connection.try_send(data)
+    # the rest is written without other traffic
+    deadline = time.time() + 2.
+    while connection.send_queue and time.time() < deadline:
+        time.sleep(0.01)
+    assert sock.data == data
+    assert not connection.mid_message
+    assert connection.bytes_sent == len(data)
+
+
+def test_no_window(pair):
+    connection, peer = pair
+    for i in range(10):
+        connection.send_buffers(message(i))
+    frames = receive(peer)
+    assert [payload[0] for is_control, command, payload in frames] == list(range(10))
+
+
+def test_window_needs_acknowledging_peer(pair):
+    connection, peer = pair
+    # a peer that ignores marks must not stall the queue
+    connection.set_send_buffer_size(72)
+    for i in range(10):
+        connection.send_buffers(message(i))
+    frames = receive(peer)
+    assert [frame[2][0] for frame in frames if not frame[0]] == list(range(10))
+    assert [frame for frame in frames if frame[0]] == [(True, ControlMessageCode.MarkSent, 64)]
+    assert not connection.send_queue
+
+
+def test_window_breaks_between_messages(pair):
+    connection, peer = pair
+    # the window closes right after the prefix of the second message
+    connection.set_send_buffer_size(72)
+    control(connection, ControlMessageCode.AcknowledgeSent, 0)
+    for i in range(10):
+        connection.send_buffers(message(i))
+    frames = receive(peer)
+    # the parser asserts that no mark splits a message, the second message completes the window
+    assert frames == [(False, 2, message(0)[1]), (True, ControlMessageCode.MarkSent, 64), (False, 2, message(1)[1])]
+    assert len(connection.send_queue) == 16
+
+    control(connection, ControlMessageCode.AcknowledgeSent, 64)
+    assert receive(peer) == [(True, ControlMessageCode.MarkSent, 128), (False, 2, message(2)[1])]
+
+
+def test_window_drains_with_acks(pair):
+    connection, peer = pair
+    connection.set_send_buffer_size(200)
+    control(connection, ControlMessageCode.AcknowledgeSent, 0)
+    for i in range(20):
+        connection.send_buffers(message(i))
+    received = []
+    while connection.send_queue:
+        frames = receive(peer)
+        received.extend(frame[2][0] for frame in frames if not frame[0])
+        marks = [frame[2] for frame in frames if frame[0]]
+        assert marks
+        control(connection, ControlMessageCode.AcknowledgeSent, marks[-1])
+    received.extend(frame[2][0] for frame in receive(peer) if not frame[0])
+    assert received == list(range(20))
+    assert connection.queued_bytes == 0
+
+
+def test_mark_is_acknowledged(pair):
+    connection, peer = pair
+    control(connection, ControlMessageCode.MarkSent, 1234)
+    assert receive(peer) == [(True, ControlMessageCode.AcknowledgeSent, 1234)]